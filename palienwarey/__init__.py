@@ -1,6 +1,3 @@
-from . import machines
-
-
 VERSION = (0, 1, 0, 'a', 0)
 
 
@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+import bisect
+import threading
+import time
+
+from .colors import pack_colors
+from .constants import (
+    CMD_SET_COLOR, DEFAULT_ANIMATION_FPS, MAX_ANIMATION_FPS, SUCCESS)
+from .logconf import logger
+from .stats import clock, LatencyHistogram
+
+
+__all__ = ['Timeline', 'Animation', 'load_spec', 'FrameScheduler',
+           'AnimationPlayer']
+
+
+def _rgb(color):
+    """
+    Returns the (r, g, b) tuple of a 6 digit rgb color string.
+    """
+    if len(color) != 6:
+        raise ValueError(
+            'Invalid number of digits (must be 6, %s given)' % len(color))
+    return tuple(int(color[i:i + 2], 16) for i in (0, 2, 4))
+
+
+class Timeline(object):
+    """
+    Color of a zone over time, linearly interpolated between keyframes.
+
+    Keyframes are (seconds, 'rrggbb') pairs. Before the first keyframe and
+    after the last one the zone keeps their color, unless period is given:
+    then time wraps every period seconds, fading from the last keyframe back
+    into the first one.
+    """
+
+    def __init__(self, keyframes, period=None):
+        self.keyframes = sorted((float(seconds), color)
+                                for seconds, color in keyframes)
+        if not self.keyframes:
+            raise ValueError('Timeline without keyframes')
+        points = [(seconds, _rgb(color)) for seconds, color in self.keyframes]
+        if period is not None:
+            if period < points[-1][0]:
+                raise ValueError('Keyframe at %.3fs past the %.3fs period' %
+                                 (points[-1][0], period))
+            points.append((points[0][0] + period, points[0][1]))
+        self.period = period
+        self.times = [seconds for seconds, _ in points]
+        self.colors = [rgb for _, rgb in points]
+
+    def color_at(self, seconds):
+        """
+        Returns the (r, g, b) color at seconds, channels being floats.
+        """
+        if self.period:
+            seconds %= self.period
+            if seconds < self.times[0]:
+                seconds += self.period
+        i = bisect.bisect_right(self.times, seconds)
+        if i == 0:
+            return self.colors[0]
+        if i == len(self.times):
+            return self.colors[-1]
+        start, end = self.times[i - 1], self.times[i]
+        ratio = (seconds - start) / (end - start)
+        return tuple(a + (b - a) * ratio
+                     for a, b in zip(self.colors[i - 1], self.colors[i]))
+
+
+class Animation(object):
+    """
+    Timelines for a set of zones, by single zone uid.
+
+    Looping animations start over every duration seconds, others end after
+    it. Duration defaults to the time of the last keyframe.
+    """
+
+    def __init__(self, timelines, duration=None, loop=True):
+        if not timelines:
+            raise ValueError('Animation without zones')
+        if duration is None:
+            duration = max(float(seconds) for keyframes in timelines.values()
+                           for seconds, _ in keyframes)
+        self.duration = float(duration)
+        self.loop = loop
+        # Animations shorter than a frame are still images.
+        period = self.duration if loop and self.duration > 0 else None
+        self.timelines = dict((uid, Timeline(keyframes, period))
+                              for uid, keyframes in timelines.items())
+
+    def frame_at(self, seconds):
+        """
+        Returns a dict with the device color of every zone at seconds.
+        """
+        return self.frames_at([seconds])[0]
+
+    def frames_at(self, times):
+        """
+        Returns a frame, as frame_at does, for every time in times. The
+        colors of all of them are packed in one batch (see
+        ``colors.pack_colors``).
+        """
+        uids = sorted(self.timelines)
+        timelines = [self.timelines[uid] for uid in uids]
+        packed = pack_colors([[timeline.color_at(seconds)
+                               for timeline in timelines]
+                              for seconds in times])
+        return [dict(zip(uids, frame)) for frame in packed]
+
+    def as_spec(self):
+        """
+        Returns a JSON serializable spec of the animation, see load_spec.
+        """
+        return {
+            'duration': self.duration,
+            'loop': self.loop,
+            'zones': [[uid, [list(keyframe) for keyframe in
+                             timeline.keyframes]]
+                      for uid, timeline in sorted(self.timelines.items())]
+        }
+
+
+def _zone_uids(machine, key):
+    if machine is None:
+        if not isinstance(key, int):
+            raise ValueError('Zone %r is not a uid' % (key,))
+        return [key]
+    if isinstance(key, int):
+        zone = machine['zones_by_uid'].get(key)
+    else:
+        zone = dict((z['alias'], z) for z in machine['zones']).get(key)
+    if zone is None:
+        raise ValueError('Unknown zone %r' % (key,))
+    if zone['is_group']:
+        return list(zone['uid'])
+    return [zone['uid']]
+
+
+def load_spec(spec, machine=None):
+    """
+    Returns the Animation described by spec, a dict like::
+
+        {"duration": 2, "loop": true,
+         "zones": {"all": [[0, "ff0000"], [1, "0000ff"]],
+                   "power": [[0, "ffffff"], [1, "000000"]]}}
+
+    Zones can be a dict or a list of [zone, keyframes] pairs, zones being
+    uids or, when machine is given, aliases too. Group zones are expanded
+    into their members. Duration and loop are optional.
+
+    Raises:
+      + ValueError: if spec is not valid.
+    """
+    try:
+        zones = spec['zones']
+        if isinstance(zones, dict):
+            zones = zones.items()
+        timelines = {}
+        for zone, keyframes in zones:
+            for uid in _zone_uids(machine, zone):
+                timelines[uid] = keyframes
+        return Animation(timelines, spec.get('duration'),
+                         spec.get('loop', True))
+    except (KeyError, TypeError, AttributeError) as e:
+        raise ValueError('Invalid animation: %s' % e)
+
+
+class FrameScheduler(object):
+    """
+    Plays an Animation by calling send with a frame every 1/fps seconds.
+
+    send takes a list of zones as ``protocol.send`` does and returns a
+    status code. Every frame holds all the zones, frames where no zone
+    changed color are not sent at all, and a DeviceSession only sends the
+    zones that did.
+
+    Frames are due at fixed times from the start, taken from a monotonic
+    clock, so the time spent sending does not add up as drift. When a send
+    takes longer than a frame (the device being slow or the daemon queue
+    full), the frames whose time passed meanwhile are dropped instead of
+    being sent late. Frames are computed a second worth at a time, see
+    ``Animation.frames_at``.
+    """
+
+    def __init__(self, animation, send, fps=DEFAULT_ANIMATION_FPS):
+        if not 0 < fps <= MAX_ANIMATION_FPS:
+            raise ValueError('FPS must be between 0 and %d, %r given' %
+                             (MAX_ANIMATION_FPS, fps))
+        self.animation = animation
+        self.send = send
+        self.fps = fps
+        self.usb_histogram = LatencyHistogram()
+        self.frames = 0
+        self.sent = 0
+        self.zones_sent = 0
+        self.dropped = 0
+        self.errors = 0
+        self.last_error = None
+        self.started = None
+        self.stopped = None
+        self.running = False
+        self.thread = None
+
+    def start(self, seconds=None):
+        """
+        Plays the animation from a new thread, see run.
+        """
+        self.running = True
+        self.thread = threading.Thread(target=self._run, args=(seconds,),
+                                       name='lsdaemon-animation')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None and self.thread.is_alive() and \
+           self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def run(self, seconds=None):
+        """
+        Plays the animation until stopped, for seconds when given or, for
+        animations not looping, until they end.
+        """
+        self.running = True
+        self._run(seconds)
+
+    def _run(self, seconds):
+        period = 1.0 / self.fps
+        if seconds is None and not self.animation.loop:
+            seconds = self.animation.duration
+        batch = max(1, int(self.fps))
+        self.started = start = clock()
+        previous = {}
+        frames = []
+        first = slot = 0
+        while self.running:
+            due = slot * period
+            if seconds is not None and due > seconds:
+                break
+            if not first <= slot < first + len(frames):
+                first = slot
+                frames = self.animation.frames_at(
+                    [(first + i) * period for i in range(batch)])
+            frame = frames[slot - first]
+            changed = sum(1 for uid, color in frame.items()
+                          if previous.get(uid) != color)
+            self.frames += 1
+            if changed:
+                previous = frame if self._send(frame) else {}
+                if previous:
+                    self.sent += 1
+                    self.zones_sent += changed
+
+            # Frames already due are dropped, the latest one is sent now.
+            late = int((clock() - start) / period)
+            next_slot = max(slot + 1, late)
+            self.dropped += next_slot - slot - 1
+            slot = next_slot
+            delay = start + slot * period - clock()
+            if delay > 0:
+                time.sleep(delay)
+        self.stopped = clock()
+        self.running = False
+
+    def _send(self, frame):
+        zones = [[uid, (CMD_SET_COLOR, color)]
+                 for uid, color in sorted(frame.items())]
+        before = clock()
+        try:
+            code = self.send(zones)
+        except Exception as e:
+            logger.exception(e)
+            code = None
+        failed = code != SUCCESS
+        self.usb_histogram.add(clock() - before, failed)
+        if failed:
+            # Everything gets sent again with the next frame.
+            self.errors += 1
+            self.last_error = code
+            logger.debug('Cannot send frame (code %s)', code)
+        return not failed
+
+    def stats(self):
+        elapsed = 0
+        if self.started is not None:
+            elapsed = (self.stopped or clock()) - self.started
+        return {
+            'playing': self.running,
+            'fps': self.fps,
+            'achieved_fps': self.frames / elapsed if elapsed else 0.0,
+            'frames': self.frames,
+            'sent': self.sent,
+            'zones_sent': self.zones_sent,
+            'dropped': self.dropped,
+            'errors': self.errors,
+            'usb': self.usb_histogram.as_dict()
+        }
+
+
+class AnimationPlayer(object):
+    """
+    Plays one animation at a time in the background through send, a new
+    one replacing the one being played. Used by lsdaemon.
+    """
+
+    def __init__(self, send):
+        self.send = send
+        self.lock = threading.Lock()
+        self.scheduler = None
+
+    def play(self, animation, fps=DEFAULT_ANIMATION_FPS, seconds=None):
+        scheduler = FrameScheduler(animation, self.send, fps)
+        with self.lock:
+            if self.scheduler is not None:
+                self.scheduler.stop()
+            self.scheduler = scheduler
+            scheduler.start(seconds)
+
+    def stop(self):
+        with self.lock:
+            if self.scheduler is not None:
+                self.scheduler.stop()
+
+    def stats(self):
+        with self.lock:
+            if self.scheduler is None:
+                return None
+            return self.scheduler.stats()
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+import json
+import struct
+
+from .constants import (
+    BINARY_MAGIC, CMD_SET_MORPH, CMD_STRING_MAP, MAX_SPEED, MESSAGES_MAP,
+    SUCCESS)
+
+
+__all__ = ['METHODS', 'is_binary', 'pack_color', 'unpack_color',
+           'encode_request', 'decode_request', 'encode_response',
+           'decode_response']
+
+
+# Methods by id, ids are part of the wire format: only append.
+METHODS = ('ping', 'send', 'state', 'invalidate', 'stats', 'describe')
+METHOD_IDS = dict((name, i) for i, name in enumerate(METHODS))
+
+FLAG_ID = 0x01
+FLAG_SAVE = 0x02
+FLAG_MODES = 0x04
+FLAG_DATA = 0x08
+
+# magic, method id or response code, flags
+_head = struct.Struct('<2sBB')
+_request_id = struct.Struct('<I')
+# speed, mode count, zone count
+_send = struct.Struct('<HBB')
+# uid count, command count
+_zone = struct.Struct('<BB')
+_uid = struct.Struct('<I')
+# command, 12 bit color
+_color = struct.Struct('<BH')
+_morph = struct.Struct('<BHH')
+
+
+def is_binary(frame):
+    """
+    Returns True if frame holds a binary encoded message.
+    """
+    return frame[:len(BINARY_MAGIC)].tobytes() == BINARY_MAGIC
+
+
+def pack_color(color, first=True):
+    """
+    Returns the 12 bit 0xRGB value of a color as returned by parse_color.
+    """
+    if first:
+        rg, b = color
+        if b & 0xf:
+            raise ValueError('Invalid color %r' % (color,))
+        return (rg << 4) | (b >> 4)
+    r, gb = color
+    if r > 0xf:
+        raise ValueError('Invalid color %r' % (color,))
+    return (r << 8) | gb
+
+
+def unpack_color(rgb, first=True):
+    """
+    Inverse of pack_color.
+    """
+    if first:
+        return (rgb >> 4, (rgb & 0xf) << 4)
+    return (rgb >> 8, rgb & 0xff)
+
+
+def _encode_send(zones=None, modes=None, speed=MAX_SPEED, save=False):
+    flags = (FLAG_SAVE if save else 0) | (FLAG_MODES if modes else 0)
+    zones = zones or ()
+    modes = modes or ()
+    chunks = [_send.pack(speed, len(modes), len(zones)),
+              struct.pack('<%dB' % len(modes), *modes)]
+    for zone_cmds in zones:
+        uids = zone_cmds[0]
+        if not isinstance(uids, (list, tuple)):
+            uids = (uids,)
+        cmds = zone_cmds[1:]
+        chunks.append(_zone.pack(len(uids), len(cmds)))
+        for uid in uids:
+            chunks.append(_uid.pack(uid))
+        for cmd_and_args in cmds:
+            cmd = cmd_and_args[0]
+            if cmd not in CMD_STRING_MAP:
+                raise ValueError('Unknown command %r' % (cmd,))
+            if cmd == CMD_SET_MORPH:
+                chunks.append(_morph.pack(
+                    cmd, pack_color(cmd_and_args[1]),
+                    pack_color(cmd_and_args[2], False)))
+            else:
+                chunks.append(_color.pack(cmd, pack_color(cmd_and_args[1])))
+    return flags, ''.join(chunks)
+
+
+def _decode_send(data, offset, flags):
+    speed, mode_count, zone_count = _send.unpack_from(data, offset)
+    offset += _send.size
+    modes = list(struct.unpack_from('<%dB' % mode_count, data, offset))
+    offset += mode_count
+    zones = []
+    for _ in range(zone_count):
+        uid_count, cmd_count = _zone.unpack_from(data, offset)
+        offset += _zone.size
+        if not uid_count:
+            raise ValueError('Zone without uids')
+        uids = struct.unpack_from('<%dI' % uid_count, data, offset)
+        offset += _uid.size * uid_count
+        zone_cmds = [uids[0] if uid_count == 1 else uids]
+        for _ in range(cmd_count):
+            cmd, rgb = _color.unpack_from(data, offset)
+            if cmd == CMD_SET_MORPH:
+                rgb2 = _morph.unpack_from(data, offset)[2]
+                zone_cmds.append((cmd, unpack_color(rgb),
+                                  unpack_color(rgb2, False)))
+                offset += _morph.size
+            elif cmd in CMD_STRING_MAP:
+                zone_cmds.append((cmd, unpack_color(rgb)))
+                offset += _color.size
+            else:
+                raise ValueError('Unknown command %r' % (cmd,))
+        zones.append(zone_cmds)
+    if offset != len(data):
+        raise ValueError('%d trailing bytes' % (len(data) - offset))
+    return {
+        'zones': zones,
+        'modes': modes if flags & FLAG_MODES else None,
+        'speed': speed,
+        'save': bool(flags & FLAG_SAVE)
+    }
+
+
+def encode_request(method, args=None, request_id=None):
+    """
+    Returns the binary payload for a request.
+
+    Raises ValueError when the request cannot be binary encoded: unknown
+    methods, arguments for methods other than send, or commands and colors
+    not produced by parse.
+    """
+    try:
+        method_id = METHOD_IDS[method]
+    except KeyError:
+        raise ValueError('Method %r has no binary encoding' % method)
+    flags = 0
+    body = ''
+    try:
+        if method == 'send':
+            flags, body = _encode_send(**(args or {}))
+        elif args is not None:
+            raise ValueError('Method %r takes no arguments' % method)
+        head = _head.pack(BINARY_MAGIC, method_id,
+                          flags | (FLAG_ID if request_id is not None else 0))
+        if request_id is not None:
+            head += _request_id.pack(int(request_id))
+    except (struct.error, TypeError, IndexError) as e:
+        raise ValueError(str(e))
+    return head + body
+
+
+def decode_request(frame):
+    """
+    Decodes a binary request frame into (method_name, args, request_id),
+    like lsdaemon's protocol.parse after loading the JSON arguments.
+
+    Raises ValueError on invalid data.
+    """
+    try:
+        _, method_id, flags = _head.unpack_from(frame)
+        offset = _head.size
+        request_id = None
+        if flags & FLAG_ID:
+            request_id = str(_request_id.unpack_from(frame, offset)[0])
+            offset += _request_id.size
+        try:
+            method_name = METHODS[method_id]
+        except IndexError:
+            raise ValueError('Unknown method id %d' % method_id)
+        args = None
+        if method_name == 'send':
+            args = _decode_send(frame, offset, flags)
+        elif offset != len(frame):
+            raise ValueError('%d trailing bytes' % (len(frame) - offset))
+    except struct.error as e:
+        raise ValueError(str(e))
+    return method_name, args, request_id
+
+
+def encode_response(response):
+    """
+    Returns the binary payload for a response dict. The message is left
+    out, clients know it from the code.
+    """
+    flags = 0
+    tail = ''
+    if 'id' in response:
+        flags |= FLAG_ID
+        tail += _request_id.pack(int(response['id']))
+    if 'data' in response:
+        flags |= FLAG_DATA
+        tail += json.dumps(response['data'])
+    return _head.pack(BINARY_MAGIC, response['code'], flags) + tail
+
+
+def decode_response(frame):
+    """
+    Decodes a binary response frame into the same dict a JSON response
+    would load into.
+
+    Raises ValueError on invalid data.
+    """
+    try:
+        _, code, flags = _head.unpack_from(frame)
+    except struct.error as e:
+        raise ValueError(str(e))
+    offset = _head.size
+    response = {'success': code == SUCCESS,
+                'code': code,
+                'message': MESSAGES_MAP.get(code, '')}
+    if flags & FLAG_ID:
+        try:
+            response['id'] = str(_request_id.unpack_from(frame, offset)[0])
+        except struct.error as e:
+            raise ValueError(str(e))
+        offset += _request_id.size
+    if flags & FLAG_DATA:
+        response['data'] = json.loads(frame[offset:].tobytes())
+    return response
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+import colorsys
+import math
+
+try:
+    import numpy
+except ImportError:
+    # Optional, colors are handled in pure Python without it.
+    numpy = None
+
+
+__all__ = ['HAVE_NUMPY', 'BAYER_MATRIX', 'interpolate', 'quantize',
+           'pack_levels', 'pack_colors', 'pack_morphs']
+
+
+HAVE_NUMPY = numpy is not None
+
+# Ordered dithering thresholds (times 16), by frame and zone modulo 4.
+BAYER_MATRIX = ((0, 8, 2, 10),
+                (12, 4, 14, 6),
+                (3, 11, 1, 9),
+                (15, 7, 13, 5))
+
+# Channels go from 0 to 255, the device shows 16 levels of each, a level
+# every 16 values as ``parse.parse_color`` does, dithered or not.
+LEVELS = 16
+LEVEL_STEP = 16
+
+
+def _is_color(value):
+    return not isinstance(value[0], (list, tuple))
+
+
+def _tuples(values, depth):
+    if depth == 1:
+        return [tuple(value) for value in values]
+    return [_tuples(value, depth - 1) for value in values]
+
+
+def _from_array(array):
+    """
+    Returns a NumPy array as the lists of tuples functions return without
+    NumPy, so callers get the same type either way.
+    """
+    if array.ndim == 1:
+        return tuple(array.tolist())
+    return _tuples(array.tolist(), array.ndim - 1)
+
+
+def _lerp(a, b, ratio):
+    return tuple(x + (y - x) * ratio for x, y in zip(a, b))
+
+
+def _lerp_hsv(a, b, ratio):
+    h1, s1, v1 = colorsys.rgb_to_hsv(*[x / 255.0 for x in a])
+    h2, s2, v2 = colorsys.rgb_to_hsv(*[x / 255.0 for x in b])
+    # Around the hue circle the short way.
+    if h2 - h1 > 0.5:
+        h1 += 1
+    elif h1 - h2 > 0.5:
+        h2 += 1
+    hsv = _lerp((h1, s1, v1), (h2, s2, v2), ratio)
+    return tuple(x * 255 for x in
+                 colorsys.hsv_to_rgb(hsv[0] % 1, hsv[1], hsv[2]))
+
+
+def _py_interpolate(start, end, ratios, space):
+    lerp = _lerp_hsv if space == 'hsv' else _lerp
+    if _is_color(start):
+        return [lerp(start, end, ratio) for ratio in ratios]
+    return [[lerp(a, b, ratio) for a, b in zip(start, end)]
+            for ratio in ratios]
+
+
+def _np_rgb_to_hsv(rgb):
+    rgb = rgb / 255.0
+    r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    v = rgb.max(axis=-1)
+    delta = v - rgb.min(axis=-1)
+    safe = numpy.where(delta == 0, 1, delta)
+    s = numpy.where(v == 0, 0, delta / numpy.where(v == 0, 1, v))
+    h = numpy.where(v == r, (g - b) / safe,
+                    numpy.where(v == g, 2 + (b - r) / safe,
+                                4 + (r - g) / safe))
+    h = numpy.where(delta == 0, 0, (h / 6) % 1)
+    return h, s, v
+
+
+def _np_hsv_to_rgb(h, s, v):
+    i = numpy.floor(h * 6)
+    f = h * 6 - i
+    p = v * (1 - s)
+    q = v * (1 - s * f)
+    t = v * (1 - s * (1 - f))
+    i = i.astype(int) % 6
+    r = numpy.choose(i, [v, q, p, p, t, v])
+    g = numpy.choose(i, [t, v, v, q, p, p])
+    b = numpy.choose(i, [p, p, t, v, v, q])
+    return numpy.stack([r, g, b], axis=-1) * 255
+
+
+def _np_interpolate(start, end, ratios, space):
+    start = numpy.asarray(start, dtype=float)
+    end = numpy.asarray(end, dtype=float)
+    ratios = numpy.asarray(ratios, dtype=float).reshape(
+        (-1,) + (1,) * start.ndim)
+    if space != 'hsv':
+        return start + (end - start) * ratios
+    h1, s1, v1 = _np_rgb_to_hsv(start)
+    h2, s2, v2 = _np_rgb_to_hsv(end)
+    h1 = numpy.where(h2 - h1 > 0.5, h1 + 1, h1)
+    h2 = numpy.where(h1 - h2 > 0.5, h2 + 1, h2)
+    ratios = ratios[..., 0]
+    return _np_hsv_to_rgb((h1 + (h2 - h1) * ratios) % 1,
+                          s1 + (s2 - s1) * ratios, v1 + (v2 - v1) * ratios)
+
+
+def interpolate(start, end, ratios, space='rgb'):
+    """
+    Interpolates between colors, a frame per ratio.
+
+    Arguments:
+      + start: a (r, g, b) color, channels from 0 to 255, or a list of them
+         (one per zone).
+      + end: same as start, the colors at ratio 1.
+      + ratios: a list of ratios from 0 to 1.
+      + space: 'rgb' for linear interpolation of the channels or 'hsv' to go
+         around the hue circle instead, keeping colors saturated.
+
+    Returns the interpolated colors, (r, g, b) tuples of floats, in a list
+    with a color (or a list of colors) per ratio.
+    """
+    if space not in ('rgb', 'hsv'):
+        raise ValueError('Unknown color space %r' % (space,))
+    if numpy is None:
+        return _py_interpolate(start, end, ratios, space)
+    return _from_array(_np_interpolate(start, end, ratios, space))
+
+
+def _py_quantize(colors, dither, frame):
+    if _is_color(colors[0]):
+        if not dither:
+            return [tuple(min(max(int(x) // LEVEL_STEP, 0), LEVELS - 1)
+                          for x in color)
+                    for color in colors]
+        row = BAYER_MATRIX[frame % 4]
+        return [tuple(min(max(int(math.floor(float(x) / LEVEL_STEP +
+                                              row[i % 4] / 16.0)), 0),
+                          LEVELS - 1)
+                      for x in color)
+                for i, color in enumerate(colors)]
+    return [_py_quantize(frame_colors, dither, frame + i)
+            for i, frame_colors in enumerate(colors)]
+
+
+def _np_quantize(colors, dither, frame):
+    colors = numpy.asarray(colors)
+    if not dither:
+        levels = numpy.floor_divide(colors, LEVEL_STEP)
+    else:
+        # Thresholds by frame (third to last axis) and zone.
+        zones = colors.shape[-2]
+        frames = colors.shape[-3] if colors.ndim > 2 else 1
+        matrix = numpy.array(BAYER_MATRIX, dtype=float) / 16
+        rows = matrix[(frame + numpy.arange(frames)) % 4]
+        thresholds = rows[:, numpy.arange(zones) % 4]
+        if colors.ndim == 2:
+            thresholds = thresholds[0]
+        levels = numpy.floor(colors / float(LEVEL_STEP) +
+                             thresholds[..., None])
+    return numpy.clip(levels, 0, LEVELS - 1).astype(numpy.uint8)
+
+
+def quantize(colors, dither=False, frame=0):
+    """
+    Returns the device levels (0 to 15) of every channel of colors.
+
+    Without dither, channels are divided by 16 like ``parse.parse_color``
+    does. With dither, ordered dithering spreads the rounding error across
+    neighbouring zones and frames, so fades look smoother than 16 levels
+    allow: a flat color averages to channel / 16 over 4 zones and 4 frames,
+    and a channel multiple of 16 gets the same level as without dither.
+
+    Arguments:
+      + colors: a list of (r, g, b) colors (one per zone), channels from 0 to
+         255 as ints or floats, or a list of those (one per frame). NumPy
+         arrays are accepted too.
+      + dither: whether to use ordered dithering.
+      + frame: number of the first frame, for dithering.
+
+    Returns the levels in the same shape as colors, as tuples of ints.
+    """
+    if numpy is None:
+        return _py_quantize(colors, dither, frame)
+    return _from_array(_np_quantize(colors, dither, frame))
+
+
+def _py_pack_levels(levels, first):
+    if not _is_color(levels[0]):
+        return [_py_pack_levels(frame_levels, first)
+                for frame_levels in levels]
+    if first:
+        return [(r * 16 + g, b * 16) for r, g, b in levels]
+    return [(r, g * 16 + b) for r, g, b in levels]
+
+
+def _np_pack_levels(levels, first):
+    levels = numpy.asarray(levels, dtype=numpy.uint8)
+    r, g, b = levels[..., 0], levels[..., 1], levels[..., 2]
+    if first:
+        return numpy.stack([(r << 4) | g, b << 4], axis=-1)
+    return numpy.stack([r, (g << 4) | b], axis=-1)
+
+
+def pack_levels(levels, first=True):
+    """
+    Packs channel levels, as returned by quantize, into the colors accepted
+    by the USB protocol, the same ones ``parse.parse_color`` returns.
+
+    Returns (byte, byte) tuples in the same shape as levels.
+    """
+    if numpy is None:
+        return _py_pack_levels(levels, first)
+    return _from_array(_np_pack_levels(levels, first))
+
+
+def pack_colors(colors, first=True, dither=False, frame=0):
+    """
+    Packs colors into the form accepted by the USB protocol in one go, see
+    quantize and pack_levels.
+    """
+    if numpy is None:
+        return _py_pack_levels(_py_quantize(colors, dither, frame), first)
+    return _from_array(
+        _np_pack_levels(_np_quantize(colors, dither, frame), first))
+
+
+def _py_join_morphs(first, second):
+    if _is_color(first[0]):
+        return [(x[0], x[1] + y[0], y[1]) for x, y in zip(first, second)]
+    return [_py_join_morphs(x, y) for x, y in zip(first, second)]
+
+
+def pack_morphs(start, end, dither=False, frame=0):
+    """
+    Packs the colors of morphs into the three bytes they take in a
+    set_morph packet.
+
+    Returns (byte, byte, byte) tuples in the same shape as start.
+    """
+    if numpy is None:
+        return _py_join_morphs(
+            _py_pack_levels(_py_quantize(start, dither, frame), True),
+            _py_pack_levels(_py_quantize(end, dither, frame), False))
+    first = _np_pack_levels(_np_quantize(start, dither, frame), True)
+    second = _np_pack_levels(_np_quantize(end, dither, frame), False)
+    return _from_array(numpy.stack([first[..., 0],
+                                    first[..., 1] | second[..., 0],
+                                    second[..., 1]], axis=-1))
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import logging
+import os
 
 # USB protocol related constants
 SEND_REQUEST_TYPE = 0x21
@@ -21,6 +22,8 @@ DATA_LENGTH = 9
 START_BYTE = 0x02
 FILL_BYTE = 0x00
 STATUS_OK = 0x10
+# Max zone masks kept precomputed as packet bytes
+ZONE_BYTES_CACHE_SIZE = 1024
 
 # How many color modes might be set for a given zone
 ZONE_MAX_CONFIGURATIONS = 0xf
@@ -28,13 +31,23 @@ ZONE_MAX_CONFIGURATIONS = 0xf
 # work reliably with the Alienware 14 2013, so this zone is just an alias for
 # indicating commands to be run on all non-group and non-power zones.
 ALL_ZONES_UID = 0xffffff
+# For the same reason, zones sharing the same loop are only combined into a
+# single zone mask up to this many zones (machines can override it).
+DEFAULT_MAX_MASK_WIDTH = 4
 
 # Max allowed speed for theme tempo
 MAX_SPEED = 0xffff
-# Wait in seconds before sending a command
-WAIT_FOR_OK_SLEEP = 0.01
-# Number of tries waiting for OK (~5 seconds)
-WAIT_FOR_OK_MAX_TRIES = 500
+# Seconds to sleep after the first (immediate) status poll not being OK,
+# doubled (WAIT_FOR_OK_BACKOFF) after each further miss up to the max.
+WAIT_FOR_OK_FIRST_SLEEP = 0.0005
+WAIT_FOR_OK_MAX_SLEEP = 0.05
+WAIT_FOR_OK_BACKOFF = 2
+# Seconds waiting for OK before giving up
+WAIT_FOR_OK_DEADLINE = 5
+# Busy replies received before trying a reset to wake the device up
+WAIT_FOR_OK_RESET_AFTER_BUSY = 20
+# Packets written in pipelined mode before checking device status
+PIPELINE_SYNC_EVERY = 16
 
 # Zone commands
 CMD_END_STORAGE = 0x00
@@ -78,10 +91,74 @@ RESET_ALL_LIGHTS_ON = 0x04
 # Hello, Dell
 VENDOR_ID = 0x187c
 
+# Environment variables enabling the device emulator (see emulator module)
+EMULATE_ENV = 'PALIENWAREY_EMULATE'
+EMULATE_TIMING_ENV = 'PALIENWAREY_EMULATE_TIMING'
+
+# On-disk caches
+CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+    'palienwarey')
+# Machine descriptions served by lsdaemon, per daemon address and machine
+DESCRIPTION_CACHE_DIR = os.path.join(CACHE_DIR, 'descriptions')
+# Themes compiled into packets, per theme and machine definition (see themes)
+THEME_CACHE_DIR = os.path.join(CACHE_DIR, 'themes')
+THEME_MAGIC = 'LSTH'
+
 # Daemon protocol related
 DEFAULT_HOST = ''
 DEFAULT_PORT = 6587  # AW
+# Unix socket local clients prefer when the daemon listens on it
+DEFAULT_UNIX_SOCKET = '/var/run/lsdaemon.sock'
+DEFAULT_UNIX_SOCKET_MODE = 0o666
+# Memory mapped frame buffer for high rate local clients (see framebuffer)
+DEFAULT_FRAMEBUFFER = '/dev/shm/lsdaemon.fb'
+DEFAULT_FRAMEBUFFER_MODE = 0o666
+FRAMEBUFFER_MAGIC = 'LSFB'
+FRAMEBUFFER_SLOTS = 64
+# Seconds between frame buffer sequence checks, and once idle for a while
+FRAMEBUFFER_POLL_INTERVAL = 0.001
+FRAMEBUFFER_IDLE_POLL_INTERVAL = 0.05
+FRAMEBUFFER_IDLE_AFTER = 1
 HEADER_LENGTH = 6
+# Biggest payload accepted in a frame (the header allows up to 0xffffff)
+DEFAULT_MAX_FRAME_SIZE = 0x100000
+# Payloads starting with these bytes use the binary encoding (see binary)
+BINARY_MAGIC = '\xaf\x01'
+# Seconds the daemon keeps the device claimed without requests (0 is forever)
+DEFAULT_IDLE_TIMEOUT = 30
+# Requests waiting for the device before the daemon rejects new ones
+DEFAULT_QUEUE_DEPTH = 16
+# Seconds a request may wait for the device before expiring (0 is forever)
+DEFAULT_REQUEST_DEADLINE = 10
+# Seconds between checks for requests past their deadline
+WORKER_REAP_INTERVAL = 0.05
+# Connections served at once, and accepted ones waiting for a free thread
+# before the daemon turns new ones away
+DEFAULT_MAX_CONNECTIONS = 16
+DEFAULT_CONNECTION_QUEUE = 16
+# Seconds the daemon waits for data from a client (0 is forever)
+DEFAULT_READ_TIMEOUT = 10
+# Seconds a kept alive connection may sit idle between requests, holding a
+# connection thread, before the daemon closes it (0 is read timeout)
+DEFAULT_KEEPALIVE_TIMEOUT = 2
+# Connections the OS queues for lsdaemon before accepting them
+DEFAULT_ACCEPT_BACKLOG = 16
+# Compiled programs lsdaemon keeps around, and seconds each one is kept (0 is
+# forever), see session.ProgramCache
+DEFAULT_PROGRAM_CACHE_SIZE = 64
+DEFAULT_PROGRAM_CACHE_TTL = 3600
+# Frames per second host side animations are played at (see animation)
+DEFAULT_ANIMATION_FPS = 30
+MAX_ANIMATION_FPS = 120
+# Largest per channel difference (0 to 255) between an animation and the
+# device loops fitted to it (see fitter) for the loops to be used instead.
+DEFAULT_FIT_ERROR = 24
+# Points of every loop step checked against the animation when fitting
+FIT_SAMPLES_PER_STEP = 16
+# Seconds a loop step lasts per unit of theme speed. The tempo is not
+# documented, this is an estimate and can be calibrated per call.
+LOOP_SECONDS_PER_SPEED = 0.0001
 
 # Possible addresses for leds
 LEDS_TO_SCAN = (0x1, 0x2, 0x4, 0x8, 0x10, 0x20, 0x40, 0x80, 0x100, 0x200,
@@ -96,10 +173,18 @@ ERROR_DEVICE_TIMEOUT = 13
 ERROR_NO_DAEMON = 14
 ERROR_UNKNOWN_COMMAND = 15
 ERROR_BAD_COLOR = 16
+ERROR_BAD_ANIMATION = 17
+ERROR_BAD_THEME = 18
+ERROR_BUSY = 30
 ERROR_BAD_HEADER = 31
 ERROR_BAD_METHOD = 32
 ERROR_BAD_ARGUMENTS = 33
 ERROR_BAD_REQUEST_JSON = 34
+ERROR_QUEUE_FULL = 35
+ERROR_REQUEST_EXPIRED = 36
+ERROR_FRAME_TOO_LARGE = 37
+ERROR_BAD_REQUEST_BINARY = 38
+ERROR_COALESCED = 39
 ERROR_CANNOT_CONNECT = 41
 ERROR_BAD_HEADER = 42
 ERROR_BAD_RESPONSE_JSON = 43
@@ -114,10 +199,18 @@ MESSAGES_MAP = {
     ERROR_NO_DAEMON: 'No daemon running',
     ERROR_UNKNOWN_COMMAND: 'Unknown command',
     ERROR_BAD_COLOR: 'Invalid color',
+    ERROR_BAD_ANIMATION: 'Invalid animation',
+    ERROR_BAD_THEME: 'Invalid theme',
+    ERROR_BUSY: 'Daemon busy, too many connections',
     ERROR_BAD_HEADER: 'Invalid header provided within the request',
     ERROR_BAD_REQUEST_JSON: 'Invalid JSON data provided within the request',
     ERROR_BAD_METHOD: 'Invalid JSON method provided within the request',
     ERROR_BAD_ARGUMENTS: 'Wrong arguments for the current method',
+    ERROR_QUEUE_FULL: 'Daemon overloaded, too many queued requests',
+    ERROR_REQUEST_EXPIRED: 'Request expired waiting for the device',
+    ERROR_FRAME_TOO_LARGE: 'Request over the maximum frame size',
+    ERROR_BAD_REQUEST_BINARY: 'Invalid binary data within the request',
+    ERROR_COALESCED: 'Superseded by a newer request for the same zones',
     ERROR_CANNOT_CONNECT: 'Cannot connect to daemon.',
     ERROR_BAD_HEADER: 'Invalid header replied from daemon',
     ERROR_BAD_RESPONSE_JSON: 'Invalid JSON data replied by daemon',
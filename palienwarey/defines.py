@@ -1,20 +1,72 @@
 # -*- coding: utf-8 -*-
 import collections
+import hashlib
+import json
 
-import usb.core
-
-from .constants import VENDOR_ID, MODE_VERSION_1, MODE_VERSION_2
+from . import emulator
+from .constants import (VENDOR_ID, MODE_VERSION_1, MODE_VERSION_2,
+                        DEFAULT_MAX_MASK_WIDTH)
 
 __all__ = ['MODE_VERSION_1', 'MODE_VERSION_2', 'registry', 'defmachine',
-           'defmode', 'defzone', 'register_machine', 'defregister_machine']
+           'defmode', 'defzone', 'register_machine', 'defregister_machine',
+           'describe_machine', 'definition_hash', 'description_hash',
+           'machine_from_description']
+
+
+class _Registry(dict):
+    """
+    Dict of machines by uid which imports the machines module, registering
+    all supported machines, on first lookup. Building every machine
+    definition is only paid for by tools that need one.
+    """
+
+    loaded = False
+
+    def load(self):
+        if not self.loaded:
+            self.loaded = True
+            from . import machines  # noqa
+
+    def __getitem__(self, uid):
+        self.load()
+        return dict.__getitem__(self, uid)
+
+    def __contains__(self, uid):
+        self.load()
+        return dict.__contains__(self, uid)
+
+    def __iter__(self):
+        self.load()
+        return dict.__iter__(self)
+
+    def __len__(self):
+        self.load()
+        return dict.__len__(self)
+
+    def get(self, uid, default=None):
+        self.load()
+        return dict.get(self, uid, default)
+
+    def keys(self):
+        self.load()
+        return dict.keys(self)
+
+    def values(self):
+        self.load()
+        return dict.values(self)
+
+    def items(self):
+        self.load()
+        return dict.items(self)
 
 
 # The registry of supported machines, add your machine generated by
 # defmachine here and let the protocol do its magic.
-registry = {}
+registry = _Registry()
 
 
-def defmachine(uid, name, zones, mode_version):
+def defmachine(uid, name, zones, mode_version,
+               max_mask_width=DEFAULT_MAX_MASK_WIDTH):
     """
     Defines a machine.
 
@@ -27,6 +79,8 @@ def defmachine(uid, name, zones, mode_version):
       + zones: an iterable of zones defined with defzone.
       + mode_version: One of the MODE_VERSION_* constants that define the
          available modes for device lights.
+      + max_mask_width: max number of zones that can be safely combined in a
+         single zone mask (see ``parse.coalesce_zones``).
 
     Returns a dict with all passed arguments plus the following keys:
       + zones_by_uid: containing a dict mapping uids with zones.
@@ -66,6 +120,7 @@ def defmachine(uid, name, zones, mode_version):
         'zones': zones,
         'zones_by_uid': zones_by_uid,
         'modes': modes,
+        'max_mask_width': max_mask_width,
         # This is used to save the device found for the machine when using
         # get_machine to detect current system.
         'device': None
@@ -133,32 +188,120 @@ def register_machine(machine):
         registry[uid] = machine
 
 
-def defregister_machine(name, uid, zones, mode_version):
+def defregister_machine(name, uid, zones, mode_version,
+                        max_mask_width=DEFAULT_MAX_MASK_WIDTH):
     """
     Alias for register_machine(defmachine(*args)).
 
     Returns the registered machine.
     """
-    machine = defmachine(name, uid, zones, mode_version)
+    machine = defmachine(name, uid, zones, mode_version, max_mask_width)
     register_machine(machine)
     return machine
 
 
+def describe_machine(machine):
+    """
+    Returns a JSON serializable description of machine, that is everything
+    but the usb device and the zones_by_uid lookup.
+    """
+    return {
+        'uid': machine['uid'],
+        'name': machine['name'],
+        'zones': [dict(zone) for zone in machine['zones']],
+        'modes': [dict(mode) for mode in machine['modes']],
+        'max_mask_width': machine['max_mask_width']
+    }
+
+
+def definition_hash(machine):
+    """
+    Returns a hex digest of the machine definition, which changes whenever
+    its zones, modes or anything else in its description does. Handy to key
+    caches of anything compiled for a machine.
+    """
+    return description_hash(describe_machine(machine))
+
+
+def description_hash(description):
+    """
+    Same as definition_hash for a description, as returned by
+    describe_machine.
+    """
+    description = json.dumps(description, sort_keys=True)
+    return hashlib.sha1(description.encode('utf-8')).hexdigest()
+
+
+def _zone_from_description(zone):
+    uid = zone['uid']
+    return {
+        'uid': tuple(uid) if zone['is_group'] else int(uid),
+        'name': zone['name'],
+        'alias': zone['alias'],
+        'can_morph': bool(zone['can_morph']),
+        'can_pulse': bool(zone['can_pulse']),
+        'is_group': bool(zone['is_group']),
+        'is_power': bool(zone['is_power'])
+    }
+
+
+def machine_from_description(description):
+    """
+    Inverse of describe_machine, the machine returned has no device so it
+    is only good for parsing commands (as lsd does when using the daemon).
+
+    Raises:
+      + KeyError, TypeError, ValueError: if description is not valid.
+    """
+    zones = tuple(_zone_from_description(zone)
+                  for zone in description['zones'])
+    zones_by_uid = {}
+    for zone in zones:
+        zones_by_uid[zone['uid']] = zone
+    return {
+        'uid': int(description['uid']),
+        'name': description['name'],
+        'zones': zones,
+        'zones_by_uid': zones_by_uid,
+        'modes': [_zone_from_description(mode)
+                  for mode in description['modes']],
+        'max_mask_width': int(description['max_mask_width']),
+        'device': None
+    }
+
+
 def get_machine():
     """
     Finds a registered usb machine and appends a valid usb device to it.
 
+    All devices from VENDOR_ID are enumerated in a single pass and looked up
+    in the registry by product id. When the emulator is enabled its device
+    is used instead.
+
     Raises:
       + EnvironmentError: if cannot find a connected machine.
 
     Returns a machine instance.
     """
-    tried = []
-    for machine in registry.values():
-        uid = machine['uid']
-        tried.append(uid)
-        device = usb.core.find(idVendor=VENDOR_ID, idProduct=uid)
-        if device:
+    device = emulator.get_device()
+    if device is not None:
+        machine = registry.get(device.idProduct)
+        if machine is None:
+            raise EnvironmentError(
+                'No machine found, emulating unsupported product id: %s' %
+                device.idProduct)
+        machine['device'] = device
+        return machine
+
+    # Only tools actually looking for devices pay for importing usb.
+    import usb.core
+    found = []
+    for device in usb.core.find(find_all=True, idVendor=VENDOR_ID):
+        found.append(device.idProduct)
+        machine = registry.get(device.idProduct)
+        if machine is not None:
             machine['device'] = device
             return machine
-    raise EnvironmentError('No machine found, tried: %s' % tried)
+    raise EnvironmentError(
+        'No machine found, got product ids: %s, supported: %s' %
+        (found, list(registry)))
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+import argparse
+import array
+import os
+import threading
+import time
+
+from .constants import (
+    VENDOR_ID, SEND_REQUEST_TYPE, READ_REQUEST_TYPE, DATA_LENGTH, START_BYTE,
+    FILL_BYTE, STATE_BUSY, STATE_READY, STATE_UNKNOWN_COMMAND,
+    CMD_END_STORAGE, CMD_SET_MORPH, CMD_SET_PULSE, CMD_SET_COLOR,
+    CMD_END_LOOP, CMD_TRANSMIT_EXECUTE, CMD_GET_STATUS, CMD_RESET,
+    CMD_SET_MODE, CMD_SAVE, CMD_SET_SPEED, EMULATE_ENV, EMULATE_TIMING_ENV)
+from .logconf import logger
+
+
+__all__ = ['DEFAULT_PRODUCT_ID', 'TimingModel', 'EmulatedDevice', 'enable',
+           'disable', 'enabled', 'get_device', 'find', 'argument_parser']
+
+
+# Alienware 14 2013, the one machine this has been tested against.
+DEFAULT_PRODUCT_ID = 0x0525
+
+COLOR_CMDS = (CMD_SET_MORPH, CMD_SET_PULSE, CMD_SET_COLOR)
+
+
+def _usb_error(message):
+    # Imported here so commandline tools can offer --emulate without
+    # importing usb.
+    from usb.core import USBError
+    return USBError(message)
+
+
+class TimingModel(object):
+    """
+    How long the emulated device takes to do things.
+
+    Arguments:
+      + latency: seconds every control transfer takes.
+      + busy: seconds the device replies STATE_BUSY after a reset or a
+         transmit_execute.
+      + save_busy: seconds the device replies STATE_BUSY after a save.
+      + timeouts: probability (0 to 1) of any transfer timing out.
+      + seed: seed for the timeouts random generator.
+    """
+
+    def __init__(self, latency=0.0, busy=0.0, save_busy=0.0, timeouts=0.0,
+                 seed=None):
+        self.latency = latency
+        self.busy = busy
+        self.save_busy = save_busy
+        self.timeouts = timeouts
+        # Imported here, just like usb, to keep --emulate cheap.
+        import random
+        self.random = random.Random(seed)
+
+    @classmethod
+    def from_string(cls, spec):
+        """
+        Creates a TimingModel from a "key=value,..." string.
+
+        >>> TimingModel.from_string('latency=0.001,busy=0.005').busy
+        ... 0.005
+        """
+        kwargs = {}
+        for item in spec.split(','):
+            if not item.strip():
+                continue
+            key, value = item.split('=', 1)
+            key = key.strip()
+            kwargs[key] = int(value) if key == 'seed' else float(value)
+        return cls(**kwargs)
+
+
+class _Context(object):
+    """
+    What usb.util.claim_interface and usb.util.dispose_resources call into.
+    """
+
+    def managed_claim_interface(self, device, interface):
+        device.claimed = True
+
+    def dispose(self, device, close_handle=True):
+        device.claimed = False
+
+
+class EmulatedDevice(object):
+    """
+    Software AlienFX device.
+
+    It implements the surface of usb.core.Device used by the protocol
+    module, decoding every written packet per the CMD_* constants. The
+    device keeps the loops of every zone mask for each mode (None being the
+    current session), the loops of the session being shown once
+    transmit_execute is received.
+
+    Every transfer is counted in the transfers dict (keyed by 'write' and
+    'read') and written packets are recorded in packets, which makes it
+    handy for benchmarks and checks.
+    """
+
+    def __init__(self, product_id=DEFAULT_PRODUCT_ID, timing=None):
+        self.idVendor = VENDOR_ID
+        self.idProduct = product_id
+        self.bus = 1
+        self.address = 1
+        self.timing = timing if timing is not None else TimingModel()
+        self.claimed = False
+        self.kernel_driver = True
+        self.lock = threading.Lock()
+        self._ctx = _Context()
+        self.clear()
+
+    def clear(self):
+        """
+        Forgets all state, counters and recorded packets.
+        """
+        self.transfers = {'write': 0, 'read': 0}
+        self.packets = []
+        self.mode = None
+        self.speed = None
+        self.loops = {}
+        self.shown = {}
+        self.saved = {}
+        self.pending = []
+        self.busy_until = 0
+        self.unknown_command = False
+
+    def detach_kernel_driver(self, interface):
+        if not self.kernel_driver:
+            raise _usb_error('Kernel driver not attached')
+        self.kernel_driver = False
+
+    def attach_kernel_driver(self, interface):
+        self.kernel_driver = True
+
+    def is_kernel_driver_active(self, interface):
+        return self.kernel_driver
+
+    def set_configuration(self, configuration=None):
+        pass
+
+    def ctrl_transfer(self, bmRequestType, bRequest, wValue=0, wIndex=0,
+                      data_or_wLength=None, timeout=None):
+        with self.lock:
+            if self.timing.latency:
+                time.sleep(self.timing.latency)
+            if self.timing.timeouts and \
+               self.timing.random.random() < self.timing.timeouts:
+                raise _usb_error('Operation timed out (emulated)')
+            if bmRequestType == SEND_REQUEST_TYPE:
+                self.transfers['write'] += 1
+                packet = list(data_or_wLength)
+                self.packets.append(packet)
+                self._decode(packet)
+                return len(packet)
+            elif bmRequestType == READ_REQUEST_TYPE:
+                self.transfers['read'] += 1
+                return array.array(
+                    'B', [self.status()] + [FILL_BYTE] * (DATA_LENGTH - 1))
+            raise _usb_error('Unsupported request type 0x%x' % bmRequestType)
+
+    def status(self):
+        if self.unknown_command:
+            return STATE_UNKNOWN_COMMAND
+        if time.time() < self.busy_until:
+            return STATE_BUSY
+        return STATE_READY
+
+    def _busy(self, seconds):
+        if seconds:
+            self.busy_until = time.time() + seconds
+
+    def _decode(self, packet):
+        if len(packet) != DATA_LENGTH or packet[0] != START_BYTE:
+            self.unknown_command = True
+            return
+        cmd = packet[1]
+        self.unknown_command = False
+        if cmd == CMD_GET_STATUS:
+            pass
+        elif cmd in COLOR_CMDS:
+            mask = (packet[3] << 16) + (packet[4] << 8) + packet[5]
+            self.pending.append((mask, (cmd, packet[2]) + tuple(packet[6:])))
+        elif cmd == CMD_END_LOOP:
+            # A new loop for a zone mask replaces the previous one.
+            loops = {}
+            for mask, command in self.pending:
+                loops.setdefault(mask, []).append(command)
+            self.loops.setdefault(self.mode, {}).update(loops)
+            self.pending = []
+        elif cmd == CMD_SET_MODE:
+            self.mode = packet[2]
+        elif cmd == CMD_SET_SPEED:
+            self.speed = (packet[3] << 8) + packet[4]
+        elif cmd == CMD_RESET:
+            self.loops = {}
+            self.pending = []
+            self.mode = None
+            self._busy(self.timing.busy)
+        elif cmd == CMD_TRANSMIT_EXECUTE:
+            self.shown = dict(self.loops.get(self.mode, {}))
+            self._busy(self.timing.busy)
+        elif cmd == CMD_SAVE:
+            self.saved = dict((mode, dict(loops))
+                              for mode, loops in self.loops.items())
+            self._busy(self.timing.save_busy)
+        elif cmd == CMD_END_STORAGE:
+            pass
+        else:
+            logger.debug('Emulator: unknown command 0x%x', cmd)
+            self.unknown_command = True
+
+
+_device = None
+
+
+def enable(product_id=DEFAULT_PRODUCT_ID, timing=None):
+    """
+    Makes get_machine (and friends) use an EmulatedDevice.
+
+    Returns the emulated device.
+    """
+    global _device
+    _device = EmulatedDevice(product_id, timing)
+    logger.info('Emulating device 0x%.4x', product_id)
+    return _device
+
+
+def disable():
+    global _device
+    _device = None
+
+
+def get_device():
+    """
+    Returns the EmulatedDevice in use, None when not emulating.
+
+    When not enabled explicitly, the EMULATE_ENV environment variable can
+    enable it, with the product id in hex as value. Timing can be set with
+    EMULATE_TIMING_ENV, see ``TimingModel.from_string``.
+    """
+    if _device is None and os.environ.get(EMULATE_ENV):
+        timing_spec = os.environ.get(EMULATE_TIMING_ENV)
+        timing = TimingModel.from_string(timing_spec) if timing_spec else None
+        enable(int(os.environ[EMULATE_ENV], 16), timing)
+    return _device
+
+
+def enabled():
+    return get_device() is not None
+
+
+def find(product_id):
+    """
+    Returns the EmulatedDevice if it emulates product_id, None otherwise.
+    """
+    device = get_device()
+    if device is not None and device.idProduct == product_id:
+        return device
+    return None
+
+
+def argument_parser():
+    """
+    Returns a parser with the --emulate switch, meant to be used as parent
+    by the commandline tools parsers.
+    """
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('-E', '--emulate', nargs='?',
+                        type=lambda product_id: int(product_id, 16),
+                        const=DEFAULT_PRODUCT_ID, metavar='PRODUCT_ID',
+                        help=('Use an emulated device (defaults to 0x%.4x) '
+                              'instead of real hardware.' %
+                              DEFAULT_PRODUCT_ID))
+    return parser
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+from .colors import pack_levels, quantize
+from .constants import (
+    CMD_SET_COLOR, CMD_SET_MORPH, CMD_SET_PULSE, DEFAULT_FIT_ERROR,
+    FIT_SAMPLES_PER_STEP, LOOP_SECONDS_PER_SPEED, MAX_SPEED,
+    ZONE_MAX_CONFIGURATIONS)
+from .logconf import logger
+
+
+__all__ = ['fit_timeline', 'fit_loops']
+
+
+def _shown(levels):
+    """
+    Returns the (r, g, b) color the device shows for channel levels, as
+    returned by ``colors.quantize``.
+    """
+    return tuple(level * 17 for level in levels)
+
+
+def _color_model(color, ratio):
+    return color
+
+
+def _morph_model(colors, ratio):
+    start, end = colors
+    return tuple(a + (b - a) * ratio for a, b in zip(start, end))
+
+
+def _pulse_model(color, ratio):
+    # Fades out to black and back in.
+    return tuple(channel * abs(1 - 2 * ratio) for channel in color)
+
+
+def _error(model, args, points):
+    last = len(points) - 1
+    return max(abs(a - b)
+               for i, point in enumerate(points)
+               for a, b in zip(model(args, float(i) / last), point))
+
+
+def _mean(points):
+    count = len(points)
+    return tuple(sum(channels) / count for channels in zip(*points))
+
+
+def _step_cmds(points, levels, packed, can_morph, can_pulse):
+    """
+    Returns (error, cmd) tuples for the commands able to play a loop step
+    going through the colors in points.
+
+    levels holds the channel levels of the mean, the first and the last of
+    the points, and packed their device colors (the last one as the second
+    color of a morph).
+    """
+    mean, start, end = levels
+    fits = [(_error(_color_model, _shown(mean), points),
+             (CMD_SET_COLOR, packed[0]))]
+    if can_morph:
+        fits.append((_error(_morph_model, (_shown(start), _shown(end)),
+                            points),
+                     (CMD_SET_MORPH, packed[1], packed[2])))
+    if can_pulse:
+        fits.append((_error(_pulse_model, _shown(start), points),
+                     (CMD_SET_PULSE, packed[1])))
+    return fits
+
+
+def fit_timeline(timeline, steps, period, can_morph=True, can_pulse=True,
+                 samples=FIT_SAMPLES_PER_STEP):
+    """
+    Approximates a timeline over period seconds with a device loop.
+
+    The period is split in steps of the same length, each played with the
+    command closest to the timeline: a color, a morph between the colors at
+    both ends of the step or a pulse. Every step is checked at samples
+    points.
+
+    Arguments:
+      + timeline: an ``animation.Timeline``.
+      + steps: how many commands the loop has.
+      + period: seconds the loop lasts.
+      + can_morph: whether the zone can morph.
+      + can_pulse: whether the zone can pulse.
+      + samples: points checked per step.
+
+    Returns a (cmds, error) tuple, cmds being the commands of the loop and
+    error the largest difference in any channel (0 to 255) between the
+    loop and the timeline.
+    """
+    step = float(period) / steps
+    steps_points = [[timeline.color_at(i * step + step * j / samples)
+                     for j in range(samples + 1)]
+                    for i in range(steps)]
+    # The colors commands can use, for all steps in one batch.
+    levels = quantize([color for points in steps_points
+                       for color in (_mean(points), points[0], points[-1])])
+    firsts = pack_levels(levels)
+    seconds = pack_levels(levels, False)
+    cmds = []
+    error = 0
+    for i, points in enumerate(steps_points):
+        mean, start, end = range(i * 3, i * 3 + 3)
+        # Commands are tried from the simplest, ties keep the first.
+        step_error, cmd = min(
+            _step_cmds(points, levels[mean:end + 1],
+                       (firsts[mean], firsts[start], seconds[end]),
+                       can_morph, can_pulse),
+            key=lambda fit: fit[0])
+        cmds.append(cmd)
+        error = max(error, step_error)
+    return cmds, error
+
+
+def _still_levels(timeline):
+    """
+    Returns the channel levels of a timeline the device shows as a single
+    color, None if it changes color.
+    """
+    levels = quantize(timeline.colors)
+    if any(color != levels[0] for color in levels):
+        return None
+    return levels[0]
+
+
+def fit_loops(animation, machine=None, max_error=DEFAULT_FIT_ERROR,
+              seconds_per_speed=LOOP_SECONDS_PER_SPEED):
+    """
+    Fits a looping animation onto device loops, so the device plays it on
+    its own instead of the host streaming every frame.
+
+    Every zone gets a loop of up to ZONE_MAX_CONFIGURATIONS commands. The
+    theme speed is shared by all zones, so all loops have the same number
+    of steps (zones not changing color just get one), the fewest meeting
+    max_error for every zone.
+
+    Arguments:
+      + animation: an ``animation.Animation``.
+      + machine: the machine the loops are for, used for zone capabilities
+         (every zone is assumed to morph and pulse when None).
+      + max_error: largest difference allowed in any channel (0 to 255)
+         between the animation and the loops.
+      + seconds_per_speed: seconds a step lasts per unit of speed.
+
+    Returns a dict with the zones and speed arguments for
+    ``protocol.send``, or None if the animation does not loop or cannot be
+    fitted within max_error.
+    """
+    if not animation.loop:
+        return None
+    zones_by_uid = machine['zones_by_uid'] if machine is not None else {}
+    timelines = sorted(animation.timelines.items())
+    still = dict((uid, _still_levels(timeline))
+                 for uid, timeline in timelines)
+
+    for steps in range(1, ZONE_MAX_CONFIGURATIONS + 1):
+        speed = int(round(animation.duration / steps / seconds_per_speed))
+        if speed > MAX_SPEED:
+            continue
+        zones = []
+        worst = 0
+        for uid, timeline in timelines:
+            zone = zones_by_uid.get(uid, {})
+            if still[uid] is not None:
+                zones.append([uid, (CMD_SET_COLOR,
+                                    pack_levels([still[uid]])[0])])
+                continue
+            cmds, error = fit_timeline(timeline, steps, animation.duration,
+                                       zone.get('can_morph', True),
+                                       zone.get('can_pulse', True))
+            if error > max_error:
+                break
+            worst = max(worst, error)
+            zones.append([uid] + cmds)
+        else:
+            logger.debug('Fitted %d step loops at speed %d (error %.1f)',
+                         steps, speed, worst)
+            return {'zones': zones, 'speed': max(speed, 1)}
+    return None
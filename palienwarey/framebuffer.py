@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+import errno
+import mmap
+import os
+import stat
+import struct
+import threading
+import time
+
+from .binary import pack_color, unpack_color
+from .constants import (
+    CMD_SET_COLOR, MAX_SPEED, SUCCESS, FRAMEBUFFER_MAGIC, FRAMEBUFFER_SLOTS,
+    FRAMEBUFFER_POLL_INTERVAL, FRAMEBUFFER_IDLE_POLL_INTERVAL,
+    FRAMEBUFFER_IDLE_AFTER, DEFAULT_FRAMEBUFFER_MODE)
+from .logconf import logger
+from .parse import parse_color
+from .stats import clock
+
+
+__all__ = ['FrameBuffer', 'FrameBufferWriter', 'FrameBufferPoller']
+
+
+# magic, version, reserved, slots, sequence, zones in the frame
+_header = struct.Struct('<4sBBHQI4x')
+_sequence = struct.Struct('<Q')
+SEQUENCE_OFFSET = 8
+# zone uid, 12 bit 0xRGB color, reserved
+_slot = struct.Struct('<IHH')
+VERSION = 1
+
+
+class FrameBuffer(object):
+    """
+    A memory mapped file holding a frame: the color of up to slots zones.
+
+    The frame is guarded by a sequence counter working as a seqlock: the
+    writer makes it odd while writing and even again when done, readers
+    retry when it is odd or changed while reading. Only one writer is
+    supported at a time.
+
+    The file is created by lsdaemon (create=True), writers just open it.
+    The daemon runs as root and the file lives in a world writable
+    directory, so it is created exclusively and never through a symlink: a
+    leftover regular file owned by the daemon user is replaced, anything
+    else at path makes it refuse to start.
+    """
+
+    def __init__(self, path, create=False, slots=FRAMEBUFFER_SLOTS,
+                 mode=DEFAULT_FRAMEBUFFER_MODE):
+        self.path = path
+        if create:
+            fd = self._create(path, slots, mode)
+        else:
+            fd = os.open(path, os.O_RDWR)
+        try:
+            self.map = mmap.mmap(fd, 0)
+        finally:
+            os.close(fd)
+        magic, version, _, self.slots, _, _ = _header.unpack_from(self.map)
+        if magic != FRAMEBUFFER_MAGIC or version != VERSION:
+            self.map.close()
+            raise ValueError('%s is not a frame buffer' % path)
+
+    @staticmethod
+    def _create(path, slots, mode):
+        """
+        Creates the frame buffer file at path, returns its open fd.
+
+        Raises:
+          + OSError: if path exists and is not a regular file owned by the
+             current user, or cannot be created.
+        """
+        try:
+            st = os.lstat(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        else:
+            if not stat.S_ISREG(st.st_mode) or st.st_uid != os.geteuid():
+                raise OSError(errno.EEXIST, 'Refusing to replace %s, not a '
+                              'regular file owned by us' % path)
+            logger.info('Removing stale frame buffer %s', path)
+            os.unlink(path)
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW |
+                     os.O_RDWR, mode)
+        try:
+            # Not left to the umask.
+            os.fchmod(fd, mode)
+            size = _header.size + slots * _slot.size
+            os.write(fd, _header.pack(FRAMEBUFFER_MAGIC, VERSION, 0, slots,
+                                      0, 0))
+            os.write(fd, b'\0' * (size - _header.size))
+        except Exception:
+            os.close(fd)
+            raise
+        return fd
+
+    def sequence(self):
+        return _sequence.unpack_from(self.map, SEQUENCE_OFFSET)[0]
+
+    def read(self, tries=100):
+        """
+        Returns a (sequence, frame) tuple, frame being a list of (uid,
+        0xRGB) tuples, or None if no consistent frame could be read.
+        """
+        for _ in range(tries):
+            sequence = self.sequence()
+            if sequence % 2:
+                # Being written.
+                time.sleep(0)
+                continue
+            count = _header.unpack_from(self.map)[5]
+            frame = [_slot.unpack_from(self.map, _header.size +
+                                       i * _slot.size)[:2]
+                     for i in range(min(count, self.slots))]
+            if self.sequence() == sequence:
+                return sequence, frame
+        return None
+
+    def write(self, frame):
+        """
+        Writes frame, a list of (uid, 0xRGB) tuples, returning its sequence.
+        """
+        if len(frame) > self.slots:
+            raise ValueError('Frame with %d zones, only %d slots' %
+                             (len(frame), self.slots))
+        sequence = self.sequence()
+        if sequence % 2:
+            # A writer died in the middle of a frame.
+            sequence += 1
+        _sequence.pack_into(self.map, SEQUENCE_OFFSET, sequence + 1)
+        for i, (uid, rgb) in enumerate(frame):
+            _slot.pack_into(self.map, _header.size + i * _slot.size,
+                            uid, rgb, 0)
+        _header.pack_into(self.map, 0, FRAMEBUFFER_MAGIC, VERSION, 0,
+                          self.slots, sequence + 1, len(frame))
+        _sequence.pack_into(self.map, SEQUENCE_OFFSET, sequence + 2)
+        return sequence + 2
+
+    def close(self):
+        self.map.close()
+
+
+class FrameBufferWriter(object):
+    """
+    Client side helper for the lsdaemon frame buffer at path.
+
+    Every write merges the given colors into the colors written so far and
+    writes all of them as the new frame, so the daemon can skip frames and
+    still end up showing the latest one.
+
+    >>> writer = FrameBufferWriter('/dev/shm/lsdaemon.fb')
+    >>> writer.write({0x1: 'ff0000', 0x2: '00ff00'})
+    """
+
+    def __init__(self, path):
+        self.framebuffer = FrameBuffer(path)
+        self.colors = {}
+
+    def write(self, colors):
+        """
+        Writes colors, a dict of zone uids to 6 digit rgb color strings.
+
+        Returns the sequence of the frame written.
+        """
+        for uid, color in colors.items():
+            self.colors[uid] = pack_color(parse_color(color))
+        return self.framebuffer.write(sorted(self.colors.items()))
+
+    def close(self):
+        self.framebuffer.close()
+
+
+class FrameBufferPoller(object):
+    """
+    Applies the frames written to a FrameBuffer through lsdaemon.
+
+    A thread polls the sequence counter every interval seconds (every
+    idle_interval seconds once no frames came for idle_after seconds) and
+    hands the latest frame to the device worker as a send with a single
+    color per zone. While the worker is busy, newer frames overwrite older
+    ones, which are never sent. The DeviceSession only sends the zones
+    changed since the previous frame.
+    """
+
+    def __init__(self, framebuffer, worker, session,
+                 interval=FRAMEBUFFER_POLL_INTERVAL,
+                 idle_interval=FRAMEBUFFER_IDLE_POLL_INTERVAL,
+                 idle_after=FRAMEBUFFER_IDLE_AFTER):
+        self.framebuffer = framebuffer
+        self.worker = worker
+        self.session = session
+        self.interval = interval
+        self.idle_interval = idle_interval
+        self.idle_after = idle_after
+        self.applied = 0
+        self.frames = 0
+        self.dropped = 0
+        self.errors = 0
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = threading.Thread(target=self.poll,
+                                       name='lsdaemon-framebuffer')
+        self.thread.daemon = True
+
+    def start(self):
+        self.running = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def poll(self):
+        last_frame = 0
+        while self.running:
+            if self.framebuffer.sequence() != self.applied and self.apply():
+                last_frame = clock()
+            elif clock() - last_frame < self.idle_after:
+                time.sleep(self.interval)
+            else:
+                time.sleep(self.idle_interval)
+
+    def apply(self):
+        """
+        Applies the latest frame, returns False if none could be read.
+        """
+        result = self.framebuffer.read()
+        if result is None:
+            return False
+        sequence, frame = result
+        if sequence == self.applied:
+            return False
+        # Frames in between were overwritten before being picked up.
+        self.dropped += max(0, (sequence - self.applied) // 2 - 1)
+        zones = [[uid, (CMD_SET_COLOR, unpack_color(rgb))]
+                 for uid, rgb in frame]
+        try:
+            code = self.worker.call(self.session.send, zones, None,
+                                    MAX_SPEED, cached=False)
+        except Exception as e:
+            logger.exception(e)
+            code = None
+        if code != SUCCESS:
+            self.errors += 1
+            logger.error('Cannot apply frame %d (code %s)', sequence, code)
+        with self.condition:
+            self.frames += 1
+            self.applied = sequence
+            self.condition.notify_all()
+        return True
+
+    def wait(self, sequence, timeout=None):
+        """
+        Waits until the frame with sequence (or a newer one) got applied.
+
+        Returns True unless it timed out.
+        """
+        deadline = clock() + timeout if timeout is not None else None
+        with self.condition:
+            while self.applied < sequence:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - clock()
+                    if remaining <= 0:
+                        return False
+                self.condition.wait(remaining)
+        return True
+
+    def stats(self):
+        return {
+            'path': self.framebuffer.path,
+            'sequence': self.applied,
+            'frames': self.frames,
+            'dropped': self.dropped,
+            'errors': self.errors
+        }
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+import json
+
+from .constants import (HEADER_LENGTH, DEFAULT_MAX_FRAME_SIZE, MESSAGES_MAP,
+                        SUCCESS)
+
+
+__all__ = ['FrameError', 'FrameTooLarge', 'FrameReader', 'encode_frame',
+           'decode_json', 'response']
+
+
+class FrameError(ValueError):
+    """
+    Raised when the stream does not contain a valid frame.
+    """
+
+
+class FrameTooLarge(FrameError):
+    """
+    Raised when the header announces a payload over the max frame size.
+    """
+
+
+def encode_frame(data):
+    """
+    Returns data prefixed by the header: its length in hex.
+    """
+    return "%.6x" % len(data) + data
+
+
+def response(code, data=None):
+    """
+    Returns the response dict for code, as replied by lsdaemon.
+    """
+    response = {'success': code == SUCCESS,
+                'code': code,
+                'message': MESSAGES_MAP[code]}
+    if data is not None:
+        response['data'] = data
+    return response
+
+
+def decode_json(frame, encoding='utf-8'):
+    """
+    Loads the JSON payload of frame (as returned by FrameReader).
+    """
+    return json.loads(frame.tobytes().decode(encoding))
+
+
+class FrameReader(object):
+    """
+    Reads frames (a header with the payload length in hex and the payload)
+    from a stream socket.
+
+    Data is received with recv_into into a reusable buffer, growing it only
+    when a frame does not fit (up to max_size), so short reads, several
+    frames per read and frames split across reads are all handled without
+    copying. Frames are returned as memoryview slices of the buffer, which
+    are only valid until the next read.
+
+    Without a socket, data can be pushed with feed and frames taken with
+    next_frame, which suits servers not doing blocking reads.
+    """
+
+    def __init__(self, sock=None, max_size=DEFAULT_MAX_FRAME_SIZE,
+                 size=4096):
+        self.sock = sock
+        self.max_size = max_size
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+        # Bytes from start needed to complete the frame being read.
+        self.needed = HEADER_LENGTH
+
+    def pending(self):
+        """
+        Returns how many received bytes have not been consumed yet.
+        """
+        return self.end - self.start
+
+    def next_frame(self):
+        """
+        Returns the payload of the next frame already received, None if it
+        is not complete yet.
+        """
+        available = self.end - self.start
+        if available < HEADER_LENGTH:
+            self.needed = HEADER_LENGTH
+            return None
+        header = self.view[self.start:self.start + HEADER_LENGTH].tobytes()
+        try:
+            length = int(header, 16)
+        except ValueError:
+            raise FrameError('Invalid header: %r' % header)
+        if length < 0:
+            raise FrameError('Invalid header: %r' % header)
+        if length > self.max_size:
+            raise FrameTooLarge(
+                'Frame of %d bytes over the %d bytes limit' %
+                (length, self.max_size))
+        self.needed = HEADER_LENGTH + length
+        if available < self.needed:
+            return None
+        frame = self.view[self.start + HEADER_LENGTH:
+                          self.start + self.needed]
+        self.start += self.needed
+        self.needed = HEADER_LENGTH
+        return frame
+
+    def _make_room(self):
+        """
+        Makes sure the buffer has room for the frame being read.
+        """
+        available = self.end - self.start
+        if self.needed > len(self.buffer):
+            # Views of previous frames keep the old buffer alive.
+            buffer = bytearray(max(self.needed, 2 * len(self.buffer)))
+            buffer[:available] = self.view[self.start:self.end]
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+        elif self.start + self.needed > len(self.buffer) or \
+                self.end == len(self.buffer):
+            self.buffer[:available] = self.view[self.start:self.end].tobytes()
+        else:
+            return
+        self.start = 0
+        self.end = available
+
+    def feed(self, data):
+        """
+        Appends data to the received bytes.
+        """
+        self.needed = max(self.needed, self.pending() + len(data))
+        self._make_room()
+        self.view[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def recv(self):
+        """
+        Receives from the socket whatever fits in the buffer.
+
+        Returns the number of bytes received, 0 meaning the peer closed the
+        connection.
+        """
+        self._make_room()
+        received = self.sock.recv_into(self.view[self.end:])
+        self.end += received
+        return received
+
+    def read_frame(self):
+        """
+        Returns the payload of the next frame, reading from the socket
+        until it is complete, None when the connection is closed between
+        frames.
+
+        Raises FrameError on invalid headers or when the connection is
+        closed in the middle of a frame.
+        """
+        while True:
+            frame = self.next_frame()
+            if frame is not None:
+                return frame
+            if not self.recv():
+                if self.pending():
+                    raise FrameError(
+                        'Connection closed with %d bytes of %d read' %
+                        (self.pending(), self.needed))
+                return None
@@ -0,0 +1,808 @@
+# -*- coding: utf-8 -*-
+import argparse
+import collections
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+
+from . import VERSION, binary, colors, emulator, lsdclient
+from .constants import (
+    ZONE_MAX_CONFIGURATIONS, MAX_SPEED, DATA_LENGTH, START_BYTE, FILL_BYTE,
+    CMD_SET_COLOR, CMD_SET_MORPH, CMD_SET_PULSE, DEFAULT_PROGRAM_CACHE_SIZE,
+    SUCCESS,
+    ERROR_DEVICE_NOT_FOUND, ERROR_DEVICE_TIMEOUT, ERROR_BAD_HEADER)
+from .defines import get_machine, registry
+from .framebuffer import FrameBuffer
+from .framing import FrameReader, decode_json, encode_frame
+from .logconf import logger, set_log_level, set_log_formatter, log_error_code
+from .lsdaemon import (
+    LSDaemonServer, LSDaemonUnixServer, protocol as lsdaemon_protocol)
+from .parse import coalesce_zones, parse, parse_color
+from .protocol import (
+    send, defpacket, pack_color, pack_morph, packet_set_color,
+    packet_set_morph)
+from .stats import clock
+from .themes import (
+    CompiledTheme, cache_path, compile_theme, load_theme, write_compiled)
+
+
+__all__ = ['SCENARIOS', 'PATHS', 'MICROBENCHMARKS', 'HEAVY_MODULES',
+           'percentile', 'summarize', 'measure', 'compare', 'check_budget',
+           'lsbench', 'main']
+
+
+def _single_zones(machine):
+    return [zone for zone in machine['zones']
+            if not zone['is_group'] and not zone['is_power']]
+
+
+def _zone_by_alias(machine, *aliases):
+    for alias in aliases:
+        for zone in machine['zones']:
+            if zone['alias'] == alias:
+                return zone
+    return None
+
+
+def scenario_single_color(machine):
+    zone = _single_zones(machine)[0]
+    return {'zones': [(zone['uid'], 'c:ff0000')]}
+
+
+def scenario_keyboard_morph(machine):
+    zone = _zone_by_alias(machine, 'kbd', 'all')
+    return {'zones': [(zone['uid'], 'm:ff0000:00ff00 p:00ff00 '
+                                    'm:00ff00:ff0000 p:ff0000')]}
+
+
+def scenario_all_modes_save(machine):
+    zone = _zone_by_alias(machine, 'all')
+    return {'zones': [(zone['uid'], 'c:ffcc00')],
+            'modes': [mode['uid'] for mode in machine['modes']],
+            'save': True}
+
+
+def scenario_max_loops(machine):
+    colors = ['c:ff0000', 'c:00ff00', 'c:0000ff']
+    zones = []
+    for i, zone in enumerate(_single_zones(machine)):
+        cmds = [colors[(i + j) % len(colors)]
+                for j in range(ZONE_MAX_CONFIGURATIONS)]
+        zones.append((zone['uid'], ' '.join(cmds)))
+    return {'zones': zones}
+
+
+def scenario_zone_colors(machine):
+    colors = ['ff0000', '00ff00', '0000ff', 'ffff00', '00ffff', 'ff00ff']
+    return {'zones': [(zone['uid'], 'c:' + colors[i % len(colors)])
+                      for i, zone in enumerate(_single_zones(machine))]}
+
+
+# Benchmark scenarios, each returns lsd arguments for the given machine.
+SCENARIOS = collections.OrderedDict([
+    ('single-color', scenario_single_color),
+    ('keyboard-morph', scenario_keyboard_morph),
+    ('all-modes-save', scenario_all_modes_save),
+    ('max-loops', scenario_max_loops),
+    ('zone-colors', scenario_zone_colors),
+])
+
+
+def percentile(sorted_values, percent):
+    """
+    Returns the nearest-rank percentile of an already sorted list.
+    """
+    if not sorted_values:
+        return 0.0
+    rank = int(round(percent / 100.0 * len(sorted_values) + 0.5)) - 1
+    return sorted_values[max(0, min(rank, len(sorted_values) - 1))]
+
+
+def summarize(name, latencies, packets=None, errors=0):
+    """
+    Returns a result dict with latency percentiles (in ms) for latencies
+    (in seconds) and, when given, the packets per request.
+    """
+    latencies = sorted(latencies)
+    total = sum(latencies)
+    result = collections.OrderedDict([
+        ('name', name),
+        ('requests', len(latencies)),
+        ('errors', errors),
+        ('p50_ms', percentile(latencies, 50) * 1000),
+        ('p95_ms', percentile(latencies, 95) * 1000),
+        ('p99_ms', percentile(latencies, 99) * 1000),
+        ('mean_ms', total / len(latencies) * 1000 if latencies else 0.0),
+        ('rps', len(latencies) / total if total else 0.0),
+    ])
+    if packets is not None:
+        result['packets_per_request'] = \
+            float(packets) / len(latencies) if latencies else 0.0
+    return result
+
+
+def measure(fn, iterations, warmup=1):
+    """
+    Calls fn iterations times (after warmup calls) timing every call.
+
+    Returns a (latencies, errors) tuple, where errors counts the calls that
+    didn't return SUCCESS.
+    """
+    for _ in range(warmup):
+        fn()
+    latencies = []
+    errors = 0
+    for _ in range(iterations):
+        start = clock()
+        code = fn()
+        latencies.append(clock() - start)
+        if code not in (None, SUCCESS):
+            errors += 1
+    return latencies, errors
+
+
+def _transfers(device):
+    transfers = getattr(device, 'transfers', None)
+    return sum(transfers.values()) if transfers is not None else 0
+
+
+def path_parse(machine, scenario, iterations, options):
+    def run():
+        coalesce_zones(machine, parse(machine, scenario['zones']))
+    return measure(run, iterations) + (None,)
+
+
+def path_send(machine, scenario, iterations, options):
+    zones = coalesce_zones(machine, parse(machine, scenario['zones']))
+    device = machine['device']
+
+    def run():
+        return send(machine, zones, list(scenario.get('modes', [])),
+                    MAX_SPEED, scenario.get('save', False),
+                    options['pipeline'])
+    before = _transfers(device)
+    latencies, errors = measure(run, iterations, warmup=0)
+    return latencies, errors, _transfers(device) - before
+
+
+def path_daemon(machine, scenario, iterations, options):
+    unix_socket = options.get('unix_socket')
+    if unix_socket:
+        server = LSDaemonUnixServer(unix_socket, pipeline=options['pipeline'],
+                                    cache_size=options['cache_size'])
+        host, port = '', None
+    else:
+        server = LSDaemonServer(('127.0.0.1', 0),
+                                pipeline=options['pipeline'],
+                                cache_size=options['cache_size'])
+        host, port = server.server_address
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    args = {
+        'zones': coalesce_zones(machine, parse(machine, scenario['zones'])),
+        'modes': list(scenario.get('modes', [])),
+        'speed': MAX_SPEED,
+        'save': scenario.get('save', False)
+    }
+
+    client = lsdclient.LSDClient(host, port,
+                                 binary=options.get('binary', False),
+                                 unix_socket=unix_socket)
+
+    def run():
+        if not options['keep_shadow']:
+            # Otherwise repeated requests are skipped by the daemon.
+            server.session.invalidate()
+        return client.send(args)['code']
+    try:
+        run()
+        before = _transfers(machine['device'])
+        latencies, errors = measure(run, iterations, warmup=0)
+        return latencies, errors, _transfers(machine['device']) - before
+    finally:
+        client.close()
+        server.shutdown()
+        server.server_close()
+
+
+def path_daemon_binary(machine, scenario, iterations, options):
+    return path_daemon(machine, scenario, iterations,
+                       dict(options, binary=True))
+
+
+def path_daemon_unix(machine, scenario, iterations, options):
+    directory = tempfile.mkdtemp(prefix='lsbench')
+    try:
+        return path_daemon(
+            machine, scenario, iterations,
+            dict(options, unix_socket=os.path.join(directory, 'lsd.sock')))
+    finally:
+        shutil.rmtree(directory)
+
+
+def path_framebuffer(machine, scenario, iterations, options):
+    """
+    Writes the scenario as frames into the daemon frame buffer, waiting for
+    each to be applied. Frames only hold colors: the first command of each
+    zone is taken as its color, so scenarios other than zone-colors do less
+    work here than through the other paths.
+    """
+    directory = tempfile.mkdtemp(prefix='lsbench')
+    path = os.path.join(directory, 'lsd.fb')
+    server = LSDaemonServer(('127.0.0.1', 0), pipeline=options['pipeline'],
+                            framebuffer=path)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    framebuffer = FrameBuffer(path)
+    frame = [(zone_cmds[0], binary.pack_color(zone_cmds[1][1]))
+             for zone_cmds in parse(machine, scenario['zones'])]
+
+    def run():
+        if not options['keep_shadow']:
+            server.session.invalidate()
+        errors = server.poller.errors
+        if not server.poller.wait(framebuffer.write(frame)) or \
+           server.poller.errors != errors:
+            return ERROR_DEVICE_TIMEOUT
+        return SUCCESS
+    try:
+        run()
+        before = _transfers(machine['device'])
+        latencies, errors = measure(run, iterations, warmup=0)
+        return latencies, errors, _transfers(machine['device']) - before
+    finally:
+        framebuffer.close()
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(directory)
+
+
+# Code paths a scenario can be run through.
+PATHS = collections.OrderedDict([
+    ('parse', path_parse),
+    ('send', path_send),
+    ('daemon', path_daemon),
+    ('daemon-binary', path_daemon_binary),
+    ('daemon-unix', path_daemon_unix),
+    ('framebuffer', path_framebuffer),
+])
+
+
+def _legacy_packet(cmd, idx, zones, color1, color2=None):
+    # Packets as built before the struct based encoder, for reference.
+    first_two = int(zones / 65536)
+    next_two = int(zones / 256) - int(first_two * 256)
+    last_two = zones - first_two * 65536 - next_two * 256
+    if color2 is None:
+        return defpacket(cmd, [idx], (first_two, next_two, last_two), color1)
+    return defpacket(cmd, [idx], (first_two, next_two, last_two),
+                     [color1[0]], [color1[1] + color2[0]], [color2[1]])
+
+
+def micro_packets(iterations, count=4000):
+    """
+    Encodes count color and morph packets with the legacy list builder,
+    the packet_* functions and pack_* into a single reusable buffer.
+    """
+    commands = [(i % 15 + 1, 1 << (i % 16), (0xf0, 0x80), (0x0f, 0x70))
+                for i in range(count)]
+    buf = bytearray(count * DATA_LENGTH)
+
+    def legacy():
+        for idx, zones, color1, color2 in commands:
+            _legacy_packet(CMD_SET_COLOR, idx, zones, color1)
+            _legacy_packet(CMD_SET_MORPH, idx, zones, color1, color2)
+
+    def packet():
+        for idx, zones, color1, color2 in commands:
+            packet_set_color(idx, zones, color1)
+            packet_set_morph(idx, zones, color1, color2)
+
+    def pack_into():
+        offset = 0
+        for idx, zones, color1, color2 in commands:
+            pack_color(buf, offset, CMD_SET_COLOR, idx, zones, color1)
+            pack_morph(buf, offset, idx, zones, color1, color2)
+            offset += DATA_LENGTH
+
+    return _micro_results('packets', count * 2, iterations, [
+        ('legacy', legacy), ('packet', packet), ('pack-into', pack_into)])
+
+
+def micro_framing(iterations, count=2000):
+    """
+    Reads count request frames from a local socket pair with FrameReader,
+    the writer sending every frame whole or the whole stream split into
+    random fragments of 1 to 64 bytes. Reads not matching what was sent
+    count as errors.
+    """
+    rand = random.Random(0)
+    payloads = [
+        'send#%d %s' % (i, json.dumps({
+            'zones': [[1 << (i % 16), [CMD_SET_COLOR, 0, [i % 16, 0xf]]]] *
+            (1 + i % 8)}))
+        for i in range(count)]
+    frames = [encode_frame(payload) for payload in payloads]
+    stream = ''.join(frames)
+    fragments = []
+    offset = 0
+    while offset < len(stream):
+        size = rand.randint(1, 64)
+        fragments.append(stream[offset:offset + size])
+        offset += size
+
+    def read(chunks):
+        reader_sock, writer_sock = socket.socketpair()
+
+        def write():
+            try:
+                for chunk in chunks:
+                    writer_sock.sendall(chunk)
+            except socket.error:
+                pass
+            finally:
+                writer_sock.close()
+        thread = threading.Thread(target=write)
+        thread.start()
+        reader = FrameReader(reader_sock)
+        try:
+            for payload in payloads:
+                frame = reader.read_frame()
+                if frame is None or frame.tobytes() != payload:
+                    return ERROR_BAD_HEADER
+            return SUCCESS if reader.read_frame() is None else \
+                ERROR_BAD_HEADER
+        finally:
+            reader_sock.close()
+            thread.join()
+
+    return _micro_results('framing', count, iterations, [
+        ('whole', lambda: read(frames)),
+        ('fragmented', lambda: read(fragments))])
+
+
+def micro_wire(iterations, count=500):
+    """
+    Encodes and decodes count send requests (and their responses) the way
+    lsdclient and lsdaemon do, with the JSON and the binary encodings.
+    """
+    zones = [[1 << zone] + [
+        (CMD_SET_MORPH, (0xf0, 0x80), (0x0f, 0x70)) if i % 3 == 0 else
+        (CMD_SET_PULSE if i % 3 == 1 else CMD_SET_COLOR, (0x12, 0x30))
+        for i in range(ZONE_MAX_CONFIGURATIONS)] for zone in range(16)]
+    args = {'zones': zones, 'modes': [1, 5], 'speed': MAX_SPEED, 'save': False}
+    response = {'success': True, 'code': SUCCESS, 'message': '', 'id': '1'}
+
+    def read(data):
+        reader = FrameReader()
+        reader.feed(data)
+        return reader.next_frame()
+
+    def json_wire():
+        for _ in range(count):
+            frame = read(lsdclient.encode_request('send', args, 1))
+            method_name, json_args, request_id = lsdaemon_protocol.parse(
+                frame.tobytes().decode('utf-8'))
+            json.loads(json_args)
+            decode_json(read(lsdaemon_protocol.encode_response(
+                response, 'utf-8')))
+
+    def binary_wire():
+        for _ in range(count):
+            binary.decode_request(read(encode_frame(
+                binary.encode_request('send', args, 1))))
+            binary.decode_response(read(encode_frame(
+                binary.encode_response(response))))
+
+    results = _micro_results('wire', count, iterations, [
+        ('json', json_wire), ('binary', binary_wire)])
+    results[0]['request_bytes'] = len(
+        lsdclient.encode_request('send', args, 1))
+    results[1]['request_bytes'] = len(
+        encode_frame(binary.encode_request('send', args, 1)))
+    return results
+
+
+def _python_env(**variables):
+    """
+    Returns the environment for python processes importing this package,
+    updated with variables.
+    """
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [package_dir, os.environ.get('PYTHONPATH', '')]), **variables)
+
+
+def micro_startup(iterations):
+    """
+    Runs lsd as a new process setting all zones to a color, directly
+    (against the emulator) and through a daemon, with and without its
+    cached machine description.
+    """
+    server = LSDaemonServer(('127.0.0.1', 0))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    directory = tempfile.mkdtemp(prefix='lsbench')
+    env = _python_env(XDG_CACHE_HOME=directory)
+    lsd = [sys.executable, '-m', 'palienwarey.lsd', '--log-level', 'error']
+    colors = ['--all', 'c:ff0000']
+    daemon = lsd + ['--daemon', '--port', str(server.server_address[1]),
+                    '--unix-socket', os.path.join(directory, 'none.sock')]
+
+    def run(args):
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.call(args + colors, env=env, stdout=devnull,
+                                   stderr=devnull)
+
+    def uncached():
+        shutil.rmtree(os.path.join(directory, 'palienwarey'),
+                      ignore_errors=True)
+        return run(daemon)
+
+    try:
+        return _micro_results('startup', 1, iterations, [
+            ('direct', lambda: run(lsd + ['--emulate'])),
+            ('daemon', lambda: run(daemon)),
+            ('daemon-uncached', uncached)])
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(directory)
+
+
+# Measures importing a module in a new process, printing the seconds taken
+# and the modules it loaded.
+_IMPORT_SCRIPT = """
+import sys, time
+before = set(sys.modules)
+start = time.time()
+__import__(sys.argv[1])
+elapsed = time.time() - start
+sys.stdout.write('%r %s' % (elapsed, ' '.join(
+    sorted(name for name in sys.modules
+           if name not in before and sys.modules[name] is not None))))
+"""
+
+# Modules the commandline clients must not import (see micro_imports)
+HEAVY_MODULES = ('usb', 'SocketServer', 'socketserver', 'numpy',
+                 'palienwarey.machines', 'palienwarey.protocol',
+                 'palienwarey.lsdaemon', 'palienwarey.session',
+                 'palienwarey.worker', 'palienwarey.framebuffer',
+                 'palienwarey.animation', 'palienwarey.fitter',
+                 'palienwarey.colors', 'palienwarey.themes')
+
+
+def micro_imports(iterations):
+    """
+    Imports lsd and lsdclient in new processes, like python -X importtime
+    would, timing just the import and counting the modules loaded.
+
+    Every import loading one of HEAVY_MODULES counts as an error, their
+    names are listed in the result.
+    """
+    env = _python_env()
+    results = []
+    for module in ('palienwarey.lsd', 'palienwarey.lsdclient'):
+        latencies = []
+        errors = 0
+        heavy = set()
+        for _ in range(iterations):
+            output = subprocess.check_output(
+                [sys.executable, '-c', _IMPORT_SCRIPT, module], env=env)
+            elapsed, modules = output.decode('utf-8').split(' ', 1)
+            latencies.append(float(elapsed))
+            modules = modules.split()
+            loaded = set(name for name in modules
+                         if name.split('.')[0] in HEAVY_MODULES or
+                         name in HEAVY_MODULES)
+            if loaded:
+                errors += 1
+                heavy.update(loaded)
+        result = summarize('micro/imports/%s' % module.split('.')[-1],
+                           latencies, errors=errors)
+        result['modules'] = len(modules)
+        result['heavy_modules'] = sorted(heavy)
+        results.append(result)
+    return results
+
+
+def micro_colors(iterations, count=10000):
+    """
+    Packs count colors into protocol colors, both layouts, with parse_color
+    (from hex strings, as lsd does), the pure Python colors functions and,
+    when available, their NumPy versions with and without dithering.
+    """
+    rgb = [(i * 7 % 256, i * 13 % 256, i * 31 % 256) for i in range(count)]
+    hexes = ['%02x%02x%02x' % color for color in rgb]
+
+    def parse_colors():
+        for color in hexes:
+            parse_color(color)
+            parse_color(color, False)
+
+    def python():
+        levels = colors._py_quantize(rgb, False, 0)
+        colors._py_pack_levels(levels, True)
+        colors._py_pack_levels(levels, False)
+
+    variants = [('parse-color', parse_colors), ('python', python)]
+    if colors.HAVE_NUMPY:
+        array = colors.numpy.array(rgb, dtype=colors.numpy.uint8)
+
+        def vectorized(dither):
+            def pack():
+                colors.pack_colors(array, True, dither)
+                colors.pack_colors(array, False, dither)
+            return pack
+
+        variants.extend([('numpy', vectorized(False)),
+                         ('numpy-dither', vectorized(True))])
+    return _micro_results('colors', count * 2, iterations, variants)
+
+
+def micro_themes(iterations, count=50):
+    """
+    Applies count times, without a device, a theme setting 15 commands on
+    every zone for all modes: compiling it from JSON and loading the
+    compiled theme cached by a previous run (hashing included).
+    """
+    machine = registry[emulator.DEFAULT_PRODUCT_ID]
+    commands = ['c:ff0000', 'm:00ff00:0000ff', 'p:ffcc00']
+    data = json.dumps({
+        'speed': 200,
+        'modes': [mode['alias'] for mode in machine['modes']],
+        'zones': [[zone['uid'], [commands[(i + j) % len(commands)]
+                                 for j in range(ZONE_MAX_CONFIGURATIONS)]]
+                  for i, zone in enumerate(_single_zones(machine))]
+    })
+    cache_dir = tempfile.mkdtemp(prefix='lsbench-themes-')
+    stream, save = compile_theme(machine, load_theme(data))
+    write_compiled(cache_path(data, machine, cache_dir), stream, save)
+
+    def compiled():
+        for _ in range(count):
+            compile_theme(machine, load_theme(data))
+
+    def cached():
+        for _ in range(count):
+            theme = CompiledTheme(cache_path(data, machine, cache_dir))
+            list(theme.packets())
+            theme.close()
+
+    try:
+        results = _micro_results('themes', count, iterations, [
+            ('compile', compiled), ('cached', cached)])
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    for result in results:
+        result['packets'] = len(stream)
+    return results
+
+
+def check_budget(results, budget):
+    """
+    Checks micro/imports results against budget, the milliseconds a p50
+    import is allowed to take.
+
+    Returns a list of (name, reason) for every import over budget or
+    loading heavy modules.
+    """
+    failures = []
+    for result in results['results']:
+        if not result['name'].startswith('micro/imports/'):
+            continue
+        if result['errors']:
+            failures.append((result['name'], 'imports %s' %
+                             ', '.join(result['heavy_modules'])))
+        if budget is not None and result['p50_ms'] > budget:
+            failures.append((result['name'], 'p50 %.3fms over %.3fms' %
+                             (result['p50_ms'], budget)))
+    return failures
+
+
+def _micro_results(name, items, iterations, variants):
+    """
+    Measures every (variant_name, fn) in variants, adding the time per item
+    and the speedup against the first variant to the results.
+    """
+    results = []
+    for variant_name, fn in variants:
+        latencies, errors = measure(fn, iterations)
+        result = summarize('micro/%s/%s' % (name, variant_name), latencies,
+                           errors=errors)
+        result['items'] = items
+        result['us_per_item'] = result['p50_ms'] * 1000 / items
+        result['speedup'] = (results[0]['p50_ms'] / result['p50_ms']
+                             if results and result['p50_ms'] else 1.0)
+        results.append(result)
+    return results
+
+
+# Micro benchmarks, no device involved.
+MICROBENCHMARKS = collections.OrderedDict([
+    ('packets', micro_packets),
+    ('framing', micro_framing),
+    ('wire', micro_wire),
+    ('startup', micro_startup),
+    ('imports', micro_imports),
+    ('colors', micro_colors),
+    ('themes', micro_themes),
+])
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compares results p95 latencies against the baseline ones.
+
+    Returns a list of (name, baseline_p95, p95) for every regression beyond
+    tolerance (a ratio, 0.2 means 20% slower).
+    """
+    baseline_p95 = dict((result['name'], result['p95_ms'])
+                        for result in baseline['results'])
+    regressions = []
+    for result in results['results']:
+        before = baseline_p95.get(result['name'])
+        if before and result['p95_ms'] > before * (1 + tolerance):
+            regressions.append((result['name'], before, result['p95_ms']))
+    return regressions
+
+
+def lsbench(backend='emulator', product_id=emulator.DEFAULT_PRODUCT_ID,
+            timing=None, scenarios=None, paths=None, iterations=100,
+            pipeline=0, keep_shadow=False, micro=None,
+            cache_size=DEFAULT_PROGRAM_CACHE_SIZE):
+    """
+    Runs the benchmark scenarios through the given code paths.
+
+    When micro benchmarks are requested, scenarios are only run if
+    explicitly requested too.
+
+    Arguments:
+      + backend: 'emulator' for an EmulatedDevice or 'usb' for real hardware.
+      + product_id: product id of the emulated device.
+      + timing: an emulator.TimingModel for the emulated device.
+      + scenarios: names of SCENARIOS to run (defaults to all).
+      + paths: names of PATHS to run (defaults to all).
+      + iterations: requests sent per scenario and path.
+      + pipeline: pipeline argument for protocol.send.
+      + keep_shadow: when False, the daemon shadow program is invalidated
+         before each request so all of them are sent in full.
+      + micro: names of MICROBENCHMARKS to run.
+      + cache_size: size of the daemon program cache, 0 disables it.
+
+    Raises:
+      + EnvironmentError: if cannot find a connected machine.
+
+    Returns a JSON serializable dict with the results.
+    """
+    if backend == 'emulator':
+        emulator.enable(product_id, timing)
+    machine = get_machine()
+
+    options = {'pipeline': pipeline, 'keep_shadow': keep_shadow,
+               'cache_size': cache_size}
+    results = []
+    for micro_name in micro or ():
+        logger.info('Running micro/%s', micro_name)
+        results.extend(MICROBENCHMARKS[micro_name](iterations))
+
+    if scenarios is None:
+        scenarios = list(SCENARIOS) if not micro else []
+    for scenario_name in scenarios:
+        scenario = SCENARIOS[scenario_name](machine)
+        for path_name in paths or PATHS:
+            logger.info('Running %s/%s', path_name, scenario_name)
+            latencies, errors, packets = PATHS[path_name](
+                machine, scenario, iterations, options)
+            results.append(summarize('%s/%s' % (path_name, scenario_name),
+                                     latencies, packets, errors))
+
+    return collections.OrderedDict([
+        ('version', VERSION),
+        ('python', platform.python_version()),
+        ('backend', backend),
+        ('machine', machine['name']),
+        ('iterations', iterations),
+        ('results', results),
+    ])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Alienware lights latency benchmarks')
+    parser.add_argument('-b', '--backend', default='emulator',
+                        choices=['emulator', 'usb'],
+                        help='Device backend (defaults to emulator).')
+    parser.add_argument('-E', '--product-id', default='%.4x' %
+                        emulator.DEFAULT_PRODUCT_ID,
+                        help='Emulated device product id in hex.')
+    parser.add_argument('-T', '--timing', default='',
+                        help=('Emulator timing model, '
+                              'ex: latency=0.001,busy=0.005.'))
+    parser.add_argument('-s', '--scenario', action='append',
+                        choices=list(SCENARIOS), dest='scenarios',
+                        help='Scenario to run (defaults to all).')
+    parser.add_argument('-P', '--path', action='append', choices=list(PATHS),
+                        dest='paths',
+                        help='Code path to run (defaults to all).')
+    parser.add_argument('-M', '--micro', action='append',
+                        choices=list(MICROBENCHMARKS),
+                        help='Micro benchmark to run.')
+    parser.add_argument('-n', '--iterations', default=100, type=int,
+                        help='Requests per scenario and path.')
+    parser.add_argument('-w', '--pipeline', default=0, type=int, metavar='N',
+                        help='Send write-only, syncing every N packets.')
+    parser.add_argument('-k', '--keep-shadow', action='store_true',
+                        help='Let the daemon skip unchanged zones.')
+    parser.add_argument('-C', '--cache-size',
+                        default=DEFAULT_PROGRAM_CACHE_SIZE, type=int,
+                        help=('Daemon program cache size, 0 disables it '
+                              '(defaults to %s).' %
+                              DEFAULT_PROGRAM_CACHE_SIZE))
+    parser.add_argument('-o', '--output', default=None,
+                        help='Write JSON results to file instead of stdout.')
+    parser.add_argument('-B', '--baseline', default=None,
+                        help='JSON results to compare p95 latencies with.')
+    parser.add_argument('-t', '--tolerance', default=0.2, type=float,
+                        help='Allowed p95 regression ratio (defaults to 0.2).')
+    parser.add_argument('-S', '--import-budget', default=None, type=float,
+                        metavar='MS',
+                        help=('Fail when the imports micro benchmark p50 '
+                              'goes over MS milliseconds.'))
+    parser.add_argument('-l', '--log-level', default='warn',
+                        choices=['debug', 'info', 'warn', 'error', 'critical'],
+                        help='Set logging level.')
+    parser.add_argument('-v', '--verbosity', choices=['simple', 'verbose'],
+                        default='simple', help='Set verbosity of logs.')
+    args = parser.parse_args()
+
+    set_log_level(args.log_level)
+    set_log_formatter(args.verbosity)
+
+    timing = emulator.TimingModel.from_string(args.timing)
+    try:
+        results = lsbench(args.backend, int(args.product_id, 16), timing,
+                          args.scenarios, args.paths, args.iterations,
+                          args.pipeline, args.keep_shadow, args.micro,
+                          args.cache_size)
+    except EnvironmentError:
+        return log_error_code(ERROR_DEVICE_NOT_FOUND)
+
+    data = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(data + '\n')
+    else:
+        print(data)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(results, baseline, args.tolerance)
+        for name, before, after in regressions:
+            logger.error('Regression in %s: p95 %.3fms -> %.3fms',
+                         name, before, after)
+        if regressions:
+            return 1
+
+    failures = check_budget(results, args.import_budget)
+    for name, reason in failures:
+        logger.error('Startup budget exceeded by %s: %s', name, reason)
+    if failures:
+        return 1
+
+    return SUCCESS
+
+
+if __name__ == "__main__":
+    sys.exit(main())
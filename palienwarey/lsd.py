@@ -1,35 +1,71 @@
 # -*- coding: utf-8 -*-
 import argparse
+import json
 import sys
 
-from . import lsdclient
+from . import emulator
 from .constants import (
-    MAX_SPEED, ERROR_DEVICE_NOT_FOUND, ERROR_UNKNOWN_COMMAND, ERROR_BAD_COLOR)
-from .defines import get_machine
+    DEFAULT_HOST, DEFAULT_PORT, DEFAULT_UNIX_SOCKET, MAX_SPEED,
+    PIPELINE_SYNC_EVERY, DEFAULT_ANIMATION_FPS, DEFAULT_FIT_ERROR, SUCCESS,
+    ERROR_DEVICE_NOT_FOUND, ERROR_UNKNOWN_COMMAND, ERROR_BAD_COLOR,
+    ERROR_BAD_ANIMATION, ERROR_BAD_THEME, ERROR_BAD_RESPONSE_JSON)
+from .defines import get_machine, machine_from_description
 from .logconf import logger, set_log_level, set_log_formatter, log_error_code
-from .lsdaemon import DEFAULT_HOST, DEFAULT_PORT, SUCCESS
-from .parse import AppendZoneAction, parse
-from .protocol import send
+from .parse import AppendZoneAction, coalesce_zones, parse
 
 
-__all__ = ['lsd', 'main']
+__all__ = ['lsd', 'play_animation', 'send_loops', 'daemon_machine', 'main']
 
 
 def lsd(machine, zones=None, modes=None, speed=0, save=False,
-        cascade=False, daemon=False, repl=False,
+        cascade=False, daemon=False, repl=False, pipeline=0, binary=False,
         log_level='info', verbosity='simple',
-        host=DEFAULT_HOST, port=DEFAULT_PORT):
+        host=DEFAULT_HOST, port=DEFAULT_PORT,
+        unix_socket=None, animate=None, fps=None,
+        stop_animation=False, stream=False, max_error=DEFAULT_FIT_ERROR,
+        theme=None, client=None):
     set_log_level(log_level)
     set_log_formatter(verbosity)
 
-    try:
-        parsed = parse(machine, zones, cascade)
-    except KeyError as e:
-        logger.error(e.message)
-        return log_error_code(ERROR_UNKNOWN_COMMAND)
-    except ValueError as e:
-        logger.error(e.message)
-        return log_error_code(ERROR_BAD_COLOR)
+    if animate is not None or stop_animation:
+        if daemon and client is None:
+            from . import lsdclient
+            client = lsdclient.LSDClient(host, port, pool_size=1,
+                                         binary=binary,
+                                         unix_socket=unix_socket)
+        try:
+            return play_animation(machine, animate, fps, pipeline,
+                                  client if daemon else None, stream,
+                                  max_error)
+        finally:
+            if client is not None:
+                client.close()
+
+    if theme is not None and not daemon:
+        # Compiled themes are cached, so there is nothing left to parse.
+        from .themes import apply_theme
+        logger.info('Not using daemon, applying theme directly.')
+        return apply_theme(machine, theme, pipeline=pipeline)
+    elif theme is not None:
+        from .themes import load_theme, theme_program
+        try:
+            with open(theme, 'rb') as theme_file:
+                program = theme_program(machine,
+                                        load_theme(theme_file.read()))
+        except (IOError, ValueError) as e:
+            logger.error('Cannot load %s: %s', theme, e)
+            return log_error_code(ERROR_BAD_THEME)
+        parsed, modes = program['zones'], program['modes']
+        speed, save = program['speed'], program['save']
+    else:
+        try:
+            parsed = coalesce_zones(machine, parse(machine, zones, cascade))
+        except KeyError as e:
+            logger.error(e.message)
+            return log_error_code(ERROR_UNKNOWN_COMMAND)
+        except ValueError as e:
+            logger.error(e.message)
+            return log_error_code(ERROR_BAD_COLOR)
 
     if repl:
         try:
@@ -38,14 +74,23 @@ def lsd(machine, zones=None, modes=None, speed=0, save=False,
             from pdb import set_trace
         set_trace()
 
+    # lsd is meant to be quick enough to be bound to keys, modules needed
+    # only by the direct (usb) or the daemon paths are imported on use.
     if not daemon:
+        from .protocol import send
         logger.info('Not using daemon, executing commands directly.')
-        return send(machine, parsed, modes, speed, save)
+        return send(machine, parsed, modes, speed, save, pipeline)
     else:
-        response = lsdclient.ping(host, port)
-        if response['success']:
+        # The daemon was pinged already when asked for the machine, a
+        # daemon gone since then just fails the send.
+        if client is None:
+            from . import lsdclient
+            client = lsdclient.LSDClient(host, port, pool_size=1,
+                                         binary=binary,
+                                         unix_socket=unix_socket)
+        try:
             logger.info('Using daemon at port: %s' % port)
-            response = lsdclient.send(host, port, {
+            response = client.send({
                 'zones': parsed,
                 'modes': modes,
                 'speed': speed,
@@ -54,36 +99,219 @@ def lsd(machine, zones=None, modes=None, speed=0, save=False,
             if not response['code'] == SUCCESS:
                 logger.error(response['message'])
             return log_error_code(response['code'])
-        else:
+        finally:
+            client.close()
+
+
+def play_animation(machine, path=None, fps=None, pipeline=0, client=None,
+                   stream=False, max_error=DEFAULT_FIT_ERROR):
+    """
+    Plays the animation in the JSON file at path (see
+    ``animation.load_spec``) until it ends or gets interrupted. fps
+    overrides the one in the file, if any.
+
+    Unless stream is True, looping animations are first fitted onto device
+    loops (see ``fitter.fit_loops``) within max_error and sent once, the
+    device playing them on its own. Frames are streamed only when that is
+    not possible.
+
+    When client is given, the daemon plays the animation on its own and
+    this returns right away. Without path, the animation the daemon is
+    playing gets stopped.
+
+    Returns an integer intended to be the value returned by sys.exit.
+    """
+    from .animation import FrameScheduler, load_spec
+
+    animation = None
+    if path is not None:
+        try:
+            with open(path) as spec_file:
+                spec = json.load(spec_file)
+            animation = load_spec(spec, machine)
+        except (IOError, ValueError) as e:
+            logger.error('Cannot load %s: %s', path, e)
+            return log_error_code(ERROR_BAD_ANIMATION)
+        fps = fps or spec.get('fps', DEFAULT_ANIMATION_FPS)
+
+    if animation is not None and not stream:
+        from .fitter import fit_loops
+        fitted = fit_loops(animation, machine, max_error)
+        if fitted is not None:
+            return send_loops(machine, fitted, pipeline, client)
+        logger.info('Animation cannot be fitted onto device loops, '
+                    'streaming it')
+
+    if client is not None:
+        args = None
+        if animation is not None:
+            args = dict(animation.as_spec(), fps=fps)
+        response = client.request('animate', args)
+        if not response['success']:
             return log_error_code(response['code'])
+        logger.info('Animation %s by the daemon',
+                    'played' if args is not None else 'stopped')
+        return SUCCESS
 
+    if animation is None:
+        logger.error('Only the daemon plays animations in the background')
+        return log_error_code(ERROR_BAD_ANIMATION)
 
-def main():
-    parser = argparse.ArgumentParser(description='Alienware lights control')
-    parser.add_argument('-l', '--log-level', default='info',
-                        choices=['debug', 'info', 'warn', 'error', 'critical'],
-                        help='Set logging level.')
-    parser.add_argument('-c', '--cascade', action='store_true',
-                        help='Override commands in cascade.')
+    from .session import DeviceSession
+    # Frames hardly ever repeat, caching their programs is a waste.
+    session = DeviceSession(idle_timeout=0, pipeline=pipeline, cache_size=0)
+    try:
+        scheduler = FrameScheduler(animation, session.send, fps)
+    except ValueError as e:
+        logger.error(e)
+        return log_error_code(ERROR_BAD_ANIMATION)
+    try:
+        scheduler.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        session.close()
+    stats = scheduler.stats()
+    logger.info('Played %d frames at %.1f fps (%d dropped, %d errors), '
+                '%.2fms of USB per frame sent', stats['frames'],
+                stats['achieved_fps'], stats['dropped'], stats['errors'],
+                stats['usb']['mean_ms'])
+    if scheduler.last_error is not None:
+        return log_error_code(scheduler.last_error)
+    return SUCCESS
+
+
+def send_loops(machine, fitted, pipeline=0, client=None):
+    """
+    Sends the loops fitted to an animation, as returned by
+    ``fitter.fit_loops``, directly or through the daemon client.
+
+    Returns an integer intended to be the value returned by sys.exit.
+    """
+    zones = coalesce_zones(machine, fitted['zones'])
+    logger.info('Animation fitted onto %d device loops (speed %d)',
+                len(zones), fitted['speed'])
+    if client is None:
+        from .protocol import send
+        return send(machine, zones, None, fitted['speed'], False, pipeline)
+    # Replaces the animation played by the daemon, if any.
+    response = client.send({'zones': zones, 'speed': fitted['speed']})
+    if not response['success']:
+        return log_error_code(response['code'])
+    return SUCCESS
+
+
+def daemon_machine(client):
+    """
+    Returns a (code, machine) tuple with the machine served by the daemon
+    client talks to, built from its (cached) description.
+
+    The machine has no device, but that is all lsd needs to parse commands
+    that are going to be sent through the daemon anyway.
+    """
+    response = client.ping()
+    if response['success']:
+        data = response.get('data') or {}
+        response = client.describe(data.get('uid'),
+                                   data.get('definition_hash'))
+    if not response['success']:
+        return response['code'], None
+    try:
+        return SUCCESS, machine_from_description(response['data'])
+    except (KeyError, TypeError, ValueError):
+        return ERROR_BAD_RESPONSE_JSON, None
+
+
+def client_argument_parser():
+    """
+    Returns a parser with the daemon client switches.
+    """
+    parser = argparse.ArgumentParser(add_help=False)
     parser.add_argument('-d', '--daemon', action='store_true',
                         default=False, help='Use the daemon.')
+    parser.add_argument('-b', '--binary', action='store_true',
+                        default=False,
+                        help='Use the binary encoding with the daemon.')
     parser.add_argument('-i', '--host', default=DEFAULT_HOST,
                         help='lsdaemon host (defaults localhost).')
     parser.add_argument('-p', '--port', action='store', default=DEFAULT_PORT,
+                        type=int,
                         help='lsdaemon port (defaults to %s.' % DEFAULT_PORT)
+    parser.add_argument('-u', '--unix-socket', metavar='PATH',
+                        help=('lsdaemon Unix socket, preferred over TCP '
+                              'when available (defaults to %s for the '
+                              'default port).' % DEFAULT_UNIX_SOCKET))
+    return parser
+
+
+def main():
+    # The emulator must be enabled before looking for the machine, whose
+    # definition is needed to build the rest of the switches.
+    emulate_parser = emulator.argument_parser()
+    emulate = emulate_parser.parse_known_args()[0].emulate
+    if emulate is not None:
+        emulator.enable(emulate)
+
+    # With the daemon, the machine definition is asked to it instead.
+    client_parser = client_argument_parser()
+    client_args = client_parser.parse_known_args()[0]
+
+    parser = argparse.ArgumentParser(description='Alienware lights control',
+                                     parents=[emulate_parser, client_parser])
+    parser.add_argument('-l', '--log-level', default='info',
+                        choices=['debug', 'info', 'warn', 'error', 'critical'],
+                        help='Set logging level.')
+    parser.add_argument('-c', '--cascade', action='store_true',
+                        help='Override commands in cascade.')
     parser.add_argument('-r', '--repl', default=False, action='store_true',
                         help='Get into the command repl.')
     parser.add_argument('-t', '--speed', default=MAX_SPEED, type=int,
                         help='Set theme tempo (speed).')
     parser.add_argument('-s', '--save', action='store_true', default=False,
                         help='Save changes permanently.')
+    parser.add_argument('-w', '--pipeline', nargs='?', type=int, default=0,
+                        const=PIPELINE_SYNC_EVERY, metavar='N',
+                        help=('Send commands write-only, checking device '
+                              'status every N packets (defaults to %s, '
+                              'ignored with --daemon).' % PIPELINE_SYNC_EVERY))
+    parser.add_argument('-a', '--animate', default=None, metavar='FILE',
+                        help=('Play the animation in a JSON file, in the '
+                              'background with --daemon.'))
+    parser.add_argument('-f', '--fps', default=None, type=float,
+                        help=('Animation frames per second (defaults to the '
+                              'file one or %s).' % DEFAULT_ANIMATION_FPS))
+    parser.add_argument('-S', '--stop-animation', action='store_true',
+                        default=False,
+                        help='Stop the animation played by the daemon.')
+    parser.add_argument('-T', '--theme', default=None, metavar='FILE',
+                        help=('Apply the theme in a JSON file, compiled '
+                              'and cached on first use.'))
+    parser.add_argument('--stream', action='store_true', default=False,
+                        help=('Stream animation frames instead of fitting '
+                              'device loops to them.'))
+    parser.add_argument('--max-error', default=DEFAULT_FIT_ERROR, type=int,
+                        metavar='N',
+                        help=('Largest color difference (0 to 255) allowed '
+                              'for device loops fitted to animations '
+                              '(defaults to %s).' % DEFAULT_FIT_ERROR))
     parser.add_argument('-v', '--verbosity', choices=['simple', 'verbose'],
                         default='simple', help='Set verbosity of logs.')
 
-    try:
-        machine = get_machine()
-    except EnvironmentError:
-        return log_error_code(ERROR_DEVICE_NOT_FOUND)
+    client = None
+    if client_args.daemon:
+        from . import lsdclient
+        client = lsdclient.LSDClient(
+            client_args.host, client_args.port, pool_size=1,
+            binary=client_args.binary, unix_socket=client_args.unix_socket)
+        code, machine = daemon_machine(client)
+        if code != SUCCESS:
+            client.close()
+            return log_error_code(code)
+    else:
+        try:
+            machine = get_machine()
+        except EnvironmentError:
+            return log_error_code(ERROR_DEVICE_NOT_FOUND)
 
     # Parse all modes and add switches for them.
     for i, mode in enumerate(machine['modes']):
@@ -103,8 +331,9 @@ def main():
             help=zone['name'])
 
     args = vars(parser.parse_args())
+    del args['emulate']
 
-    return lsd(machine, **args)
+    return lsd(machine, client=client, **args)
 
 
 if __name__ == '__main__':
@@ -1,7 +1,12 @@
 # -*- coding: utf-8 -*-
 import argparse
+import errno
 import json
+import os
 import socket
+import stat
+import struct
+import threading
 
 try:
     import SocketServer as socketserver
@@ -9,40 +14,75 @@ except ImportError:
     # Python 3 compat
     import socketserver
 
-from .constants import (DEFAULT_HOST, DEFAULT_PORT, HEADER_LENGTH, SUCCESS,
-                        ERROR_BAD_HEADER, ERROR_BAD_METHOD,
-                        ERROR_BAD_ARGUMENTS, ERROR_BAD_REQUEST_JSON,
-                        MESSAGES_MAP)
+from .constants import (DEFAULT_HOST, DEFAULT_PORT, HEADER_LENGTH,
+                        DEFAULT_IDLE_TIMEOUT, DEFAULT_QUEUE_DEPTH,
+                        DEFAULT_REQUEST_DEADLINE, DEFAULT_MAX_CONNECTIONS,
+                        DEFAULT_CONNECTION_QUEUE, DEFAULT_READ_TIMEOUT,
+                        DEFAULT_KEEPALIVE_TIMEOUT,
+                        DEFAULT_ACCEPT_BACKLOG, DEFAULT_ANIMATION_FPS,
+                        DEFAULT_PROGRAM_CACHE_SIZE, DEFAULT_PROGRAM_CACHE_TTL,
+                        MAX_SPEED, PIPELINE_SYNC_EVERY, SUCCESS,
+                        ERROR_DEVICE_NOT_FOUND, ERROR_BUSY, ERROR_BAD_HEADER,
+                        ERROR_BAD_METHOD, ERROR_BAD_ARGUMENTS,
+                        ERROR_BAD_REQUEST_JSON, ERROR_BAD_REQUEST_BINARY,
+                        ERROR_FRAME_TOO_LARGE,
+                        DEFAULT_MAX_FRAME_SIZE, DEFAULT_UNIX_SOCKET,
+                        DEFAULT_UNIX_SOCKET_MODE, DEFAULT_FRAMEBUFFER)
+from . import binary, emulator, framing
+from .animation import AnimationPlayer, load_spec
+from .framebuffer import FrameBuffer, FrameBufferPoller
+from .framing import FrameError, FrameTooLarge, FrameReader, encode_frame
 from .logconf import logger, set_log_level, set_log_formatter
-from .protocol import send
+from .protocol import get_wait_policy
+from .session import DeviceSession, coalesce_key
+from .worker import ConnectionPool, DeviceWorker
 
 
 __all__ = ['DEFAULT_PORT', 'HEADER_LENGTH', 'SUCCESS', 'ERROR_BAD_HEADER',
            'ERROR_BAD_METHOD', 'ERROR_BAD_ARGUMENTS', 'ERROR_BAD_REQUEST_JSON',
-           'protocol', 'LSDaemonServerRequestHandler', 'LSDaemonServer',
-           'lsdaemon', 'main']
+           'DEFAULT_UNIX_SOCKET', 'protocol', 'LSDaemonServerRequestHandler',
+           'LSDaemonServer', 'LSDaemonUnixServer', 'lsdaemon', 'main']
 
 
 class protocol(object):
 
     @staticmethod
-    def response(code):
-        return {'success': code == SUCCESS,
-                'code': code,
-                'message': MESSAGES_MAP[code]}
+    def response(code, data=None):
+        return framing.response(code, data)
+
+    @staticmethod
+    def method_response(result):
+        """
+        Builds the response for what a method_* returned.
+
+        Methods return either a status code or a (code, data) tuple.
+        """
+        if isinstance(result, tuple):
+            return protocol.response(*result)
+        return protocol.response(result)
 
     @staticmethod
     def encode_response(response, coding):
-        data = json.dumps(response).encode(coding)
-        header = "%.6x" % len(data)
-        return header + data
+        return encode_frame(json.dumps(response).encode(coding))
 
     @staticmethod
     def decode_request(request, coding):
         return request.decode(coding)
 
     @staticmethod
-    def dispatch(method_name, args=None):
+    def dispatch(server, method_name, args=None):
+        if args is not None:
+            try:
+                args = json.loads(args)
+            except ValueError:
+                return protocol.response(ERROR_BAD_REQUEST_JSON)
+        return protocol.call(server, method_name, args)
+
+    @staticmethod
+    def call(server, method_name, args=None):
+        """
+        Same as dispatch, but with args already decoded.
+        """
         try:
             method = getattr(protocol, 'method_' + method_name)
         except AttributeError:
@@ -50,33 +90,98 @@ class protocol(object):
 
         if args is not None:
             try:
-                args = json.loads(args)
-            except ValueError:
-                return ERROR_BAD_REQUEST_JSON
-
-            try:
-                return protocol.response(method(args))
-            except TypeError:
+                return protocol.method_response(method(server, args))
+            except (TypeError, ValueError, IndexError, struct.error) as e:
+                # Malformed arguments, like colors not packing into bytes.
+                logger.error('Bad %s arguments: %s', method_name, e)
                 return protocol.response(ERROR_BAD_ARGUMENTS)
         else:
-            return protocol.response(method())
+            return protocol.method_response(method(server))
 
     @staticmethod
     def parse(request):
+        """
+        Splits a request into its (method_name, args, request_id).
+
+        The request id is optional and set by appending it to the method
+        name after a hash sign, like in 'send#42 {...}'.
+        """
         try:
             method_name, args = request.split(' ', 1)
         except ValueError:
             method_name = request.strip()
             args = None
-        return (method_name, args)
+        method_name, _, request_id = method_name.partition('#')
+        return (method_name, args, request_id or None)
 
     @staticmethod
-    def method_send(args):
-        return send(**args)
+    def method_send(server, args):
+        # Queued sends to the same zones and modes are superseded by newer
+        # ones, but saves are never dropped.
+        try:
+            key = coalesce_key(**args)
+        except (TypeError, IndexError):
+            return ERROR_BAD_ARGUMENTS
+        # Otherwise the next frame would override this request.
+        server.player.stop()
+        return server.worker.call_latest(key, args.get('save', False),
+                                         server.session.send, **args)
+
+    @staticmethod
+    def method_ping(server):
+        # The machine uid and definition hash let clients validate their
+        # cached descriptions.
+        description = server.session.describe()
+        if description is None:
+            return SUCCESS
+        return (SUCCESS, {'uid': description['uid'],
+                          'definition_hash': server.session.definition})
+
+    @staticmethod
+    def method_animate(server, args=None):
+        # Without arguments, stops the animation being played.
+        if args is None:
+            server.player.stop()
+            return SUCCESS
+        try:
+            server.player.play(load_spec(args),
+                               args.get('fps', DEFAULT_ANIMATION_FPS),
+                               args.get('seconds'))
+        except ValueError as e:
+            logger.error('Bad animation: %s', e)
+            return ERROR_BAD_ARGUMENTS
+        return SUCCESS
+
+    @staticmethod
+    def method_describe(server):
+        description = server.session.describe()
+        if description is None:
+            return ERROR_DEVICE_NOT_FOUND
+        return (SUCCESS, description)
+
+    @staticmethod
+    def method_state(server):
+        return (SUCCESS, server.session.state())
 
     @staticmethod
-    def method_ping():
-        return 0
+    def method_invalidate(server):
+        server.session.invalidate()
+        return SUCCESS
+
+    @staticmethod
+    def method_stats(server):
+        stats = {
+            'wait_ok': get_wait_policy().histogram.as_dict(),
+            'queue': server.worker.stats(),
+            'connections': server.pool.stats(),
+            'cache': server.session.cache.stats()
+        }
+        if server.poller is not None:
+            stats['framebuffer'] = server.poller.stats()
+        animation = server.player.stats()
+        if animation is not None:
+            stats['animation'] = animation
+        return (SUCCESS, stats)
 
 
 class LSDaemonServerRequestHandler(socketserver.BaseRequestHandler):
@@ -84,7 +189,14 @@ class LSDaemonServerRequestHandler(socketserver.BaseRequestHandler):
     Request handler for the LSDaemonServer.
 
     Handle protocol requests from client by dispatching received data to
-    protocol.send and returns to the client whatever it replies.
+    protocol.send and returns to the client whatever it replies. Any number
+    of requests are served, in order, until the client closes the
+    connection, responses being tagged with the request id when given.
+
+    Every connection holds a pool thread, so once a request is served the
+    next one must start within the server keepalive_timeout or the
+    connection is closed, idle clients keeping connections alive would use
+    up the pool otherwise. Clients reconnect when that happens.
     """
 
     def __init__(self, request, client_address, server):
@@ -92,83 +204,432 @@ class LSDaemonServerRequestHandler(socketserver.BaseRequestHandler):
         socketserver.BaseRequestHandler.__init__(
             self, request, client_address, server)
 
+    def setup(self):
+        if self.server.read_timeout:
+            self.request.settimeout(self.server.read_timeout)
+
+    def wait_request(self, reader):
+        """
+        Waits up to keepalive_timeout for the next request to start
+        arriving.
+
+        Returns False if the client closed the connection.
+        """
+        if reader.pending() or not self.server.keepalive_timeout:
+            return True
+        self.request.settimeout(self.server.keepalive_timeout)
+        try:
+            return bool(reader.recv())
+        finally:
+            self.request.settimeout(self.server.read_timeout or None)
+
+    def reply(self, response):
+        data = protocol.encode_response(response, self.encoding)
+        logger.debug('Replied data: %s', data)
+        self.request.sendall(data)
+
+    def handle_binary(self, frame):
+        """
+        Serves a request using the binary encoding, see the binary module.
+        """
+        try:
+            method_name, args, request_id = binary.decode_request(frame)
+        except ValueError as e:
+            logger.error('Bad binary request received: %s', e)
+            response = protocol.response(ERROR_BAD_REQUEST_BINARY)
+        else:
+            logger.debug('Received binary request: %s %s', method_name, args)
+            response = protocol.call(self.server, method_name, args)
+            if request_id is not None:
+                response['id'] = request_id
+        data = encode_frame(binary.encode_response(response))
+        logger.debug('Replied binary data: %r', data)
+        self.request.sendall(data)
+
     def handle(self):
         logger.debug('Client connected')
+        reader = FrameReader(self.request, self.server.max_frame_size)
+        served = False
         while True:
             try:
-                header = self.request.recv(HEADER_LENGTH)
-                logger.debug('Received header: %s', header)
-
-                if header:
-                    length = int(header, 16)
-                else:
-                    logger.error('Empty header received')
-                    response = protocol.encode_response(
-                        ERROR_BAD_HEADER, self.encoding)
-                    self.request.send(response)
-                    self.request.close()
+                if served and not self.wait_request(reader):
+                    logger.debug('Client disconnected')
+                    break
+                served = True
+                try:
+                    frame = reader.read_frame()
+                except FrameTooLarge as e:
+                    logger.error('Bad request received: %s', e)
+                    self.reply(protocol.response(ERROR_FRAME_TOO_LARGE))
+                    break
+                except FrameError as e:
+                    logger.error('Bad request received: %s', e)
+                    self.reply(protocol.response(ERROR_BAD_HEADER))
                     break
 
-                data = protocol.decode_request(
-                    self.request.recv(length), self.encoding)
-                logger.debug('Received data: %s', data)
+                if frame is None:
+                    logger.debug('Client disconnected')
+                    break
 
-                method_name, args = protocol.parse(data)
-                raw_response = protocol.dispatch(method_name, args)
-                response = protocol.encode_response(
-                    raw_response, self.encoding)
-                logger.debug('Replied data: %s', response)
-                self.request.send(response)
+                if binary.is_binary(frame):
+                    self.handle_binary(frame)
+                    continue
 
-                break
+                data = protocol.decode_request(frame.tobytes(), self.encoding)
+                logger.debug('Received data: %s', data)
+
+                method_name, args, request_id = protocol.parse(data)
+                response = protocol.dispatch(self.server, method_name, args)
+                if request_id is not None:
+                    response['id'] = request_id
+                self.reply(response)
             except socket.timeout as e:
-                logger.error('Socket error: %s', e)
+                logger.debug('Client timed out: %s', e)
+                break
+            except socket.error as e:
+                logger.debug('Client connection lost: %s', e)
                 break
 
 
-class LSDaemonServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+class LSDaemonServer(socketserver.TCPServer):
     """
     Good ol' TCPServer using LSDaemonServerRequestHandler as handler.
+
+    Connections are served by a ConnectionPool of max_connections threads,
+    up to connection_queue more wait for a free one and any other gets an
+    ERROR_BUSY reply and is closed. Clients sending nothing for
+    read_timeout seconds are disconnected, or for keepalive_timeout seconds
+    between requests, and backlog is the size of the OS queue of
+    connections yet to be accepted.
+
+    The server owns a DeviceSession so the device is claimed once and reused
+    by all requests until it has been idle for idle_timeout seconds, and
+    the programs it compiles are cached (up to cache_size of them for
+    cache_ttl seconds). Only its DeviceWorker thread talks to the device,
+    handler threads queue requests for it (up to max_queue, each waiting at
+    most deadline seconds). When share_with is another server, its session,
+    worker and connection pool are used instead, which allows serving
+    several transports.
+
+    When framebuffer is a path, a FrameBuffer is created there and the
+    frames local clients write into it are applied by a FrameBufferPoller.
+
+    Animations requested with the animate method are played by an
+    AnimationPlayer, frames going through the DeviceWorker too.
     """
 
+    max_frame_size = DEFAULT_MAX_FRAME_SIZE
+
     def __init__(self, server_address,
-                 handler_class=LSDaemonServerRequestHandler, encoding='utf-8'):
+                 handler_class=LSDaemonServerRequestHandler, encoding='utf-8',
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT, pipeline=0,
+                 max_queue=DEFAULT_QUEUE_DEPTH,
+                 deadline=DEFAULT_REQUEST_DEADLINE, share_with=None,
+                 framebuffer=None, max_connections=DEFAULT_MAX_CONNECTIONS,
+                 connection_queue=DEFAULT_CONNECTION_QUEUE,
+                 read_timeout=DEFAULT_READ_TIMEOUT,
+                 keepalive_timeout=DEFAULT_KEEPALIVE_TIMEOUT,
+                 backlog=DEFAULT_ACCEPT_BACKLOG,
+                 cache_size=DEFAULT_PROGRAM_CACHE_SIZE,
+                 cache_ttl=DEFAULT_PROGRAM_CACHE_TTL):
         self.encoding = encoding
+        self.share_with = share_with
+        # Set once the threads below run, a server failing to bind is closed
+        # before and has nothing to stop.
+        self.started = False
+        self.read_timeout = read_timeout
+        self.keepalive_timeout = keepalive_timeout
+        # Used by server_activate to listen.
+        self.request_queue_size = backlog
+        if share_with is None:
+            self.session = DeviceSession(idle_timeout, pipeline, cache_size,
+                                         cache_ttl)
+            self.worker = DeviceWorker(max_queue, deadline)
+            self.pool = ConnectionPool(max_connections, connection_queue)
+            self.player = AnimationPlayer(self.send_frame)
+            self.poller = None
+        else:
+            self.session = share_with.session
+            self.worker = share_with.worker
+            self.pool = share_with.pool
+            self.player = share_with.player
+            self.poller = share_with.poller
         socketserver.TCPServer.__init__(self, server_address, handler_class)
-        host, port = self.server_address
-        logger.info('Serving on: %s:%s (coding %s)', host, port, self.encoding)
+        if share_with is None:
+            # Created once bound, so a second daemon failing to start does
+            # not touch the frame buffer of the one running.
+            if framebuffer is not None:
+                try:
+                    self.poller = FrameBufferPoller(
+                        FrameBuffer(framebuffer, create=True), self.worker,
+                        self.session)
+                except Exception:
+                    self.server_close()
+                    raise
+            self.worker.start()
+            self.pool.start()
+            if self.poller is not None:
+                self.poller.start()
+                logger.info('Frame buffer at: %s', framebuffer)
+            self.started = True
+        logger.info('Serving on: %s (coding %s)', self.address_string(),
+                    self.encoding)
+
+    def address_string(self):
+        host, port = self.server_address[:2]
+        return '%s:%s' % (host, port)
+
+    def send_frame(self, zones):
+        return self.worker.call(self.session.send, zones, None, MAX_SPEED,
+                                cached=False)
+
+    def process_request(self, request, client_address):
+        if not self.pool.submit(self.process_request_thread, request,
+                                client_address):
+            logger.warn('Too many connections, rejecting client')
+            self.reject_request(request)
+
+    def process_request_thread(self, request, client_address):
+        # Same as ThreadingMixIn does, but run by a pool thread.
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def reject_request(self, request):
+        try:
+            request.sendall(protocol.encode_response(
+                protocol.response(ERROR_BUSY), self.encoding))
+        except socket.error as e:
+            logger.debug('Cannot reply to rejected client: %s', e)
+        self.shutdown_request(request)
+
+    def server_close(self):
+        socketserver.TCPServer.server_close(self)
+        if self.share_with is None and self.started:
+            self.player.stop()
+            self.pool.stop()
+            if self.poller is not None:
+                self.poller.stop()
+                self.poller.framebuffer.close()
+                try:
+                    os.unlink(self.poller.framebuffer.path)
+                except OSError:
+                    pass
+            self.worker.stop()
+            self.session.close()
+
+
+class LSDaemonUnixServer(LSDaemonServer):
+    """
+    LSDaemonServer listening on a Unix socket at path.
+
+    The socket file gets mode as permission bits, so local users can be
+    allowed to talk to the daemon without exposing it on the network. A
+    stale socket file left by a dead daemon is replaced.
+    """
+
+    address_family = socket.AF_UNIX
+
+    def __init__(self, path, mode=DEFAULT_UNIX_SOCKET_MODE, **kwargs):
+        self.mode = mode
+        # Only the socket file this server bound is removed on close, never
+        # the one of a daemon already listening on path.
+        self.bound = False
+        LSDaemonServer.__init__(self, path, **kwargs)
+
+    def address_string(self):
+        return self.server_address
+
+    def server_bind(self):
+        path = self.server_address
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except socket.error:
+                logger.info('Removing stale socket %s', path)
+                os.unlink(path)
+            else:
+                raise socket.error(errno.EADDRINUSE,
+                                   'Daemon already listening on %s' % path)
+            finally:
+                probe.close()
+        # Created with mode right away, a chmod after bind would leave a
+        # window where the umask decides who can connect.
+        umask = os.umask(~self.mode & 0o777)
+        try:
+            socketserver.TCPServer.server_bind(self)
+        finally:
+            os.umask(umask)
+        self.bound = True
+
+    def server_close(self):
+        LSDaemonServer.server_close(self)
+        if not self.bound:
+            return
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
 
 
 def lsdaemon(host=DEFAULT_HOST, port=0, encoding='utf-8',
+             idle_timeout=DEFAULT_IDLE_TIMEOUT, pipeline=0,
+             max_queue=DEFAULT_QUEUE_DEPTH, deadline=DEFAULT_REQUEST_DEADLINE,
+             unix_socket=None, unix_socket_mode=DEFAULT_UNIX_SOCKET_MODE,
+             no_tcp=False, framebuffer=None,
+             max_connections=DEFAULT_MAX_CONNECTIONS,
+             connection_queue=DEFAULT_CONNECTION_QUEUE,
+             read_timeout=DEFAULT_READ_TIMEOUT,
+             keepalive_timeout=DEFAULT_KEEPALIVE_TIMEOUT,
+             backlog=DEFAULT_ACCEPT_BACKLOG,
+             cache_size=DEFAULT_PROGRAM_CACHE_SIZE,
+             cache_ttl=DEFAULT_PROGRAM_CACHE_TTL, emulate=None,
              log_level='info', verbosity='simple'):
     """
     Starts a LSDaemonServer on given host and port using encoding.
 
-    If no port is provided then let the OS choose it.
+    If no port is provided then let the OS choose it. When unix_socket is a
+    path, a LSDaemonUnixServer is started there too (or instead, if no_tcp
+    is True). When framebuffer is a path, local clients can write frames
+    there (see framebuffer). When emulate is a product id, an emulated
+    device is used instead of real hardware.
     """
     set_log_level(log_level)
     set_log_formatter(verbosity)
 
-    server = LSDaemonServer((host, port), encoding=encoding)
-    server.serve_forever()
+    if emulate is not None:
+        emulator.enable(emulate)
+
+    kwargs = {'encoding': encoding, 'idle_timeout': idle_timeout,
+              'pipeline': pipeline, 'max_queue': max_queue,
+              'deadline': deadline, 'framebuffer': framebuffer,
+              'max_connections': max_connections,
+              'connection_queue': connection_queue,
+              'read_timeout': read_timeout,
+              'keepalive_timeout': keepalive_timeout, 'backlog': backlog,
+              'cache_size': cache_size, 'cache_ttl': cache_ttl}
+    servers = []
+    # Servers other than the first are served from their own threads.
+    threaded = []
+    try:
+        if not no_tcp:
+            servers.append(LSDaemonServer((host, port), **kwargs))
+        if unix_socket is not None:
+            share_with = servers[0] if servers else None
+            servers.append(LSDaemonUnixServer(
+                unix_socket, unix_socket_mode, share_with=share_with,
+                **kwargs))
+        for server in servers[1:]:
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            threaded.append(server)
+        servers[0].serve_forever()
+    except KeyboardInterrupt:
+        logger.info('Shutting down')
+    finally:
+        for server in threaded:
+            server.shutdown()
+        # The first server owns the device, it goes last.
+        for server in reversed(servers):
+            server.server_close()
 
 
 def main():
     parser = argparse.ArgumentParser(
-        description='Alienware lights control daemon driver')
+        description='Alienware lights control daemon driver',
+        parents=[emulator.argument_parser()])
     parser.add_argument('-i', '--host', default='',
                         help='Host (defaults localhost).')
     parser.add_argument('-e', '--encoding', default='utf-8',
                         choices=['utf-8', 'latin-1'], help='Data encoding.')
+    parser.add_argument('-t', '--idle-timeout', default=DEFAULT_IDLE_TIMEOUT,
+                        type=float,
+                        help=('Seconds to keep the device claimed without '
+                              'requests, 0 is forever (defaults to %s).' %
+                              DEFAULT_IDLE_TIMEOUT))
+    parser.add_argument('-q', '--max-queue', default=DEFAULT_QUEUE_DEPTH,
+                        type=int,
+                        help=('Requests waiting for the device before new '
+                              'ones get rejected (defaults to %s).' %
+                              DEFAULT_QUEUE_DEPTH))
+    parser.add_argument('-d', '--deadline', default=DEFAULT_REQUEST_DEADLINE,
+                        type=float,
+                        help=('Seconds a request may wait for the device, 0 '
+                              'is forever (defaults to %s).' %
+                              DEFAULT_REQUEST_DEADLINE))
     parser.add_argument('-l', '--log-level', default='info',
                         choices=['debug', 'info', 'warn', 'error', 'critical'],
                         help='Set logging level.')
     parser.add_argument('-p', '--port', action='store', default=DEFAULT_PORT,
                         type=int, help='Port (defaults to %s).' % DEFAULT_PORT)
+    parser.add_argument('-w', '--pipeline', nargs='?', type=int, default=0,
+                        const=PIPELINE_SYNC_EVERY, metavar='N',
+                        help=('Send commands write-only, checking device '
+                              'status every N packets (defaults to %s).' %
+                              PIPELINE_SYNC_EVERY))
+    parser.add_argument('-u', '--unix-socket', nargs='?', default=None,
+                        const=DEFAULT_UNIX_SOCKET, metavar='PATH',
+                        help=('Listen on a Unix socket too (defaults to '
+                              '%s).' % DEFAULT_UNIX_SOCKET))
+    parser.add_argument('-U', '--unix-socket-mode',
+                        default=DEFAULT_UNIX_SOCKET_MODE,
+                        type=lambda mode: int(mode, 8), metavar='MODE',
+                        help=('Unix socket permissions in octal (defaults '
+                              'to %o).' % DEFAULT_UNIX_SOCKET_MODE))
+    parser.add_argument('-n', '--no-tcp', action='store_true', default=False,
+                        help='Only listen on the Unix socket.')
+    parser.add_argument('-f', '--framebuffer', nargs='?', default=None,
+                        const=DEFAULT_FRAMEBUFFER, metavar='PATH',
+                        help=('Apply frames written to a shared memory frame '
+                              'buffer (defaults to %s).' %
+                              DEFAULT_FRAMEBUFFER))
+    parser.add_argument('-c', '--max-connections',
+                        default=DEFAULT_MAX_CONNECTIONS, type=int,
+                        help=('Connections served at once (defaults to %s).' %
+                              DEFAULT_MAX_CONNECTIONS))
+    parser.add_argument('-Q', '--connection-queue',
+                        default=DEFAULT_CONNECTION_QUEUE, type=int,
+                        help=('Connections waiting to be served before new '
+                              'ones get rejected (defaults to %s).' %
+                              DEFAULT_CONNECTION_QUEUE))
+    parser.add_argument('-r', '--read-timeout', default=DEFAULT_READ_TIMEOUT,
+                        type=float,
+                        help=('Seconds to wait for data from a client, 0 is '
+                              'forever (defaults to %s).' %
+                              DEFAULT_READ_TIMEOUT))
+    parser.add_argument('-k', '--keepalive-timeout',
+                        default=DEFAULT_KEEPALIVE_TIMEOUT, type=float,
+                        help=('Seconds a connection may be idle between '
+                              'requests, 0 is the read timeout (defaults to '
+                              '%s).' % DEFAULT_KEEPALIVE_TIMEOUT))
+    parser.add_argument('-b', '--backlog', default=DEFAULT_ACCEPT_BACKLOG,
+                        type=int,
+                        help=('Connections the OS queues until accepted '
+                              '(defaults to %s).' % DEFAULT_ACCEPT_BACKLOG))
+    parser.add_argument('-C', '--cache-size',
+                        default=DEFAULT_PROGRAM_CACHE_SIZE, type=int,
+                        help=('Compiled programs kept for repeated requests, '
+                              '0 disables the cache (defaults to %s).' %
+                              DEFAULT_PROGRAM_CACHE_SIZE))
+    parser.add_argument('-T', '--cache-ttl', default=DEFAULT_PROGRAM_CACHE_TTL,
+                        type=float,
+                        help=('Seconds compiled programs are kept, 0 is '
+                              'forever (defaults to %s).' %
+                              DEFAULT_PROGRAM_CACHE_TTL))
     parser.add_argument('-v', '--verbosity', choices=['simple', 'verbose'],
                         default='simple', help='Set verbosity of logs.')
 
-    lsdaemon(**vars(parser.parse_args()))
+    args = parser.parse_args()
+    if args.max_connections < 1:
+        parser.error('--max-connections must be at least 1')
+    if args.no_tcp and args.unix_socket is None:
+        parser.error('--no-tcp requires --unix-socket')
+    lsdaemon(**vars(args))
 
 
 if __name__ == "__main__":
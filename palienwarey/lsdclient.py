@@ -1,58 +1,287 @@
 # -*- coding: utf-8 -*-
 import json
+import os
 import socket
+import threading
 
-from .constants import (ERROR_CANNOT_CONNECT, ERROR_BAD_HEADER,
+from .constants import (SUCCESS, DEFAULT_HOST, DEFAULT_PORT,
+                        DEFAULT_UNIX_SOCKET, DESCRIPTION_CACHE_DIR,
+                        ERROR_BUSY, ERROR_CANNOT_CONNECT, ERROR_BAD_HEADER,
                         ERROR_BAD_RESPONSE_JSON, ERROR_CANNOT_SEND_DATA)
+from . import binary, framing
+from .framing import FrameError, FrameReader, decode_json, encode_frame
 from .logconf import logger
-from .lsdaemon import DEFAULT_HOST, DEFAULT_PORT, HEADER_LENGTH, protocol
 
 
 __all__ = ['ERROR_CANNOT_CONNECT', 'ERROR_BAD_HEADER',
            'ERROR_BAD_RESPONSE_JSON', 'ERROR_CANNOT_SEND_DATA',
-           'send_request', 'ping', 'send']
+           'encode_request', 'LSDClient', 'get_client', 'send_request',
+           'ping', 'send', 'state', 'stats', 'describe']
 
 
-def send_request(host=DEFAULT_HOST, port=DEFAULT_PORT, method='ping',
-                 args=None):
+# Hosts for which the Unix socket can be used
+LOCAL_HOSTS = ('', 'localhost', '127.0.0.1', '::1')
+
+
+def encode_request(method, args=None, request_id=None):
     """
-    Sends requests to lsdaemon and returns the loaded JSON response.
+    Returns the framed request for method with args.
+
+    A request is a string with the form 'METHOD[#ID] [JSON_ARGS]' prefixed
+    by a header with its length in hex. The daemon echoes ID back in the
+    response, which allows matching pipelined requests.
     """
-    # A request is a string with the form 'METHOD JSON_ARGS'.
+    if request_id is not None:
+        method = '%s#%s' % (method, request_id)
     if args is not None:
-        json_args = json.dumps(args)
-        data = method + ' ' + json_args
+        data = method + ' ' + json.dumps(args)
     else:
         data = method
+    return encode_frame(data)
 
-    # The header just contains the size of request in hex.
-    header = "%.6x" % len(data)
-    request = header + data
 
+def _read_description(path):
     try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect((host, port))
-    except socket.error:
-        return protocol.response(ERROR_CANNOT_CONNECT)
+        with open(path) as cache_file:
+            return json.load(cache_file)
+    except (IOError, OSError, ValueError):
+        return None
 
-    try:
-        sock.send(request)
-    except Exception as e:
-        logger.exception(e)
-        return protocol.response(ERROR_CANNOT_SEND_DATA)
 
+def _write_description(path, description):
     try:
-        # The response is pretty much like the request: a header with the
-        # length of the payload in hex and the payload.
-        length = int(sock.recv(HEADER_LENGTH), 16)
-    except ValueError:
-        return protocol.response(ERROR_BAD_HEADER)
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        with open(path, 'w') as cache_file:
+            json.dump(description, cache_file)
+    except (IOError, OSError) as e:
+        logger.debug('Cannot write description cache %s: %s', path, e)
+
+
+class LSDClient(object):
+    """
+    lsdaemon client keeping connections open between requests.
+
+    The daemon serves any number of requests per connection, so up to
+    pool_size idle connections are kept around and reused instead of
+    paying a TCP handshake per request. It is safe to use from several
+    threads, each request taking a connection for itself.
+
+    With binary set, requests are sent using the compact binary encoding
+    (see the binary module) whenever they can be encoded with it, and JSON
+    otherwise.
+
+    When host is local and the daemon listens on the unix_socket path, it
+    is used instead of TCP. Without unix_socket, the default one is only
+    tried for the default port, as a daemon on another port is most likely
+    not the one behind it.
+    """
+
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, pool_size=2,
+                 binary=False, unix_socket=None):
+        self.host = host
+        self.port = port
+        self.pool_size = pool_size
+        self.binary = binary
+        if unix_socket is None and port == DEFAULT_PORT:
+            unix_socket = DEFAULT_UNIX_SOCKET
+        self.unix_socket = unix_socket if host in LOCAL_HOSTS else None
+        self.pool = []
+        self.lock = threading.Lock()
+
+    def connect(self):
+        """
+        Returns a FrameReader for a new connection to the daemon.
+        """
+        if self.unix_socket and os.path.exists(self.unix_socket):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.unix_socket)
+                return FrameReader(sock)
+            except socket.error as e:
+                sock.close()
+                logger.debug('Cannot connect to %s, using TCP: %s',
+                             self.unix_socket, e)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.connect((self.host, self.port))
+        except socket.error:
+            sock.close()
+            raise
+        return FrameReader(sock)
+
+    def acquire(self):
+        """
+        Returns a (reader, pooled) tuple, pooled being True when the
+        connection was taken from the pool rather than just connected.
+        """
+        with self.lock:
+            if self.pool:
+                return self.pool.pop(), True
+        return self.connect(), False
+
+    def release(self, reader):
+        with self.lock:
+            if len(self.pool) < self.pool_size:
+                self.pool.append(reader)
+                return
+        reader.sock.close()
+
+    def close(self):
+        with self.lock:
+            pool, self.pool = self.pool, []
+        for reader in pool:
+            reader.sock.close()
+
+    def request(self, method='ping', args=None, request_id=None):
+        """
+        Sends a request to lsdaemon and returns the loaded JSON response.
+        """
+        return self.pipeline([(method, args)], request_id)[0]
+
+    def pipeline(self, requests, first_id=None):
+        """
+        Sends all (method, args) requests in one go over one connection and
+        returns their responses in the same order.
+
+        Requests are numbered starting at first_id (when given) and the
+        daemon tags every response with its request id.
+        """
+        data = ''.join(
+            self.encode_request(method, args,
+                                None if first_id is None else first_id + i)
+            for i, (method, args) in enumerate(requests))
+
+        try:
+            reader, pooled = self.acquire()
+        except socket.error:
+            return [framing.response(ERROR_CANNOT_CONNECT)] * len(requests)
+
+        sock = reader.sock
+        try:
+            sock.sendall(data)
+        except socket.error as e:
+            sock.close()
+            if pooled:
+                # The daemon might have dropped the idle connection.
+                return self.pipeline(requests, first_id)
+            logger.exception(e)
+            return [framing.response(ERROR_CANNOT_SEND_DATA)] * len(requests)
+
+        responses = []
+        for _ in requests:
+            response = self.read_response(reader)
+            if response is None:
+                sock.close()
+                if pooled and not responses:
+                    # Closed by the daemon while idle, nothing was served.
+                    return self.pipeline(requests, first_id)
+                break
+            responses.append(response)
+            if response.get('code') == ERROR_BUSY:
+                # Turned away by the daemon, none of the requests is served.
+                sock.close()
+                responses = [response] * len(requests)
+                break
+            if response.get('code') in (ERROR_BAD_HEADER,
+                                        ERROR_BAD_RESPONSE_JSON):
+                # Out of sync with the daemon, drop the connection.
+                sock.close()
+                break
+        else:
+            self.release(reader)
+        while len(responses) < len(requests):
+            responses.append(framing.response(ERROR_BAD_HEADER))
+        return responses
+
+    def encode_request(self, method, args=None, request_id=None):
+        if self.binary:
+            try:
+                return encode_frame(
+                    binary.encode_request(method, args, request_id))
+            except ValueError as e:
+                logger.debug('Sending %s as JSON: %s', method, e)
+        return encode_request(method, args, request_id)
+
+    def read_response(self, reader):
+        """
+        Reads a response, returns None if the daemon closed the connection.
+        """
+        try:
+            # The response is pretty much like the request: a header with
+            # the length of the payload in hex and the payload.
+            frame = reader.read_frame()
+        except (FrameError, socket.error):
+            return framing.response(ERROR_BAD_HEADER)
+        if frame is None:
+            return None
+
+        try:
+            # Consume the payload and return.
+            if binary.is_binary(frame):
+                return binary.decode_response(frame)
+            return decode_json(frame)
+        except ValueError:
+            return framing.response(ERROR_BAD_RESPONSE_JSON)
+
+    def ping(self):
+        return self.request('ping')
 
+    def send(self, args):
+        return self.request('send', args)
+
+    def state(self):
+        return self.request('state')
+
+    def stats(self):
+        return self.request('stats')
+
+    def describe(self, uid=None, definition=None,
+                 cache_dir=DESCRIPTION_CACHE_DIR):
+        """
+        Requests the description of the machine served by the daemon.
+
+        When uid and definition (its definition hash) are given, as replied
+        by ping, the description is cached in cache_dir for the daemon
+        address and both, so later calls do not need to ask the daemon
+        until the machine definition changes.
+        """
+        path = None
+        if uid is not None and definition and cache_dir:
+            path = os.path.join(cache_dir, '%s-%s-%.4x-%s.json' %
+                                (self.host or 'localhost', self.port, uid,
+                                 definition[:16]))
+            description = _read_description(path)
+            if description is not None and description.get('uid') == uid:
+                return framing.response(SUCCESS, description)
+        response = self.request('describe')
+        if path is not None and response['success']:
+            _write_description(path, response['data'])
+        return response
+
+
+_clients = {}
+
+
+def get_client(host=DEFAULT_HOST, port=DEFAULT_PORT):
+    """
+    Returns the shared LSDClient for host and port.
+    """
     try:
-        # Consume the payload and return.
-        return json.loads(sock.recv(length))
-    except ValueError:
-        return protocol.response(ERROR_BAD_RESPONSE_JSON)
+        return _clients[(host, port)]
+    except KeyError:
+        return _clients.setdefault((host, port), LSDClient(host, port))
+
+
+def send_request(host=DEFAULT_HOST, port=DEFAULT_PORT, method='ping',
+                 args=None):
+    """
+    Sends requests to lsdaemon and returns the loaded JSON response.
+
+    Connections are reused between calls, see LSDClient.
+    """
+    return get_client(host, port).request(method, args)
 
 
 def ping(host, port):
@@ -67,3 +296,24 @@ def send(host, port, args):
     Simple wrapper around send_request for sending device requests.
     """
     return send_request(host, port, 'send', args)
+
+
+def state(host, port):
+    """
+    Simple wrapper around send_request for getting the device shadow state.
+    """
+    return send_request(host, port, 'state')
+
+
+def stats(host, port):
+    """
+    Simple wrapper around send_request for getting daemon stats.
+    """
+    return send_request(host, port, 'stats')
+
+
+def describe(host, port):
+    """
+    Simple wrapper around send_request for getting the machine description.
+    """
+    return send_request(host, port, 'describe')
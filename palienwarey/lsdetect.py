@@ -4,6 +4,7 @@ import sys
 
 from usb.core import USBError, find
 
+from . import emulator
 from .constants import (
     RESET_ALL_LIGHTS_ON, RESET_ALL_LIGHTS_OFF, VENDOR_ID, LEDS_TO_SCAN,
     SUCCESS, ERROR_DEVICE_NOT_FOUND, ERROR_DEVICE_CANNOT_TAKE_OVER,
@@ -53,15 +54,20 @@ def y_or_n(prompt, default=False, yes="y", no="n"):
     return not opt == no
 
 
-def lsdetect(color='ffffff', log_level='info', verbosity='simple'):
+def lsdetect(color='ffffff', emulate=None, log_level='info',
+             verbosity='simple'):
     """
     Alienware detection tool for the masses.
 
-    Use this to find out your led addresses.
+    Use this to find out your led addresses. When emulate is a product id,
+    an emulated device is used instead of real hardware.
     """
     set_log_level(log_level)
     set_log_formatter(verbosity)
 
+    if emulate is not None:
+        emulator.enable(emulate)
+
     try:
         machine = get_machine()
         logger.info('Detected %s', machine['name'])
@@ -78,7 +84,10 @@ def lsdetect(color='ffffff', log_level='info', verbosity='simple'):
             except KeyboardInterrupt:
                 logger.info('kthxbye')
                 return SUCCESS
-        device = find(idVendor=VENDOR_ID, idProduct=product_id)
+        if emulator.enabled():
+            device = emulator.find(product_id)
+        else:
+            device = find(idVendor=VENDOR_ID, idProduct=product_id)
         if device is None:
             return log_error_code(ERROR_DEVICE_NOT_FOUND)
 
@@ -145,7 +154,8 @@ def lsdetect(color='ffffff', log_level='info', verbosity='simple'):
 
 def main():
     parser = argparse.ArgumentParser(
-        description='Alienware led detection and testing tool')
+        description='Alienware led detection and testing tool',
+        parents=[emulator.argument_parser()])
     parser.add_argument('-c', '--color', default='ffffff',
                         help='Color to test.')
     parser.add_argument('-l', '--log-level', default='info',
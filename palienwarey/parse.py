@@ -11,7 +11,7 @@ from .constants import (
 
 __all__ = ['ALL_ZONES_UID', 'STRING_CMD_MAP', 'AppendZoneAction',
            'parse_color', 'parse_cmd', 'parse_zones',
-           'flatten_group_zones', 'merge_zones', 'parse']
+           'flatten_group_zones', 'merge_zones', 'coalesce_zones', 'parse']
 
 
 class AppendZoneAction(Action):
@@ -184,6 +184,46 @@ def merge_zones(machine, zones_cmd_set, cascade=False):
     return merged
 
 
+def coalesce_zones(machine, zones_cmd_set):
+    """
+    Combines zones sharing the exact same commands into single zone masks.
+
+    The protocol addresses zones by the sum of their uids, so zones with the
+    same loop can be sent as one loop instead of one per zone. Since big
+    sums don't work reliably on some machines, at most the machine's
+    max_mask_width zones are combined together. Power zones are never
+    combined since they might have special rules.
+
+    Arguments:
+      + machine: a machine dict as returned by ``defines.get_machine``.
+      + zones_cmd_set: a merged zones_cmd_set as returned by ``parse``.
+
+    Returns a zones_cmd_set where the uid of combined zones is a tuple with
+    all their uids, in order of first appearance.
+    """
+    width = machine['max_mask_width']
+    coalesced = []
+    cmds_idx = {}
+    for zone_cmds in zones_cmd_set:
+        uid = zone_cmds[0]
+        cmds = tuple(zone_cmds[1:])
+        zone = machine['zones_by_uid'].get(uid)
+        if zone is None or zone['is_power'] or zone['is_group']:
+            coalesced.append(list(zone_cmds))
+            continue
+        idx = cmds_idx.get(cmds)
+        if idx is not None and len(coalesced[idx][0]) < width:
+            coalesced[idx][0] += (uid,)
+        else:
+            cmds_idx[cmds] = len(coalesced)
+            coalesced.append([(uid,)] + list(cmds))
+    for zone_cmds in coalesced:
+        uids = zone_cmds[0]
+        if isinstance(uids, tuple) and len(uids) == 1:
+            zone_cmds[0] = uids[0]
+    return coalesced
+
+
 def parse(machine, zones_cmd_set, cascade=False):
     """
     Parses the list of zones with commands in string format.
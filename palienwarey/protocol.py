@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 import collections
+import logging
+import struct
 import time
 
 from usb.core import USBError
@@ -13,20 +15,29 @@ from .constants import (
     SEND_REQUEST, SEND_VALUE, SEND_INDEX, START_BYTE, FILL_BYTE, DATA_LENGTH,
     CMD_SET_COLOR, CMD_SET_MORPH, CMD_SET_PULSE, CMD_GET_STATUS, CMD_END_LOOP,
     CMD_SET_SPEED, CMD_RESET, CMD_SAVE, CMD_SET_MODE, CMD_TRANSMIT_EXECUTE,
-    STATUS_OK, ZONE_MAX_CONFIGURATIONS, MAX_SPEED, RESET_ALL_LIGHTS_ON,
-    WAIT_FOR_OK_SLEEP, WAIT_FOR_OK_MAX_TRIES, SUCCESS, ERROR_DEVICE_NOT_FOUND,
+    STATUS_OK, STATE_BUSY, ZONE_MAX_CONFIGURATIONS, MAX_SPEED,
+    RESET_ALL_LIGHTS_ON, WAIT_FOR_OK_FIRST_SLEEP, WAIT_FOR_OK_MAX_SLEEP,
+    WAIT_FOR_OK_BACKOFF, WAIT_FOR_OK_DEADLINE, WAIT_FOR_OK_RESET_AFTER_BUSY,
+    PIPELINE_SYNC_EVERY, ZONE_BYTES_CACHE_SIZE, SUCCESS,
+    ERROR_DEVICE_NOT_FOUND,
     ERROR_DEVICE_CANNOT_TAKE_OVER, ERROR_DEVICE_TIMEOUT)
+from .stats import clock, LatencyHistogram
 
 
-__all__ = ['connect', 'read', 'write', 'send_request', 'bytes_zone',
-           'defpacket', 'packet_set_color', 'packet_set_morph',
+__all__ = ['connect', 'read', 'write', 'send_request', 'Pipeline',
+           'PIPELINE_SYNC_EVERY', 'bytes_zone',
+           'defpacket', 'pack_color', 'pack_morph', 'pack_template',
+           'pack_args', 'packet_set_color', 'packet_set_morph',
            'packet_set_pulse', 'packet_get_status', 'packet_end_loop',
            'packet_set_speed', 'packet_reset', 'packet_save',
            'packet_set_mode', 'packet_transmit_execute',
-           'STATUS_OK', 'wait_ok', 'cmd_set_color', 'cmd_set_morph',
+           'STATUS_OK', 'WaitPolicy', 'get_wait_policy', 'set_wait_policy',
+           'wait_ok', 'cmd_set_color', 'cmd_set_morph',
            'cmd_set_pulse', 'cmd_get_status', 'cmd_end_loop', 'cmd_set_speed',
            'cmd_reset', 'cmd_transmit_execute', 'cmd_save', 'cmd_set_mode',
-           'CMD_FN_MAP', 'send_for_mode', 'send']
+           'CMD_FN_MAP', 'PACKET_FN_MAP', 'compile_for_mode',
+           'optimize_stream', 'transmit', 'send_for_mode', 'compile_program',
+           'send_stream', 'send_program', 'replay', 'send']
 
 
 def connect(device):
@@ -85,14 +96,73 @@ def write(device, packet):
 def send_request(device, packet):
     """
     Writes to device the given packet, waits for response and returns it.
+
+    When device is a Pipeline the request is delegated to it.
     """
-    logger.debug('Sending packet: %s' % packet)
+    if isinstance(device, Pipeline):
+        return device.send_request(packet)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('Sending packet: %s', list(packet))
     write(device, packet)
     response = read(device, packet)
     logger.debug(response)
     return response
 
 
+class Pipeline(object):
+    """
+    Write-only transfer mode for a device.
+
+    Reading a reply after every packet doubles the control transfers, while
+    only status checks really need one. A Pipeline wraps a device and can be
+    used anywhere a device is expected by the cmd_* functions: packets are
+    written without reading back and the device status is only checked at
+    synchronization points, that is before cmd_transmit_execute, after
+    cmd_save and every sync_every packets.
+
+    Synchronization points use wait_ok without resets, so a device not
+    replying STATUS_OK in time raises USBError.
+    """
+
+    def __init__(self, device, sync_every=PIPELINE_SYNC_EVERY):
+        self.device = device
+        self.sync_every = sync_every
+        self.pending = 0
+
+    def send_request(self, packet):
+        """
+        Writes the given packet, syncing when needed.
+
+        Returns the device response for status requests, None otherwise.
+        """
+        cmd = packet[1]
+        if cmd == CMD_GET_STATUS:
+            self.pending = 0
+            return send_request(self.device, packet)
+        if cmd == CMD_TRANSMIT_EXECUTE:
+            self.sync()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Sending packet (pipelined): %s', list(packet))
+        write(self.device, packet)
+        self.pending += 1
+        if cmd == CMD_SAVE or \
+           (self.sync_every and self.pending >= self.sync_every):
+            self.sync()
+
+    def sync(self):
+        """
+        Waits for the device to process all packets written so far.
+        """
+        if not self.pending:
+            return
+        wait_ok(self.device, reset=False)
+        self.pending = 0
+
+
+# Zone masks (or tuples of uids) to packet bytes, see bytes_zone.
+_zone_bytes = {}
+
+
 def bytes_zone(zone_ids):
     """
     Returns packet bytes for the given zone_ids.
@@ -113,6 +183,11 @@ def bytes_zone(zone_ids):
     Returns a bytes triplet elegible to be used in packets to mark the desired
     zones to affect.
     """
+    try:
+        return _zone_bytes[zone_ids]
+    except (KeyError, TypeError):
+        # Not seen before or not hashable (a list).
+        pass
     if isinstance(zone_ids, collections.Iterable):
         # Several zones can be affected at the same time, in that case the
         # packet part where the zone is described is just the sum of all
@@ -122,15 +197,22 @@ def bytes_zone(zone_ids):
         # For a single zone it might be handy to not have to wrap it over an
         # interable.
         zones = zone_ids
-    first_two = int(zones / 65536)
-    next_two = int(zones / 256) - int(first_two * 256)
-    last_two = zones - first_two * 65536 - next_two * 256
-    return (first_two, next_two, last_two)
+    triplet = (zones >> 16, (zones >> 8) & 0xff, zones & 0xff)
+    # Bounded, masks might come from the network through lsdaemon.
+    if len(_zone_bytes) < ZONE_BYTES_CACHE_SIZE:
+        try:
+            _zone_bytes[zone_ids] = triplet
+        except TypeError:
+            pass
+    return triplet
 
 
 def defpacket(cmd, *args):
     """
     Constructs a packet of DATA_LENGTH from args.
+
+    This is the generic (and slow) way of building packets, packet_*
+    functions use precomputed templates and structs instead.
     """
     contents = [START_BYTE, cmd]
     for arg in args:
@@ -141,6 +223,57 @@ def defpacket(cmd, *args):
     return contents
 
 
+# Every packet is START_BYTE, the command and up to 7 bytes of arguments.
+_packet_struct = struct.Struct('%dB' % DATA_LENGTH)
+
+# Templates for packets without arguments.
+_packet_templates = dict(
+    (cmd, bytes(bytearray(defpacket(cmd))))
+    for cmd in (CMD_GET_STATUS, CMD_END_LOOP, CMD_SAVE, CMD_TRANSMIT_EXECUTE))
+
+
+def pack_color(buf, offset, cmd, idx, zones, color):
+    """
+    Writes a set_color or set_pulse (as of cmd) packet into buf at offset.
+
+    Arguments are the same as packet_set_color.
+    """
+    zone_bytes = bytes_zone(zones)
+    _packet_struct.pack_into(
+        buf, offset, START_BYTE, cmd, idx, zone_bytes[0], zone_bytes[1],
+        zone_bytes[2], color[0], color[1], FILL_BYTE)
+
+
+def pack_morph(buf, offset, idx, zones, color1, color2):
+    """
+    Writes a set_morph packet into buf at offset.
+
+    Arguments are the same as packet_set_morph.
+    """
+    zone_bytes = bytes_zone(zones)
+    _packet_struct.pack_into(
+        buf, offset, START_BYTE, CMD_SET_MORPH, idx, zone_bytes[0],
+        zone_bytes[1], zone_bytes[2], color1[0], color1[1] + color2[0],
+        color2[1])
+
+
+def pack_template(buf, offset, cmd):
+    """
+    Writes a packet without arguments for cmd into buf at offset.
+    """
+    buf[offset:offset + DATA_LENGTH] = _packet_templates[cmd]
+
+
+def pack_args(buf, offset, cmd, *args):
+    """
+    Writes a packet for cmd with up to 7 single byte args into buf at
+    offset.
+    """
+    _packet_struct.pack_into(
+        buf, offset, START_BYTE, cmd,
+        *(args + (FILL_BYTE,) * (DATA_LENGTH - 2 - len(args))))
+
+
 def packet_set_color(idx, zones, color):
     """
     Returns a packet for the set_color command.
@@ -150,7 +283,9 @@ def packet_set_color(idx, zones, color):
       + zones: is either a zone uid or a sum of all uids to be affected.
       + color: is a color as returned by parse_color.
     """
-    return defpacket(CMD_SET_COLOR, [idx], bytes_zone(zones), color)
+    packet = bytearray(DATA_LENGTH)
+    pack_color(packet, 0, CMD_SET_COLOR, idx, zones, color)
+    return packet
 
 
 def packet_set_morph(idx, zones, color1, color2):
@@ -163,9 +298,9 @@ def packet_set_morph(idx, zones, color1, color2):
       + color1: is a color as returned by parse_color.
       + color2: is a color as returned by parse_color with first=False.
     """
-    color12 = color1[1] + color2[0]
-    return defpacket(CMD_SET_MORPH, [idx], bytes_zone(zones),
-                     [color1[0]], [color12], [color2[1]])
+    packet = bytearray(DATA_LENGTH)
+    pack_morph(packet, 0, idx, zones, color1, color2)
+    return packet
 
 
 def packet_set_pulse(idx, zones, color):
@@ -177,21 +312,23 @@ def packet_set_pulse(idx, zones, color):
       + zones: is either a zone uid or a sum of all uids to be affected.
       + color: is a color as returned by parse_color.
     """
-    return defpacket(CMD_SET_PULSE, [idx], bytes_zone(zones), color)
+    packet = bytearray(DATA_LENGTH)
+    pack_color(packet, 0, CMD_SET_PULSE, idx, zones, color)
+    return packet
 
 
 def packet_get_status():
     """
     Returns a packet for the get_status command.
     """
-    return defpacket(CMD_GET_STATUS)
+    return bytearray(_packet_templates[CMD_GET_STATUS])
 
 
 def packet_end_loop():
     """
     Returns a packet for the end_loop command.
     """
-    return defpacket(CMD_END_LOOP)
+    return bytearray(_packet_templates[CMD_END_LOOP])
 
 
 def packet_set_speed(speed):
@@ -201,8 +338,9 @@ def packet_set_speed(speed):
     Arguments:
       + speed: integer to be used to set theme speed (max 65535).
     """
-    return defpacket(CMD_SET_SPEED, [FILL_BYTE],
-                     [int(speed / 256)], [int(speed - (speed / 256) * 256)])
+    packet = bytearray(DATA_LENGTH)
+    pack_args(packet, 0, CMD_SET_SPEED, FILL_BYTE, speed >> 8, speed & 0xff)
+    return packet
 
 
 def packet_reset(type_=RESET_ALL_LIGHTS_ON):
@@ -215,14 +353,16 @@ def packet_reset(type_=RESET_ALL_LIGHTS_ON):
         one of RESET_TOUCH_CONTROLS, RESET_SLEEP_LIGHTS_ON,
         RESET_ALL_LIGHTS_ON, RESET_ALL_LIGHTS_OFF.
     """
-    return defpacket(CMD_RESET, [type_])
+    packet = bytearray(DATA_LENGTH)
+    pack_args(packet, 0, CMD_RESET, type_)
+    return packet
 
 
 def packet_save():
     """
     Returns a packet for the save command.
     """
-    return defpacket(CMD_SAVE)
+    return bytearray(_packet_templates[CMD_SAVE])
 
 
 def packet_set_mode(mode):
@@ -232,31 +372,110 @@ def packet_set_mode(mode):
     Arguments:
       + mode: the mode for which current configuration must be saved.
     """
-    return defpacket(CMD_SET_MODE, [mode])
+    packet = bytearray(DATA_LENGTH)
+    pack_args(packet, 0, CMD_SET_MODE, mode)
+    return packet
 
 
 def packet_transmit_execute():
     """
     Returns a packet for the trasmit_execute command.
     """
-    return defpacket(CMD_TRANSMIT_EXECUTE)
+    return bytearray(_packet_templates[CMD_TRANSMIT_EXECUTE])
+
+
+class WaitPolicy(object):
+    """
+    Controls how wait_ok polls the device.
+
+    The first poll is immediate, after that the sleep between polls starts
+    at first_sleep and is multiplied by backoff after every miss, up to
+    max_sleep. Polling stops once deadline seconds have passed.
+
+    Sending resets to a busy device just floods the bus, so they are only
+    sent after reset_after_busy STATE_BUSY replies (0 disables them). Any
+    other non OK reply (like STATE_UNKNOWN_COMMAND) resets right away.
+
+    Every wait is recorded in histogram, see ``stats.LatencyHistogram``.
+    """
+
+    def __init__(self, first_sleep=WAIT_FOR_OK_FIRST_SLEEP,
+                 max_sleep=WAIT_FOR_OK_MAX_SLEEP, backoff=WAIT_FOR_OK_BACKOFF,
+                 deadline=WAIT_FOR_OK_DEADLINE,
+                 reset_after_busy=WAIT_FOR_OK_RESET_AFTER_BUSY):
+        self.first_sleep = first_sleep
+        self.max_sleep = max_sleep
+        self.backoff = backoff
+        self.deadline = deadline
+        self.reset_after_busy = reset_after_busy
+        self.histogram = LatencyHistogram()
+
+    def sleeps(self):
+        """
+        Yields the time to sleep after each miss.
+        """
+        sleep = self.first_sleep
+        while True:
+            yield sleep
+            sleep = min(sleep * self.backoff, self.max_sleep)
+
+
+_wait_policy = WaitPolicy()
+
+
+def get_wait_policy():
+    """
+    Returns the WaitPolicy used by default by wait_ok.
+    """
+    return _wait_policy
+
+
+def set_wait_policy(policy):
+    """
+    Sets the WaitPolicy used by default by wait_ok.
+    """
+    global _wait_policy
+    _wait_policy = policy
 
 
-def wait_ok(device):
+def wait_ok(device, policy=None, reset=True):
     """
     Waits for USB device to be responsive.
+
+    Arguments:
+      + device: the device to poll.
+      + policy: a WaitPolicy, defaults to the one from get_wait_policy.
+      + reset: when False never send resets, even if the policy says so.
+         Useful when waiting for sent commands to be processed.
+
+    Raises:
+      + USBError: if no OK reply is received before the policy deadline.
     """
-    i = 0
-    while True:
+    if policy is None:
+        policy = _wait_policy
+
+    start = clock()
+    busy = 0
+    for sleep in policy.sleeps():
         status = cmd_get_status(device)[0]
         logger.debug('Waiting for ok, got: 0x%x', status)
         if status == STATUS_OK:
-            break
-        send_request(device, packet_reset(RESET_ALL_LIGHTS_ON))
-        i += 1
-        time.sleep(WAIT_FOR_OK_SLEEP)
-        if i > WAIT_FOR_OK_MAX_TRIES:
+            policy.histogram.add(clock() - start)
+            return
+
+        if status == STATE_BUSY:
+            busy += 1
+        if reset and (status != STATE_BUSY or
+                      (policy.reset_after_busy and
+                       busy >= policy.reset_after_busy)):
+            send_request(device, packet_reset(RESET_ALL_LIGHTS_ON))
+            busy = 0
+
+        elapsed = clock() - start
+        if elapsed + sleep > policy.deadline:
+            policy.histogram.add(elapsed, failed=True)
             raise USBError("Device timeout: No OK reply received.")
+        time.sleep(sleep)
 
 
 def _log_color_command(cmd, idx, zones, color1, color2=None):
@@ -385,64 +604,94 @@ CMD_FN_MAP = {
     CMD_SET_MORPH: cmd_set_morph,
     CMD_SET_PULSE: cmd_set_pulse
 }
+PACKET_FN_MAP = {
+    CMD_SET_COLOR: packet_set_color,
+    CMD_SET_MORPH: packet_set_morph,
+    CMD_SET_PULSE: packet_set_pulse
+}
 
 
-def send_for_mode(machine=None, zones=tuple(), mode=None, speed=MAX_SPEED):
+def _get_zone(machine, zone_uid):
     """
-    Sends commands to the device for given mode.
+    Returns the zone for zone_uid, which can also be a list of uids for
+    zones combined by ``parse.coalesce_zones``. The capabilities of such
+    combined zone are the ones shared by all of them.
+
+    Raises:
+      + KeyError: if any of the uids is not a zone of the machine.
+    """
+    zones_by_uid = machine['zones_by_uid']
+    if not isinstance(zone_uid, (list, tuple)):
+        return zones_by_uid[zone_uid]
+    zones = [zones_by_uid[uid] for uid in zone_uid]
+    return {
+        'uid': tuple(zone_uid),
+        'can_morph': all(zone['can_morph'] for zone in zones),
+        'can_pulse': all(zone['can_pulse'] for zone in zones)
+    }
+
+
+def compile_for_mode(machine, zones=tuple(), mode=None, speed=MAX_SPEED,
+                     only=None):
+    """
+    Compiles zone commands for given mode into a stream of packets.
+
+    The stream is a list of packets where mode changes are explicit state
+    transitions: a set_mode packet precedes the speed packet, every color
+    command and every end_loop, just like the protocol expects when sending
+    commands one by one. Use ``optimize_stream`` to drop the redundant ones.
 
     Any invalid command, zone uid or speed provided will not result into an
     error but just a warning.
 
-    Arguments:
-      + machine: a machine with a *connected* device.
-      + zones: an iterable where each element is a size two iterable, where
-         the first element is the zone uid and the latter is a list where
-         every item is a command to be sent to such zone with its arguments.
-      + modes: a mode uid to apply current configuration to (None means
-         current session only).
-      + speed: theme speed for current configuration (range 0 to 65535).
+    Arguments are the same as ``protocol.send_for_mode``, plus only: when
+    given, the positions in zones of the only zones to compile. The other
+    zones still take their loop index, so every zone compiled gets the same
+    index it gets in the full program.
 
-    Returns an integer intended to be the value returned by sys.exit.
+    Returns a list of packets.
     """
-    if machine is None:
-        try:
-            machine = get_machine()
-        except EnvironmentError:
-            return log_error_code(ERROR_DEVICE_NOT_FOUND)
+    stream = []
 
-    device = machine['device']
+    def set_mode():
+        if mode is not None:
+            stream.append(packet_set_mode(mode))
 
     # This holds the zone index for each group of commands sent to it, it must
     # start at 1, otherwise it just ignores the first request.
     idx = 1
 
     if speed:
+        # JSON clients and theme files may give it as a float.
+        speed = int(speed)
         if (0 > speed or speed > MAX_SPEED):
             logger.warn('Invalid speed %d, setting to %d (0x%x)',
                         speed, MAX_SPEED, MAX_SPEED)
             speed = MAX_SPEED
-        try:
-            cmd_set_mode(device, mode)
-            cmd_set_speed(device, speed)
-        except USBError:
-            return log_error_code(ERROR_DEVICE_TIMEOUT)
+        set_mode()
+        stream.append(packet_set_speed(speed))
 
-    for zone_cmds in zones:
+    for position, zone_cmds in enumerate(zones):
         zone_uid = zone_cmds[0]
         cmd_list = zone_cmds[1:]
 
         try:
-            zone = machine['zones_by_uid'][zone_uid]
+            zone = _get_zone(machine, zone_uid)
         except KeyError:
-            logger.warn('Invalid Zone uid: 0x%x, skipping...', zone_uid)
+            logger.warn('Invalid Zone uid: %s, skipping...', zone_uid)
             continue
+        if only is not None and position not in only:
+            idx += 1
+            continue
+        # Combined zones are logged by their mask, just like the protocol.
+        zone_mask = sum(zone_uid) if isinstance(zone_uid, (list, tuple)) \
+            else zone_uid
 
         num_configs = len(cmd_list)
         if num_configs > ZONE_MAX_CONFIGURATIONS:
             logger.warn(
                 'Max zone 0x%x configs is %d, got %d, truncating...',
-                zone_uid, ZONE_MAX_CONFIGURATIONS, num_configs)
+                zone_mask, ZONE_MAX_CONFIGURATIONS, num_configs)
             cmd_list = cmd_list[:ZONE_MAX_CONFIGURATIONS]
 
         for cmd_and_args in cmd_list:
@@ -451,93 +700,229 @@ def send_for_mode(machine=None, zones=tuple(), mode=None, speed=MAX_SPEED):
             if (cmd == CMD_SET_MORPH and not zone['can_morph']) or \
                (cmd == CMD_SET_PULSE and not zone['can_pulse']):
                 logger.warn('Invalid Zone cmd: 0x%x cannot %x, skipping...',
-                            zone_uid, cmd)
+                            zone_mask, cmd)
                 continue
             try:
-                # Send the proper command to the device
-                cmd_fn = CMD_FN_MAP[cmd]
-                cmd_set_mode(device, mode)
-                cmd_fn(device, idx, zone_uid, *args)
+                packet_fn = PACKET_FN_MAP[cmd]
             except KeyError:
                 logger.warn('Invalid Command uid: 0x%x, skipping...', cmd)
-            except USBError:
-                return log_error_code(ERROR_DEVICE_TIMEOUT)
+                continue
+            _log_color_command(CMD_FN_MAP[cmd].__name__, idx, zone_uid, *args)
+            set_mode()
+            stream.append(packet_fn(idx, zone_uid, *args))
 
         idx += 1
 
         # Mark loop end
-        try:
-            cmd_set_mode(device, mode)
-            cmd_end_loop(device)
-        except USBError:
-            return log_error_code(ERROR_DEVICE_TIMEOUT)
+        set_mode()
+        stream.append(packet_end_loop())
 
-    return SUCCESS
+    return stream
 
 
-def send(machine=None, zones=None, modes=None, speed=MAX_SPEED, save=False):
+def optimize_stream(stream):
     """
-    Sends zone commands to the device for all modes.
+    Peephole pass dropping set_mode packets for an already active mode.
 
-    This is used by lsd, either talking directly to it when it has root
-    access, or via the lsdaemon as intermediary. In any case this is the main
-    entry point of the library, that you can use for your own applications.
+    Returns a new list of packets.
+    """
+    optimized = []
+    active_mode = None
+    for packet in stream:
+        if packet[1] == CMD_SET_MODE:
+            if packet[2] == active_mode:
+                continue
+            active_mode = packet[2]
+        optimized.append(packet)
+    return optimized
 
-    If mode is None is specified, then the commands are executed just for the
-    current session, meaning that you will see the changes immediately.
+
+def transmit(device, stream):
+    """
+    Sends every packet from stream to device.
+
+    Raises:
+      + USBError: on communication errors.
+    """
+    for packet in stream:
+        send_request(device, packet)
+
+
+def send_for_mode(machine=None, zones=tuple(), mode=None, speed=MAX_SPEED,
+                  device=None):
+    """
+    Sends commands to the device for given mode.
+
+    Any invalid command, zone uid or speed provided will not result into an
+    error but just a warning.
 
     Arguments:
-      + machine: a machine, as detected by get_machine.
+      + machine: a machine with a *connected* device.
       + zones: an iterable where each element is a size two iterable, where
-         the first element is the zone uid and the latter is a list, where
-         every item is a command to be sent to such zone with its arguments.
-      + modes: a list of modes uids to apply current configuration to.
+         the first element is the zone uid (or a list of uids as returned by
+         ``parse.coalesce_zones``) and the latter is a list where every item
+         is a command to be sent to such zone with its arguments.
+      + modes: a mode uid to apply current configuration to (None means
+         current session only).
       + speed: theme speed for current configuration (range 0 to 65535).
-      + save: when True, send a cmd_save request to make changes permantent.
-
-    See ``protocol.send_for_mode`` for more details.
+      + device: device to send commands to, defaults to the machine one. It
+         can also be a Pipeline wrapping it.
 
     Returns an integer intended to be the value returned by sys.exit.
     """
+    if machine is None:
+        try:
+            machine = get_machine()
+        except EnvironmentError:
+            return log_error_code(ERROR_DEVICE_NOT_FOUND)
+
+    if device is None:
+        device = machine['device']
+
+    stream = optimize_stream(compile_for_mode(machine, zones, mode, speed))
     try:
-        machine = get_machine()
-    except EnvironmentError:
-        return log_error_code(ERROR_DEVICE_NOT_FOUND)
+        transmit(device, stream)
+    except USBError:
+        return log_error_code(ERROR_DEVICE_TIMEOUT)
 
-    device = machine['device']
+    return SUCCESS
+
+
+def compile_program(machine, zones=None, modes=None, speed=MAX_SPEED,
+                    only=None):
+    """
+    Compiles zone commands for all modes into an optimized packet stream.
+
+    The current session (None mode) is always compiled last. See
+    ``compile_for_mode`` for only.
 
-    if modes is None:
-        modes = []
+    Returns a list of packets.
+    """
+    modes = list(modes) if modes else []
     modes.append(None)
 
-    try:
-        # Try to gain device control really hard. This should work in most
-        # situations for most machines.
-        connect(device)
-    except USBError:
-        return log_error_code(ERROR_DEVICE_CANNOT_TAKE_OVER)
+    stream = []
+    for mode in modes:
+        stream.extend(compile_for_mode(machine, zones, mode, speed, only))
+    return optimize_stream(stream)
+
+
+def send_stream(machine, stream, save=False, pipeline=0, reset=True):
+    """
+    Sends a stream of packets, as returned by ``compile_program``, to an
+    already *connected* machine and executes it.
+
+    Arguments are the same as ``protocol.send_program``, stream being any
+    iterable of packets.
+
+    Returns an integer intended to be the value returned by sys.exit.
+    """
+    device = machine['device']
 
     try:
         wait_ok(device)
-        cmd_reset(device, RESET_ALL_LIGHTS_ON)
-        wait_ok(device)
+        if reset:
+            cmd_reset(device, RESET_ALL_LIGHTS_ON)
+            wait_ok(device)
     except USBError:
         return log_error_code(ERROR_DEVICE_TIMEOUT)
 
-    for mode in modes:
-        code = send_for_mode(machine, zones, mode, speed)
-        if code != SUCCESS:
-            return code
+    if pipeline:
+        device = Pipeline(device, pipeline)
 
-    # Mark loop end
     try:
+        transmit(device, stream)
+        # Mark loop end
         if save:
             cmd_save(device)
         cmd_transmit_execute(device)
     except USBError:
         return log_error_code(ERROR_DEVICE_TIMEOUT)
 
+    return SUCCESS
+
+
+def send_program(machine, zones=None, modes=None, speed=MAX_SPEED,
+                 save=False, pipeline=0, reset=True):
+    """
+    Sends zone commands for all modes to an already *connected* machine.
+
+    This is the part of ``protocol.send`` that talks to the device once it
+    has been taken over, useful for callers that keep the device claimed
+    between requests (like ``session.DeviceSession``).
+
+    Arguments are the same as ``protocol.send``, except machine which must
+    hold a connected device and reset. When reset is False, lights are not
+    reset before sending, so loops for zones not in zones are kept.
+
+    Returns an integer intended to be the value returned by sys.exit.
+    """
+    stream = compile_program(machine, zones, modes, speed)
+    return send_stream(machine, stream, save, pipeline, reset)
+
+
+def replay(machine=None, stream=(), save=False, pipeline=0):
+    """
+    Same as ``protocol.send`` for an already compiled stream of packets,
+    see ``compile_program``.
+
+    Returns an integer intended to be the value returned by sys.exit.
+    """
+    if machine is None or machine['device'] is None:
+        try:
+            machine = get_machine()
+        except EnvironmentError:
+            return log_error_code(ERROR_DEVICE_NOT_FOUND)
+
+    device = machine['device']
+
+    try:
+        # Try to gain device control really hard. This should work in most
+        # situations for most machines.
+        connect(device)
+    except USBError:
+        return log_error_code(ERROR_DEVICE_CANNOT_TAKE_OVER)
+
+    code = send_stream(machine, stream, save, pipeline)
+
     # Free the robots^C^Cdevice
     dispose_resources(device)
 
-    return SUCCESS
+    return code
+
+
+def send(machine=None, zones=None, modes=None, speed=MAX_SPEED, save=False,
+         pipeline=0):
+    """
+    Sends zone commands to the device for all modes.
+
+    This is used by lsd, either talking directly to it when it has root
+    access, or via the lsdaemon as intermediary. In any case this is the main
+    entry point of the library, that you can use for your own applications.
+
+    If mode is None is specified, then the commands are executed just for the
+    current session, meaning that you will see the changes immediately.
+
+    Arguments:
+      + machine: a machine, as detected by get_machine (detected when None).
+      + zones: an iterable where each element is a size two iterable, where
+         the first element is the zone uid and the latter is a list, where
+         every item is a command to be sent to such zone with its arguments.
+      + modes: a list of modes uids to apply current configuration to.
+      + speed: theme speed for current configuration (range 0 to 65535).
+      + save: when True, send a cmd_save request to make changes permantent.
+      + pipeline: when not 0, send commands write-only through a Pipeline,
+         checking device status every pipeline packets.
+
+    See ``protocol.send_for_mode`` for more details.
+
+    Returns an integer intended to be the value returned by sys.exit.
+    """
+    if machine is None or machine['device'] is None:
+        try:
+            machine = get_machine()
+        except EnvironmentError:
+            return log_error_code(ERROR_DEVICE_NOT_FOUND)
+
+    stream = compile_program(machine, zones, modes, speed)
+    return replay(machine, stream, save, pipeline)
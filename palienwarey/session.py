@@ -0,0 +1,413 @@
+# -*- coding: utf-8 -*-
+import collections
+import threading
+
+from usb.core import USBError
+from usb.util import dispose_resources
+
+from .constants import (
+    MAX_SPEED, DEFAULT_IDLE_TIMEOUT, DEFAULT_PROGRAM_CACHE_SIZE,
+    DEFAULT_PROGRAM_CACHE_TTL, SUCCESS, ERROR_DEVICE_NOT_FOUND,
+    ERROR_DEVICE_CANNOT_TAKE_OVER, ERROR_DEVICE_TIMEOUT)
+from .defines import description_hash, describe_machine, get_machine
+from .logconf import logger, log_error_code
+from .protocol import connect, wait_ok, compile_program, send_stream
+from .stats import clock
+
+
+__all__ = ['DEFAULT_IDLE_TIMEOUT', 'coalesce_key', 'ProgramCache',
+           'DeviceSession']
+
+
+def _freeze(obj):
+    """
+    Returns obj with all lists turned into tuples, so commands coming from
+    JSON can be compared and hashed.
+    """
+    if isinstance(obj, (list, tuple)):
+        return tuple(_freeze(item) for item in obj)
+    return obj
+
+
+def _zone_uids(zone_uid):
+    if isinstance(zone_uid, (list, tuple)):
+        return tuple(zone_uid)
+    return (zone_uid,)
+
+
+def coalesce_key(zones=None, modes=None, speed=MAX_SPEED, save=False):
+    """
+    Returns what identifies the target of a send request: the set of zone
+    uids and the set of modes. A request with the same key fully replaces
+    the program of a previous one.
+    """
+    uids = frozenset(uid for zone_cmds in zones or ()
+                     for uid in _zone_uids(zone_cmds[0]))
+    return (uids, frozenset(modes or ()))
+
+
+def _program(zones, modes, speed):
+    """
+    Returns the program a request sets up as a dict with the speed, the set
+    of modes, the command list of every single zone uid and the layout: the
+    zone uids (or lists of them) in order, which sets the loop index every
+    zone gets.
+    """
+    loops = {}
+    for zone_cmds in zones or ():
+        cmds = _freeze(zone_cmds[1:])
+        for uid in _zone_uids(zone_cmds[0]):
+            loops[uid] = cmds
+    return {
+        'speed': speed,
+        'modes': frozenset(modes or ()),
+        'loops': loops,
+        'layout': tuple(_freeze(zone_cmds[0]) for zone_cmds in zones or ())
+    }
+
+
+class ProgramCache(object):
+    """
+    LRU cache of compiled programs, the packet streams built by
+    ``protocol.compile_program``.
+
+    Compiling validates every zone and command and builds every packet,
+    which is wasted work for the few configurations clients like hotkeys
+    send over and over. Streams are cached by machine uid, zones, modes and
+    speed (saving is not part of the stream), up to max_size of them (0
+    disables the cache) and for ttl seconds (0 is forever). Everything is
+    dropped when the machine definition changes, see set_definition.
+
+    Cached streams are shared, they must not be modified.
+    """
+
+    def __init__(self, max_size=DEFAULT_PROGRAM_CACHE_SIZE,
+                 ttl=DEFAULT_PROGRAM_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.definition = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def set_definition(self, definition):
+        """
+        Sets the hash of the machine definition programs are compiled for
+        (see ``defines.definition_hash``), dropping the cached ones when it
+        changed.
+        """
+        with self.lock:
+            if definition == self.definition:
+                return
+            if self.entries:
+                logger.debug('Machine definition changed, dropping %d '
+                             'cached programs', len(self.entries))
+                self.invalidations += 1
+                self.entries.clear()
+            self.definition = definition
+
+    def compile(self, machine, zones=None, modes=None, speed=MAX_SPEED,
+                only=None):
+        """
+        Same as ``protocol.compile_program``, returning the cached stream
+        when there is one.
+        """
+        if not self.max_size:
+            return compile_program(machine, zones, modes, speed, only)
+        key = (machine['uid'], _freeze(zones), _freeze(modes), speed,
+               tuple(sorted(only)) if only is not None else None)
+        now = clock()
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                stream, expires = entry
+                if expires is None or now < expires:
+                    # Back at the end, as the most recently used.
+                    self.entries[key] = entry
+                    self.hits += 1
+                    return stream
+                self.expirations += 1
+            self.misses += 1
+        stream = compile_program(machine, zones, modes, speed, only)
+        with self.lock:
+            self.entries[key] = (stream, now + self.ttl if self.ttl else None)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        return stream
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations
+            }
+
+
+class DeviceSession(object):
+    """
+    Long lived ownership of the USB lights device.
+
+    ``protocol.send`` finds, claims and releases the device for every call,
+    which is fine for one shot tools like lsd but wasteful for the daemon.
+    A session claims the device once and keeps it across requests, it
+    re-acquires it transparently after a USB error and only releases it on
+    close or after idle_timeout seconds without requests (0 means never).
+
+    All device access goes through the session lock, so it is safe to share
+    a session between threads. When pipeline is not 0, requests are sent
+    write-only (see ``protocol.Pipeline``).
+
+    The session keeps a shadow of the last program committed to the device.
+    New requests are diffed against it and, when they start with the same
+    zones in the same order as the shadow (for the same modes and speed),
+    only zones whose loops changed are sent and lights are not reset. Those
+    zones keep the loop index they had on the device, so each loop is
+    replaced by the one for the same index and zones. The shadow is
+    invalidated on errors, when the device is (re-)acquired or released,
+    and by calling invalidate, for instance after resetting the device
+    from elsewhere.
+
+    Compiled programs are kept in a ProgramCache of cache_size programs for
+    cache_ttl seconds, so requests repeating a recent configuration only
+    cost the USB writes.
+    """
+
+    def __init__(self, idle_timeout=DEFAULT_IDLE_TIMEOUT, pipeline=0,
+                 cache_size=DEFAULT_PROGRAM_CACHE_SIZE,
+                 cache_ttl=DEFAULT_PROGRAM_CACHE_TTL):
+        self.idle_timeout = idle_timeout
+        self.pipeline = pipeline
+        self.cache = ProgramCache(cache_size, cache_ttl)
+        self.machine = None
+        self.description = None
+        self.definition = None
+        self.shadow = None
+        self.last_used = None
+        self.lock = threading.RLock()
+        self._idle_timer = None
+
+    @property
+    def acquired(self):
+        return self.machine is not None
+
+    def acquire(self):
+        """
+        Finds and claims the device unless it has been already acquired.
+
+        Returns an integer intended to be the value returned by sys.exit.
+        """
+        with self.lock:
+            if self.acquired:
+                return SUCCESS
+
+            try:
+                machine = get_machine()
+            except EnvironmentError:
+                return log_error_code(ERROR_DEVICE_NOT_FOUND)
+
+            try:
+                connect(machine['device'])
+            except USBError:
+                return log_error_code(ERROR_DEVICE_CANNOT_TAKE_OVER)
+
+            try:
+                wait_ok(machine['device'])
+            except USBError:
+                dispose_resources(machine['device'])
+                return log_error_code(ERROR_DEVICE_TIMEOUT)
+
+            logger.info('Acquired device for %s', machine['name'])
+            self.machine = machine
+            self._describe(machine)
+            self.cache.set_definition(self.definition)
+            self.invalidate()
+            return SUCCESS
+
+    def release(self):
+        """
+        Releases the device if it was acquired.
+        """
+        with self.lock:
+            if not self.acquired:
+                return
+            try:
+                dispose_resources(self.machine['device'])
+            except USBError as e:
+                logger.debug('Error releasing device: %s', e)
+            logger.info('Released device for %s', self.machine['name'])
+            self.machine = None
+            self.invalidate()
+
+    def invalidate(self):
+        """
+        Forgets the shadow program, next request will be sent in full.
+        """
+        with self.lock:
+            self.shadow = None
+
+    def describe(self):
+        """
+        Returns the description of the machine (see
+        ``defines.describe_machine``), looking it up without claiming the
+        device if it was not acquired yet, or None if no machine is found.
+        Its hash (see ``defines.definition_hash``) is kept in definition.
+        """
+        if self.description is not None:
+            # Fast path, pings should not wait for device requests.
+            return self.description
+        with self.lock:
+            if self.description is None:
+                try:
+                    machine = get_machine()
+                except EnvironmentError:
+                    return None
+                self._describe(machine)
+            return self.description
+
+    def _describe(self, machine):
+        # The hash goes first, describe returns without the lock.
+        description = describe_machine(machine)
+        self.definition = description_hash(description)
+        self.description = description
+
+    def state(self):
+        """
+        Returns a JSON serializable description of the shadow program.
+        """
+        with self.lock:
+            if self.shadow is None:
+                return {'valid': False}
+            return {
+                'valid': True,
+                'speed': self.shadow['speed'],
+                'modes': sorted(self.shadow['modes']),
+                'zones': [[uid] + list(cmds) for uid, cmds in
+                          sorted(self.shadow['loops'].items())]
+            }
+
+    def close(self):
+        """
+        Releases the device and stops the idle timer, call on shutdown.
+        """
+        with self.lock:
+            self._cancel_idle_timer()
+            self.release()
+
+    def send(self, zones=None, modes=None, speed=MAX_SPEED, save=False,
+             cached=True):
+        """
+        Same as ``protocol.send`` but using the session owned device.
+
+        When the device times out, it is re-acquired and the request retried
+        once, this covers devices that got reset or replugged between
+        requests. When cached is False, the program is not kept in the
+        cache, as for animation frames which are unlikely to repeat.
+
+        Raises whatever compiling the program raises for malformed commands
+        (see ``lsdaemon.protocol.call``), the idle timer is armed anyway.
+
+        Returns an integer intended to be the value returned by sys.exit.
+        """
+        program = _program(zones, modes, speed)
+        with self.lock:
+            self._cancel_idle_timer()
+            try:
+                for retry in (False, True):
+                    code = self.acquire()
+                    if code != SUCCESS:
+                        break
+                    code = self._send_program(program, zones, modes, speed,
+                                              save, cached)
+                    if code != ERROR_DEVICE_TIMEOUT or retry:
+                        break
+                    logger.warn('Device timeout, re-acquiring device...')
+                    self.release()
+            except Exception:
+                # Whatever got sent is unknown, next time all is sent.
+                self.shadow = None
+                raise
+            else:
+                self.shadow = program if code == SUCCESS else None
+            finally:
+                # Otherwise the device would stay claimed forever.
+                self._touch()
+            return code
+
+    def _diff(self, program, zones):
+        """
+        Returns the positions in zones of the zones to send for program to
+        be in place on top of the shadow one or None if lights must be reset
+        and everything sent.
+
+        Zones keep the loop index they got when the shadow was sent only
+        while the shadow layout is a prefix of the program one, otherwise
+        the program is sent in full.
+        """
+        shadow = self.shadow
+        layout = shadow['layout'] if shadow is not None else None
+        if shadow is None or shadow['speed'] != program['speed'] or \
+           shadow['modes'] != program['modes'] or \
+           program['layout'][:len(layout)] != layout:
+            return None
+        changed = set(uid for uid, cmds in program['loops'].items()
+                      if shadow['loops'].get(uid) != cmds)
+        return [position for position, zone_cmds in enumerate(zones)
+                if changed.intersection(_zone_uids(zone_cmds[0]))]
+
+    def _send_program(self, program, zones, modes, speed, save, cached):
+        compile_stream = self.cache.compile if cached else compile_program
+        diff = None if save else self._diff(program, zones)
+        if diff is None:
+            stream = compile_stream(self.machine, zones, modes, speed)
+            return send_stream(self.machine, stream, save, self.pipeline)
+        logger.debug('Shadow diff: sending %d of %d zones',
+                      len(diff), len(zones))
+        if not diff:
+            return SUCCESS
+        stream = compile_stream(self.machine, zones, modes, speed,
+                                frozenset(diff))
+        return send_stream(self.machine, stream, save, self.pipeline,
+                           reset=False)
+
+    def _touch(self):
+        self.last_used = clock()
+        if self.idle_timeout and self.acquired:
+            self._arm_idle_timer(self.idle_timeout)
+
+    def _arm_idle_timer(self, seconds):
+        self._idle_timer = threading.Timer(seconds, self._release_if_idle)
+        self._idle_timer.daemon = True
+        self._idle_timer.start()
+
+    def _cancel_idle_timer(self):
+        if self._idle_timer is not None:
+            self._idle_timer.cancel()
+            self._idle_timer = None
+
+    def _release_if_idle(self):
+        with self.lock:
+            # Replaced by a request while waiting for the lock.
+            if self._idle_timer is not threading.current_thread():
+                return
+            self._idle_timer = None
+            idle = clock() - self.last_used
+            if idle >= self.idle_timeout:
+                logger.debug('Device idle for %.1fs, releasing', idle)
+                self.release()
+            else:
+                self._arm_idle_timer(self.idle_timeout - idle)
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+import bisect
+import sys
+import threading
+import time
+
+
+__all__ = ['clock', 'LatencyHistogram']
+
+
+# clock_gettime clock ids, Python 2 has no time.monotonic.
+CLOCK_MONOTONIC = {'linux': 1, 'darwin': 6}
+
+
+def _clock_gettime(clock_id):
+    """
+    Returns a function reading clock_id through libc's clock_gettime in
+    seconds, None when ctypes or the function are missing.
+    """
+    try:
+        import ctypes
+    except ImportError:
+        return None
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    # Part of libc in glibc 2.17 and later, of librt before.
+    for name in (None, 'librt.so.1'):
+        try:
+            clock_gettime = ctypes.CDLL(name, use_errno=True).clock_gettime
+        except (OSError, AttributeError):
+            continue
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        clock_gettime.restype = ctypes.c_int
+        ts = timespec()
+        if clock_gettime(clock_id, ctypes.byref(ts)) != 0:
+            return None
+
+        def read():
+            ts = timespec()
+            clock_gettime(clock_id, ctypes.byref(ts))
+            return ts.tv_sec + ts.tv_nsec * 1e-9
+        return read
+    return None
+
+
+def _monotonic():
+    """
+    Returns time.monotonic, or on Python 2 clock_gettime(CLOCK_MONOTONIC)
+    where there is one. Falls back to time.time, which jumps when the
+    system clock is set.
+    """
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    platform = sys.platform.rstrip('0123456789')
+    if platform in CLOCK_MONOTONIC:
+        read = _clock_gettime(CLOCK_MONOTONIC[platform])
+        if read is not None:
+            return read
+    return time.time
+
+
+# Seconds from an arbitrary point, for measuring intervals and deadlines.
+clock = _monotonic()
+
+
+class LatencyHistogram(object):
+    """
+    Thread safe histogram of latencies with power of two buckets.
+
+    Latencies are added in seconds and reported in milliseconds, the bucket
+    bounds go from 0.25ms up to ~8s, anything slower lands in an overflow
+    bucket.
+    """
+
+    BOUNDS = tuple(0.25 * 2 ** i for i in range(16))
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.buckets = [0] * (len(self.BOUNDS) + 1)
+            self.count = 0
+            self.total = 0.0
+            self.max = 0.0
+            self.failures = 0
+
+    def add(self, seconds, failed=False):
+        """
+        Records a latency, failed marks it as a timeout or error.
+        """
+        ms = seconds * 1000
+        with self.lock:
+            self.buckets[bisect.bisect_left(self.BOUNDS, ms)] += 1
+            self.count += 1
+            self.total += ms
+            self.max = max(self.max, ms)
+            if failed:
+                self.failures += 1
+
+    def as_dict(self):
+        """
+        Returns a JSON serializable summary.
+
+        Buckets are a list of [upper_bound_ms, count] pairs, where None is
+        the overflow bucket upper bound.
+        """
+        with self.lock:
+            bounds = list(self.BOUNDS) + [None]
+            return {
+                'count': self.count,
+                'failures': self.failures,
+                'mean_ms': self.total / self.count if self.count else 0.0,
+                'max_ms': self.max,
+                'buckets': [[bound, count] for bound, count in
+                            zip(bounds, self.buckets) if count]
+            }
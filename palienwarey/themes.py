@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import mmap
+import os
+import struct
+import tempfile
+
+from .constants import (
+    DATA_LENGTH, MAX_SPEED, THEME_CACHE_DIR, THEME_MAGIC, ERROR_BAD_THEME)
+from .defines import definition_hash
+from .logconf import logger, log_error_code
+from .parse import coalesce_zones, parse
+from .protocol import compile_program, replay
+
+
+__all__ = ['theme_hash', 'load_theme', 'theme_program', 'compile_theme',
+           'cache_path', 'write_compiled', 'CompiledTheme', 'apply_theme']
+
+
+# magic, version, flags, packet length, packet count
+_header = struct.Struct('<4sBBHI')
+VERSION = 1
+FLAG_SAVE = 0x01
+
+
+def theme_hash(data):
+    """
+    Returns the hex digest of the raw contents of a theme file.
+    """
+    return hashlib.sha1(data).hexdigest()
+
+
+def load_theme(data):
+    """
+    Loads a theme from the JSON contents of a theme file, like::
+
+        {"speed": 200, "save": true, "cascade": false,
+         "modes": ["ac", "batpower"],
+         "zones": [["kbd", ["morph:ffcc00:ff0000", "pulse:ff0000"]],
+                   ["power", "color:00ff00"]]}
+
+    Zones are a list of [zone, commands] pairs (or a dict, when order does
+    not matter), zones being aliases or uids and commands a list of command
+    strings or a single string with them separated by spaces, just like lsd
+    takes them. Modes are aliases or uids too. All but zones is optional,
+    speed defaults to MAX_SPEED and no modes means the current session.
+
+    Raises:
+      + ValueError: if data is not a valid theme.
+
+    Returns a dict with the theme.
+    """
+    try:
+        theme = json.loads(data)
+        zones = theme['zones']
+        if isinstance(zones, dict):
+            zones = sorted(zones.items())
+        theme['zones'] = [
+            (zone, ' '.join(commands) if isinstance(commands, list)
+             else commands)
+            for zone, commands in zones]
+    except (KeyError, TypeError, AttributeError) as e:
+        raise ValueError('Invalid theme: %s' % e)
+    return theme
+
+
+def _lookup(items, key, kind):
+    for item in items:
+        if key in (item['alias'], item['uid']):
+            return item['uid']
+    raise ValueError('Unknown %s %r' % (kind, key))
+
+
+def theme_program(machine, theme):
+    """
+    Parses a theme, as returned by load_theme, for machine.
+
+    Raises:
+      + ValueError: if any zone, mode, command or color is invalid.
+
+    Returns a dict with the zones, modes, speed and save arguments for
+    ``protocol.send``.
+    """
+    zones_cmd_set = [(_lookup(machine['zones'], zone, 'zone'), commands)
+                     for zone, commands in theme['zones']]
+    modes = [_lookup(machine['modes'], mode, 'mode')
+             for mode in theme.get('modes') or ()]
+    try:
+        zones = coalesce_zones(machine, parse(
+            machine, zones_cmd_set, theme.get('cascade', False)))
+    except (KeyError, IndexError) as e:
+        raise ValueError('Unknown command %s' % e)
+    return {
+        'zones': zones,
+        'modes': modes or None,
+        'speed': theme.get('speed', MAX_SPEED),
+        'save': bool(theme.get('save', False))
+    }
+
+
+def compile_theme(machine, theme):
+    """
+    Compiles a theme, as returned by load_theme, for machine.
+
+    Raises:
+      + ValueError: if the theme is not valid for machine.
+
+    Returns a (stream, save) tuple, stream being the packets to send (see
+    ``protocol.compile_program``) and save whether to save them.
+    """
+    program = theme_program(machine, theme)
+    stream = compile_program(machine, program['zones'], program['modes'],
+                             program['speed'])
+    return stream, program['save']
+
+
+def cache_path(data, machine, cache_dir=THEME_CACHE_DIR):
+    """
+    Returns where the theme with the data contents is cached once compiled
+    for machine. The path changes with the theme contents and the machine
+    definition, so stale entries are never used.
+    """
+    return os.path.join(cache_dir, '%s-%s.bin' % (
+        theme_hash(data)[:16], definition_hash(machine)[:16]))
+
+
+def write_compiled(path, stream, save=False):
+    """
+    Writes a compiled theme to path, atomically so concurrent readers never
+    see it half written.
+    """
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    fd, tmp_path = tempfile.mkstemp(dir=dirname)
+    try:
+        with os.fdopen(fd, 'wb') as compiled_file:
+            compiled_file.write(_header.pack(
+                THEME_MAGIC, VERSION, FLAG_SAVE if save else 0,
+                DATA_LENGTH, len(stream)))
+            for packet in stream:
+                compiled_file.write(bytes(packet))
+        os.rename(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
+class CompiledTheme(object):
+    """
+    A compiled theme file, memory mapped so applying it just copies its
+    packets to the device.
+
+    Raises ValueError when the file is not a compiled theme (or one from a
+    different version).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as compiled_file:
+            self.map = mmap.mmap(compiled_file.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+        try:
+            magic, version, flags, length, self.count = \
+                _header.unpack_from(self.map)
+        except struct.error:
+            magic = None
+        if magic != THEME_MAGIC or version != VERSION or \
+           length != DATA_LENGTH or \
+           len(self.map) != _header.size + self.count * length:
+            self.map.close()
+            raise ValueError('%s is not a compiled theme' % path)
+        self.save = bool(flags & FLAG_SAVE)
+
+    def packets(self):
+        """
+        Yields every packet of the theme.
+        """
+        for i in range(self.count):
+            offset = _header.size + i * DATA_LENGTH
+            yield bytearray(self.map[offset:offset + DATA_LENGTH])
+
+    def close(self):
+        self.map.close()
+
+
+def apply_theme(machine, path, cache_dir=THEME_CACHE_DIR, pipeline=0):
+    """
+    Applies the theme file at path to machine, which must have a device.
+
+    The theme is compiled once per theme contents and machine definition
+    and cached in cache_dir (None disables the cache), applying a cached
+    theme involves no parsing at all, its packets are replayed as they are.
+
+    Returns an integer intended to be the value returned by sys.exit.
+    """
+    try:
+        with open(path, 'rb') as theme_file:
+            data = theme_file.read()
+    except IOError as e:
+        logger.error('Cannot read %s: %s', path, e)
+        return log_error_code(ERROR_BAD_THEME)
+
+    compiled_path = cache_path(data, machine, cache_dir) if cache_dir \
+        else None
+    try:
+        compiled = CompiledTheme(compiled_path) if compiled_path else None
+    except (IOError, OSError, ValueError) as e:
+        logger.debug('Compiling %s: %s', path, e)
+        compiled = None
+
+    if compiled is not None:
+        logger.debug('Replaying %s', compiled_path)
+        try:
+            return replay(machine, compiled.packets(), compiled.save,
+                          pipeline)
+        finally:
+            compiled.close()
+
+    try:
+        stream, save = compile_theme(machine, load_theme(data))
+    except ValueError as e:
+        logger.error('Cannot load %s: %s', path, e)
+        return log_error_code(ERROR_BAD_THEME)
+    if compiled_path is not None:
+        try:
+            write_compiled(compiled_path, stream, save)
+        except (IOError, OSError) as e:
+            logger.debug('Cannot write theme cache %s: %s', compiled_path,
+                         e)
+    return replay(machine, stream, save, pipeline)
@@ -0,0 +1,357 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    # Python 3 compat
+    import queue
+
+from .constants import (
+    DEFAULT_QUEUE_DEPTH, DEFAULT_REQUEST_DEADLINE, WORKER_REAP_INTERVAL,
+    DEFAULT_MAX_CONNECTIONS, DEFAULT_CONNECTION_QUEUE, ERROR_QUEUE_FULL,
+    ERROR_REQUEST_EXPIRED, ERROR_COALESCED)
+from .logconf import logger
+from .stats import clock, LatencyHistogram
+
+
+__all__ = ['Job', 'DeviceWorker', 'ConnectionPool']
+
+
+class Job(object):
+    """
+    A call to be run by the DeviceWorker.
+
+    A job expires when it could not be started within deadline seconds (0
+    means never), expired jobs are never run. Queued jobs can be superseded
+    by newer ones too, unless keep is True.
+    """
+
+    QUEUED, RUNNING, DONE, EXPIRED, COALESCED = range(5)
+
+    def __init__(self, fn, args=(), kwargs=None, deadline=0, keep=False):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.keep = keep
+        self.created = clock()
+        self.started = None
+        self.expires = self.created + deadline if deadline else None
+        self.state = Job.QUEUED
+        self.result = None
+        self.error = None
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+
+    def start(self):
+        """
+        Marks the job as running, unless it expired.
+
+        Returns True if the job must be run.
+        """
+        with self.lock:
+            if self.state != Job.QUEUED:
+                return False
+            if self.expires is not None and clock() > self.expires:
+                self._expire()
+                return False
+            self.state = Job.RUNNING
+            self.started = clock()
+            return True
+
+    def run(self):
+        try:
+            self.result = self.fn(*self.args, **self.kwargs)
+        except Exception as e:
+            # Raised again by wait, in the thread waiting for the result.
+            self.error = e
+        with self.lock:
+            self.state = Job.DONE
+        self.done.set()
+
+    def expire(self):
+        """
+        Expires the job, unless it already started.
+
+        Returns True if the job got expired.
+        """
+        with self.lock:
+            if self.state != Job.QUEUED:
+                return self.state == Job.EXPIRED
+            self._expire()
+            return True
+
+    def _expire(self):
+        self.state = Job.EXPIRED
+        self.result = ERROR_REQUEST_EXPIRED
+        self.done.set()
+
+    def supersede(self):
+        """
+        Drops the job in favor of a newer one, unless it already started or
+        must be kept.
+
+        Returns True if the job got superseded.
+        """
+        with self.lock:
+            if self.state != Job.QUEUED or self.keep:
+                return False
+            self.state = Job.COALESCED
+            self.result = ERROR_COALESCED
+            self.done.set()
+            return True
+
+    def wait(self):
+        """
+        Waits for the job to be done or expired and returns its result.
+
+        Raises whatever the job raised.
+        """
+        # Waiting with a timeout polls on Python 2, the DeviceWorker takes
+        # care of expiring jobs instead.
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class DeviceWorker(object):
+    """
+    The single owner of the USB device within lsdaemon.
+
+    Concurrent clients calling protocol functions on the same device would
+    interleave their packets and corrupt each other. Instead, connection
+    handlers only submit jobs to a bounded queue and this worker thread runs
+    them one at a time. When the queue is full, jobs are rejected right
+    away with ERROR_QUEUE_FULL so clients get backpressure instead of
+    piling up. Jobs still queued after deadline seconds are expired every
+    reap_interval seconds.
+
+    Jobs submitted with call_latest replace the queued job with the same
+    key, so bursts of updates to the same thing only run the newest one.
+    """
+
+    def __init__(self, max_queue=DEFAULT_QUEUE_DEPTH,
+                 deadline=DEFAULT_REQUEST_DEADLINE,
+                 reap_interval=WORKER_REAP_INTERVAL):
+        self.max_queue = max_queue
+        self.deadline = deadline
+        self.reap_interval = reap_interval
+        # Superseded and expired jobs stay in the queue until the worker
+        # skips them, they do not count against max_queue.
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.latest = {}
+        self.wait_histogram = LatencyHistogram()
+        self.rejected = 0
+        self.expired = 0
+        self.coalesced = 0
+        self.completed = 0
+        self.running = False
+        self.thread = threading.Thread(target=self.serve,
+                                       name='lsdaemon-device-worker')
+        self.thread.daemon = True
+        self.reaper = threading.Thread(target=self.reap,
+                                       name='lsdaemon-job-reaper')
+        self.reaper.daemon = True
+
+    def start(self):
+        self.running = True
+        self.thread.start()
+        if self.deadline:
+            self.reaper.start()
+
+    def stop(self):
+        """
+        Stops the worker after running the already queued jobs.
+        """
+        self.running = False
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        if self.reaper.is_alive():
+            self.reaper.join()
+
+    def reap(self):
+        """
+        Expires the queued jobs past their deadline, so clients waiting for
+        them get a reply even when the worker is stuck on a slow job.
+        """
+        while self.running:
+            now = clock()
+            with self.queue.mutex:
+                jobs = list(self.queue.queue)
+            for job in jobs:
+                if job is not None and job.expires is not None and \
+                   job.expires < now:
+                    job.expire()
+            time.sleep(self.reap_interval)
+
+    def serve(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            if not job.start():
+                if job.state == Job.EXPIRED:
+                    self.expired += 1
+                    logger.warn('Request expired after %.3fs in queue',
+                                clock() - job.created)
+                continue
+            self.wait_histogram.add(job.started - job.created)
+            job.run()
+            self.completed += 1
+
+    def call(self, fn, *args, **kwargs):
+        """
+        Runs fn(*args, **kwargs) in the worker thread and waits for it.
+
+        Returns what fn returned, ERROR_QUEUE_FULL if the queue was full or
+        ERROR_REQUEST_EXPIRED if it could not be started within deadline.
+        Exceptions raised by fn are raised again here.
+        """
+        return self.submit(Job(fn, args, kwargs, self.deadline))
+
+    def call_latest(self, key, keep, fn, *args, **kwargs):
+        """
+        Same as call, but the job supersedes the queued one with the same
+        key, whose caller gets ERROR_COALESCED. When keep is True the job
+        is never superseded itself.
+        """
+        return self.submit(Job(fn, args, kwargs, self.deadline, keep), key)
+
+    def queued(self):
+        """
+        Returns how many queued jobs are waiting to be run.
+        """
+        with self.queue.mutex:
+            return sum(1 for job in self.queue.queue
+                       if job is not None and job.state == Job.QUEUED)
+
+    def submit(self, job, key=None):
+        with self.lock:
+            previous = self.latest.get(key) if key is not None else None
+            if previous is not None and previous.supersede():
+                self.coalesced += 1
+                logger.debug('Request coalesced after %.3fs in queue',
+                             clock() - previous.created)
+            elif self.max_queue and self.queued() >= self.max_queue:
+                self.rejected += 1
+                logger.warn('Request queue full, rejecting request')
+                return ERROR_QUEUE_FULL
+            if key is not None:
+                self.latest[key] = job
+            self.queue.put(job)
+        try:
+            return job.wait()
+        finally:
+            if key is not None:
+                with self.lock:
+                    if self.latest.get(key) is job:
+                        del self.latest[key]
+
+    def stats(self):
+        return {
+            'queued': self.queued(),
+            'max_queue': self.max_queue,
+            'completed': self.completed,
+            'rejected': self.rejected,
+            'expired': self.expired,
+            'coalesced': self.coalesced,
+            'wait': self.wait_histogram.as_dict()
+        }
+
+
+class ConnectionPool(object):
+    """
+    A fixed number of threads serving lsdaemon connections.
+
+    Accepted connections wait in a queue (of up to max_queue, 0 meaning
+    unbounded) for a free thread. When the queue is full, submit returns
+    False so the server turns the client away, instead of piling up a
+    thread per connection like ThreadingMixIn does.
+
+    Threads are daemonic, connections kept alive by clients must not
+    prevent the daemon from exiting.
+    """
+
+    def __init__(self, size=DEFAULT_MAX_CONNECTIONS,
+                 max_queue=DEFAULT_CONNECTION_QUEUE):
+        self.size = size
+        self.max_queue = max_queue
+        self.queue = queue.Queue(max_queue)
+        self.lock = threading.Lock()
+        # Connections being served or waiting for a thread.
+        self.current = 0
+        self.peak = 0
+        self.active = 0
+        self.served = 0
+        self.rejected = 0
+        self.threads = []
+        for i in range(size):
+            thread = threading.Thread(target=self.serve,
+                                      name='lsdaemon-connection-%d' % i)
+            thread.daemon = True
+            self.threads.append(thread)
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        """
+        Lets idle threads exit, busy ones are left to finish on their own.
+        """
+        for _ in self.threads:
+            try:
+                self.queue.put_nowait(None)
+            except queue.Full:
+                break
+
+    def serve(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            fn, args = item
+            with self.lock:
+                self.active += 1
+            try:
+                fn(*args)
+            except Exception as e:
+                logger.exception(e)
+            finally:
+                with self.lock:
+                    self.active -= 1
+                    self.current -= 1
+                    self.served += 1
+
+    def submit(self, fn, *args):
+        """
+        Queues fn(*args) to be run by a pool thread.
+
+        Returns False, without queueing it, if the queue is full.
+        """
+        with self.lock:
+            try:
+                self.queue.put_nowait((fn, args))
+            except queue.Full:
+                self.rejected += 1
+                return False
+            self.current += 1
+            self.peak = max(self.peak, self.current)
+            return True
+
+    def stats(self):
+        with self.lock:
+            return {
+                'current': self.current,
+                'peak': self.peak,
+                'active': self.active,
+                'queued': self.current - self.active,
+                'max_connections': self.size,
+                'max_queue': self.max_queue,
+                'served': self.served,
+                'rejected': self.rejected
+            }
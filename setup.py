@@ -14,6 +14,7 @@ setup(
     description=('Cross platform Alienware Lights commandline tool, driver and library.'),
     entry_points={
         'console_scripts': [
+            'lsbench = palienwarey.lsbench:main',
             'lsd = palienwarey.lsd:main',
             'lsdaemon = palienwarey.lsdaemon:main',
             'lsdetect = palienwarey.lsdetect:main',
@@ -21,9 +22,13 @@ setup(
     },
     license='GPLv3+',
     packages=['palienwarey'],
+    test_suite='tests',
     requires=[
         'pyusb(==1.0.0a3)',
     ],
+    extras_require={
+        'numpy': ['numpy'],
+    },
     classifiers=[
         'Development Status :: 3 - Alpha',
         'Environment :: Console',
@@ -0,0 +1,5 @@
+# -*- coding: utf-8 -*-
+from palienwarey.logconf import set_log_level
+
+# Tests send invalid commands on purpose, their warnings are just noise.
+set_log_level('critical')
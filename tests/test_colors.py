@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from palienwarey import colors
+
+
+def _quantizers():
+    quantizers = [colors._py_quantize]
+    if colors.HAVE_NUMPY:
+        quantizers.append(
+            lambda *args: colors._from_array(colors._np_quantize(*args)))
+    return quantizers
+
+
+class QuantizeTest(unittest.TestCase):
+    """
+    Dithered or not, colors are quantized on the scale of parse_color.
+    """
+
+    def flat(self, quantize, channel):
+        # 4 frames of 4 zones cover the whole dithering matrix.
+        frames = [[(channel,) * 3] * 4] * 4
+        return [level[0] for frame in quantize(frames, True, 0)
+                for level in frame]
+
+    def test_levels_kept(self):
+        for quantize in _quantizers():
+            for channel in range(0, 256, 16):
+                plain = quantize([(channel,) * 3], False, 0)[0][0]
+                self.assertEqual(plain, channel // 16)
+                self.assertEqual(set(self.flat(quantize, channel)), {plain})
+
+    def test_flat_average(self):
+        for quantize in _quantizers():
+            for channel in range(0, 241):
+                levels = self.flat(quantize, channel)
+                self.assertEqual(sum(levels), channel)
+
+    def test_clamped(self):
+        for quantize in _quantizers():
+            self.assertEqual(set(self.flat(quantize, 255)), {15})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+import json
+import random
+import socket
+import threading
+import unittest
+
+from palienwarey.framing import (
+    FrameError, FrameReader, FrameTooLarge, encode_frame)
+
+
+def _payloads(count, rand):
+    # From a few bytes to several times the reader initial buffer.
+    return ['send#%d %s' % (i, json.dumps({
+        'zones': [[1 << (i % 16), [3, [i % 16, 0xf]]]] *
+        rand.choice((1, 8, 64, 600))}))
+        for i in range(count)]
+
+
+def _split(data, rand, low=1, high=64):
+    chunks = []
+    offset = 0
+    while offset < len(data):
+        size = rand.randint(low, high)
+        chunks.append(data[offset:offset + size])
+        offset += size
+    return chunks
+
+
+class FrameReaderTest(unittest.TestCase):
+    """
+    Frames must come out of a FrameReader exactly as they were sent, however
+    the stream is cut by the sender.
+    """
+
+    def setUp(self):
+        self.rand = random.Random(0)
+        self.payloads = _payloads(300, self.rand)
+        self.stream = ''.join(encode_frame(payload)
+                              for payload in self.payloads)
+
+    def read_all(self, chunks, **kwargs):
+        """
+        Sends chunks from a thread over a socket pair, returns the frames
+        read until the connection got closed.
+        """
+        reader_sock, writer_sock = socket.socketpair()
+
+        def write():
+            try:
+                for chunk in chunks:
+                    writer_sock.sendall(chunk)
+            except socket.error:
+                pass
+            finally:
+                writer_sock.close()
+        thread = threading.Thread(target=write)
+        thread.start()
+        reader = FrameReader(reader_sock, **kwargs)
+        frames = []
+        try:
+            while True:
+                frame = reader.read_frame()
+                if frame is None:
+                    return frames
+                # Views are only valid until the next read.
+                frames.append(frame.tobytes())
+        finally:
+            reader_sock.close()
+            thread.join()
+
+    def test_whole(self):
+        frames = [encode_frame(payload) for payload in self.payloads]
+        self.assertEqual(self.read_all(frames), self.payloads)
+
+    def test_coalesced(self):
+        self.assertEqual(self.read_all([self.stream]), self.payloads)
+
+    def test_fragmented(self):
+        for seed in range(5):
+            rand = random.Random(seed)
+            self.assertEqual(self.read_all(_split(self.stream, rand)),
+                             self.payloads)
+
+    def test_split_headers(self):
+        payloads = self.payloads[:30]
+        stream = ''.join(encode_frame(payload) for payload in payloads)
+        chunks = _split(stream, self.rand, 1, 3)
+        self.assertEqual(self.read_all(chunks, size=16), payloads)
+
+    def test_large_chunks(self):
+        chunks = _split(self.stream, self.rand, 4096, 65536)
+        self.assertEqual(self.read_all(chunks), self.payloads)
+
+    def test_feed(self):
+        reader = FrameReader(size=64)
+        frames = []
+        for chunk in _split(self.stream, self.rand, 1, 512):
+            reader.feed(chunk)
+            frame = reader.next_frame()
+            while frame is not None:
+                frames.append(frame.tobytes())
+                frame = reader.next_frame()
+        self.assertEqual(frames, self.payloads)
+        self.assertEqual(reader.pending(), 0)
+
+    def test_empty_frame(self):
+        self.assertEqual(self.read_all([encode_frame('') * 3]), [''] * 3)
+
+    def test_too_large(self):
+        with self.assertRaises(FrameTooLarge):
+            self.read_all([encode_frame('x' * 101)], max_size=100)
+
+    def test_invalid_header(self):
+        with self.assertRaises(FrameError):
+            self.read_all(['zzzzzzping'])
+
+    def test_closed_mid_frame(self):
+        frame = encode_frame('ping')
+        with self.assertRaises(FrameError):
+            self.read_all([frame, frame[:-1]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from palienwarey import lsbench
+
+
+class ImportsTest(unittest.TestCase):
+    """
+    Commandline clients must start fast: importing them must not load the
+    daemon, the animation engine, NumPy or USB (see lsbench.HEAVY_MODULES).
+
+    Only the modules loaded are checked, timings depend on the machine
+    running the tests and are left to ``lsbench --micro imports
+    --import-budget``.
+    """
+
+    def test_imports(self):
+        results = {'results': lsbench.micro_imports(1)}
+        self.assertEqual(lsbench.check_budget(results, None), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+import errno
+import os
+import shutil
+import socket
+import stat
+import tempfile
+import threading
+import unittest
+
+from palienwarey import emulator
+from palienwarey.constants import (DEFAULT_PORT, DEFAULT_UNIX_SOCKET,
+                                   DEFAULT_UNIX_SOCKET_MODE, SUCCESS)
+from palienwarey.lsdaemon import LSDaemonServer, LSDaemonUnixServer
+from palienwarey.lsdclient import LSDClient
+
+
+class UnixServerTest(unittest.TestCase):
+
+    def setUp(self):
+        emulator.enable()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'lsdaemon.sock')
+        self.server = LSDaemonUnixServer(self.path)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+        emulator.disable()
+
+    def ping(self):
+        client = LSDClient(unix_socket=self.path)
+        try:
+            return client.ping()
+        finally:
+            client.close()
+
+    def test_mode(self):
+        mode = stat.S_IMODE(os.stat(self.path).st_mode)
+        self.assertEqual(mode, DEFAULT_UNIX_SOCKET_MODE)
+        umask = os.umask(0o022)
+        path = os.path.join(self.directory, 'private.sock')
+        try:
+            server = LSDaemonUnixServer(path, 0o600, share_with=self.server)
+            try:
+                self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o600)
+            finally:
+                server.server_close()
+        finally:
+            # Binding must leave the process umask as it was.
+            self.assertEqual(os.umask(umask), 0o022)
+
+    def test_second_daemon(self):
+        with self.assertRaises(socket.error) as raised:
+            LSDaemonUnixServer(self.path)
+        self.assertEqual(raised.exception.errno, errno.EADDRINUSE)
+        self.assertTrue(os.path.exists(self.path))
+        self.assertEqual(self.ping()['code'], SUCCESS)
+
+    def test_second_daemon_framebuffer(self):
+        framebuffer = os.path.join(self.directory, 'lsdaemon.fb')
+        with self.assertRaises(socket.error):
+            LSDaemonUnixServer(self.path, framebuffer=framebuffer)
+        self.assertFalse(os.path.exists(framebuffer))
+        self.assertEqual(self.ping()['code'], SUCCESS)
+
+
+class ServerCloseTest(unittest.TestCase):
+
+    def setUp(self):
+        emulator.enable()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        emulator.disable()
+
+    def test_framebuffer_removed(self):
+        path = os.path.join(self.directory, 'lsdaemon.fb')
+        server = LSDaemonServer(('127.0.0.1', 0), framebuffer=path)
+        self.assertEqual(server.session.acquire(), SUCCESS)
+        os.unlink(path)
+        server.server_close()
+        self.assertFalse(server.session.acquired)
+        self.assertFalse(server.worker.thread.is_alive())
+
+
+class UnixSocketChoiceTest(unittest.TestCase):
+    """
+    Clients only try the default Unix socket for the default port, another
+    port most likely belongs to another daemon.
+    """
+
+    def test_default_port(self):
+        client = LSDClient('localhost', DEFAULT_PORT)
+        self.assertEqual(client.unix_socket, DEFAULT_UNIX_SOCKET)
+
+    def test_other_port(self):
+        self.assertIsNone(LSDClient('localhost', 7000).unix_socket)
+
+    def test_explicit(self):
+        client = LSDClient('localhost', 7000, unix_socket='/tmp/lsd.sock')
+        self.assertEqual(client.unix_socket, '/tmp/lsd.sock')
+
+    def test_remote_host(self):
+        self.assertIsNone(LSDClient('192.0.2.1', DEFAULT_PORT).unix_socket)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from palienwarey import emulator, lsbench
+from palienwarey.constants import CMD_SET_MODE, MAX_SPEED
+from palienwarey.defines import registry
+from palienwarey.parse import coalesce_zones, parse
+from palienwarey.protocol import (
+    compile_for_mode, compile_program, packet_save, packet_transmit_execute,
+    transmit)
+
+
+def _device_state(device):
+    return {
+        'mode': device.mode,
+        'speed': device.speed,
+        'loops': device.loops,
+        'shown': device.shown,
+        'saved': device.saved
+    }
+
+
+class OptimizeStreamTest(unittest.TestCase):
+    """
+    optimize_stream (through compile_program) must leave the device just
+    as the plain stream of compile_for_mode does, dropping nothing but
+    set_mode packets for the active mode.
+    """
+
+    def replay(self, stream, save):
+        device = emulator.EmulatedDevice()
+        transmit(device, stream)
+        if save:
+            transmit(device, [packet_save()])
+        transmit(device, [packet_transmit_execute()])
+        # The emulator records the bytes written to it.
+        self.assertEqual(device.packets[:len(stream)],
+                         [list(packet) for packet in stream])
+        return device
+
+    def check(self, machine, zones, modes, speed, save):
+        plain = []
+        for mode in list(modes) + [None]:
+            plain.extend(compile_for_mode(machine, zones, mode, speed))
+        optimized = compile_program(machine, zones, modes, speed)
+
+        self.assertLessEqual(len(optimized), len(plain))
+        self.assertEqual(
+            [list(packet) for packet in plain if packet[1] != CMD_SET_MODE],
+            [list(packet) for packet in optimized
+             if packet[1] != CMD_SET_MODE])
+        self.assertEqual(_device_state(self.replay(plain, save)),
+                         _device_state(self.replay(optimized, save)))
+
+    def test_scenarios(self):
+        for uid, machine in sorted(registry.items()):
+            all_modes = [mode['uid'] for mode in machine['modes']]
+            for name, scenario in lsbench.SCENARIOS.items():
+                args = scenario(machine)
+                zones = coalesce_zones(machine, parse(machine, args['zones']))
+                for modes in (args.get('modes', []), all_modes[:1],
+                              all_modes):
+                    for speed in (MAX_SPEED, 0x100, 0):
+                        self.check(machine, zones, modes, speed,
+                                   args.get('save', False))
+
+    def test_unknown_zones_and_commands(self):
+        machine = registry[emulator.DEFAULT_PRODUCT_ID]
+        uid = machine['zones'][0]['uid']
+        zones = [[0xdead, (0x03, (0xff, 0))],
+                 [uid, (0x7f, (0xff, 0)), (0x03, (0x0f, 0xf0))]]
+        self.check(machine, zones, [machine['modes'][0]['uid']], MAX_SPEED,
+                   False)
+
+
+class SpeedTest(unittest.TestCase):
+
+    def test_float_speed(self):
+        machine = registry[emulator.DEFAULT_PRODUCT_ID]
+        zones = [[machine['zones'][0]['uid'], (0x03, (0xff, 0))]]
+        mode = machine['modes'][0]['uid']
+        for speed in (200, 0x1234):
+            self.assertEqual(
+                compile_for_mode(machine, zones, mode, float(speed)),
+                compile_for_mode(machine, zones, mode, speed))
+            device = emulator.EmulatedDevice()
+            transmit(device, compile_program(machine, zones, [mode],
+                                             float(speed)))
+            self.assertEqual(device.speed, speed)
+
+
+if __name__ == '__main__':
+    unittest.main()
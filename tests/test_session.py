@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+import time
+import unittest
+
+from palienwarey import emulator
+from palienwarey.constants import CMD_SET_COLOR, SUCCESS
+from palienwarey.session import DeviceSession
+
+
+IDLE_TIMEOUT = 0.3
+
+
+class IdleTimerTest(unittest.TestCase):
+    """
+    The device is released once idle for idle_timeout seconds, measured with
+    the monotonic stats.clock.
+    """
+
+    def setUp(self):
+        emulator.enable()
+        self.session = DeviceSession(IDLE_TIMEOUT)
+
+    def tearDown(self):
+        self.session.close()
+        emulator.disable()
+
+    def send(self):
+        zones = [[1, (CMD_SET_COLOR, (0xf0, 0))]]
+        self.assertEqual(self.session.send(zones), SUCCESS)
+
+    def test_released(self):
+        self.send()
+        self.assertTrue(self.session.acquired)
+        time.sleep(IDLE_TIMEOUT * 2)
+        self.assertFalse(self.session.acquired)
+
+    def test_rearmed(self):
+        self.send()
+        # Used later without replacing the timer, which must then wait for
+        # the rest of idle_timeout instead of releasing.
+        self.session.last_used += IDLE_TIMEOUT
+        time.sleep(IDLE_TIMEOUT * 1.5)
+        self.assertTrue(self.session.acquired)
+        time.sleep(IDLE_TIMEOUT * 1.5)
+        self.assertFalse(self.session.acquired)
+
+
+if __name__ == '__main__':
+    unittest.main()